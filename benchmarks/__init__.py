@@ -0,0 +1,3 @@
+"""
+Benchmarks. Run from the repo root, e.g. python -m benchmarks.bench_vectorstore
+"""
@@ -0,0 +1,70 @@
+"""
+Per-request construction overhead of chains and agents: building them every time versus reusing
+them from the chain registry. No API calls are made.
+
+Usage: python -m benchmarks.bench_chains --repeat 200
+"""
+import argparse
+import importlib
+import os
+from statistics import median
+from time import perf_counter
+
+from chains import CHAINS
+from config import DEFAULT_MODEL
+from logger import logger
+
+# Command, module that registers it, and the extra builder args it is called with
+COMMANDS = [('summarize', 'summarize', ('stuff',)),
+            ('eli5', 'summarize', ('map_reduce',)),
+            ('search', 'search', ()),
+            ('sql', 'sql', ()),
+            ('sql-one-step', 'sql', (10,)),
+            ('sql-agent', 'sql', (10,)),
+            ('qa', 'qa', (('ask-ey',),))]
+
+
+# Time a function in microseconds
+def time_us(func, repeat: int) -> float:
+    """
+    Median run time of func over repeat runs.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        runs.append((perf_counter() - start) * 1e6)
+    return median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--model', type=str, default=DEFAULT_MODEL)
+    parser.add_argument('--temperature', type=float, default=0.7)
+    parser.add_argument('--skip', type=str, nargs='*', default=['qa'], help='Commands to skip, e.g. qa needs its indices')
+    args = parser.parse_args()
+
+    # Clients validate that a key is set, but nothing is sent
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+
+    print(f'{"command":<12}{"build us":>12}{"reuse us":>12}{"speedup":>10}')
+    for command, module, extra in COMMANDS:
+        if command in args.skip:
+            continue
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.info(f'Skipping {command}: {e}')
+            continue
+
+        builder = CHAINS.builders[command]
+        build = time_us(lambda: builder(args.model, args.temperature, *extra), args.repeat)
+        CHAINS.get(command, args.model, args.temperature, *extra)
+        reuse = time_us(lambda: CHAINS.get(command, args.model, args.temperature, *extra), args.repeat)
+        print(f'{command:<12}{build:>12.1f}{reuse:>12.1f}{build / reuse:>9.0f}x')
+    print(f'\nRegistry: {CHAINS.stats()}')
+
+
+if __name__ == '__main__':
+    main()
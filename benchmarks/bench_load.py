@@ -0,0 +1,327 @@
+"""
+Load test of the commands against local fakes of OpenAI, Google search, web pages, Pinecone and Discord.
+
+Requests run either through the command handlers in main, with a fake Discord context, or by
+calling the command functions in summarize, search, sql and qa directly. The fake LLM's latency
+and token rate, page size and concurrency are configurable. Reports throughput, p50/p95/p99
+latency, errors, calls to each fake API per request and peak memory. Results are saved as JSON
+and can be compared with an earlier run.
+
+By default every request has a distinct input and caches are bypassed where the command allows it.
+With --distinct N, inputs repeat over N values and caches are used.
+
+Usage: python -m benchmarks.bench_load --scenarios sql search --requests 50 --concurrency 10
+       python -m benchmarks.bench_load --compare benchmarks/results/load-<before>.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List
+
+import numpy as np
+
+import config
+from benchmarks.fakes import FakeContext, FakeServer, FakeSettings, words
+
+SCENARIOS = ['summarize', 'eli5', 'search', 'sql', 'sql-agent', 'ask-ey', 'board']
+RESULTS_DIR = 'benchmarks/results'
+
+
+# Point the bot at the fakes and at throwaway caches; must run before any command module is imported
+def configure(server: FakeServer, cache_dir: str):
+    """
+    Set the API endpoints and keys, and move every on-disk cache into cache_dir.
+    """
+    os.environ['OPENAI_API_KEY'] = 'sk-benchmark'
+    os.environ['OPENAI_API_BASE'] = f'{server.url}/v1'
+    os.environ['GOOGLE_API_KEY'] = 'benchmark'
+    os.environ['GOOGLE_CSE_ID'] = 'benchmark'
+    os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+
+    config.VECTOR_BACKEND = 'local'
+    config.URL_CACHE_PATH = os.path.join(cache_dir, 'url_cache.db')
+    config.RESPONSE_CACHE_PATH = os.path.join(cache_dir, 'response_cache.db')
+    config.SQL_CACHE_PATH = os.path.join(cache_dir, 'sql_cache.db')
+    config.EMBEDDING_CACHE_DIR = os.path.join(cache_dir, 'embeddings')
+    config.TRACE_EXPORT_PATH = None
+    config.WARM_UP = False
+
+
+# Build in-memory indices in place of the Pinecone ones
+def register_indices(server: FakeServer, num_docs: int):
+    """
+    Embed num_docs generated chunks per index through the fake embedding API and register them with qa.
+    """
+    import qa
+    from embedding_cache import cached_embeddings
+    from vectorstore import LocalVectorStore
+
+    for name in (config.PINECONE_INDEX_NAME_EY, config.PINECONE_INDEX_NAME_BOARD):
+        texts = [' '.join(words(120, seed)) for seed in range(num_docs)]
+        metadatas = [{'source': f'{server.url}/page/{name}-{i}'} for i in range(num_docs)]
+        qa.ENGINE.register(name, LocalVectorStore.from_texts(texts, cached_embeddings(config.EMBEDDING_MODEL),
+                                                             metadatas))
+
+
+# Input of the i-th request of a scenario
+def make_input(scenario: str, i: int, server: FakeServer) -> str:
+    """
+    Page URL for summarize and eli5, a question otherwise.
+    """
+    if scenario in ('summarize', 'eli5'):
+        return f'{server.url}/page/{i}'
+    if scenario == 'search':
+        return f'What happened at the conference on day {i}?'
+    if scenario in ('sql', 'sql-agent'):
+        return f'What are the top {i + 1} rated books?'
+    return f'How should I grow as an engineer in year {i}?'
+
+
+# Call a command handler in main the way Discord does
+def handler_call(scenario: str, discord_latency: float, use_cache: bool, users: int = 0) -> Callable[[str], Awaitable]:
+    """
+    Coroutine function running the scenario's handler on a fake context. Error replies raise.
+
+    Requests come from users in turn, or each from a new user if users is 0.
+    """
+    import main
+
+    handlers = {'summarize': (main._summarize, 'url'), 'eli5': (main._eli5, 'url'),
+                'search': (main._search_agent, 'query'), 'sql': (main._sql_chain, 'query'),
+                'sql-agent': (main._sql_agent, 'query'), 'ask-ey': (main._ask_ey, 'question'),
+                'board': (main._ask_board, 'question')}
+    command, option = handlers[scenario]
+    # bot.command wraps the handler in a Command object
+    coro = getattr(command, 'coro', command)
+
+    user_ids = itertools.count()
+
+    async def call(text: str):
+        user_id = next(user_ids)
+        ctx = FakeContext(discord_latency, user_id % users if users else user_id)
+        kwargs = {option: text, 'temperature': 0.0, 'model': config.DEFAULT_MODEL}
+        if scenario not in ('summarize', 'eli5'):
+            kwargs['no_cache'] = not use_cache
+        await coro(ctx, **kwargs)
+        errors = [message.content for message in ctx.messages
+                  if message.content.startswith('Error:') or 'used up the quota' in message.content]
+        if errors:
+            raise RuntimeError(errors[0])
+    return call
+
+
+# Call a command function directly, without Discord or the response cache
+def function_call(scenario: str, use_cache: bool) -> Callable[[str], Awaitable]:
+    """
+    Coroutine function running the scenario's command function, blocking ones on a thread.
+    """
+    from http_client import use_shared_sessions
+
+    if scenario in ('summarize', 'eli5'):
+        import summarize
+        stream = summarize.astream_summarize_url if scenario == 'summarize' else summarize.astream_eli5_url
+
+        async def call(text: str):
+            use_shared_sessions()
+            async for _ in stream(text, 0.0, config.DEFAULT_MODEL):
+                pass
+        return call
+
+    if scenario == 'search':
+        import search
+        func, kwargs = search.search_agent, {}
+    elif scenario in ('sql', 'sql-agent'):
+        import sql
+        func, kwargs = sql.sql_chain if scenario == 'sql' else sql.sql_agent, {'use_cache': use_cache}
+    else:
+        import qa
+        func, kwargs = qa.qa_ey if scenario == 'ask-ey' else qa.qa_board, {}
+
+    def run(text: str):
+        use_shared_sessions()
+        return func(text, 0.0, model=config.DEFAULT_MODEL, **kwargs)
+
+    async def call(text: str):
+        await asyncio.to_thread(run, text)
+    return call
+
+
+# Run requests with bounded concurrency
+async def run_load(call: Callable[[str], Awaitable], inputs: List[str], concurrency: int) -> Dict:
+    """
+    Return the wall time, per-request latencies and error messages.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(text: str):
+        async with semaphore:
+            start = perf_counter()
+            try:
+                await call(text)
+                return perf_counter() - start, None
+            except Exception as e:
+                return perf_counter() - start, repr(e)
+
+    start = perf_counter()
+    results = await asyncio.gather(*(one(text) for text in inputs))
+    return {'wall': perf_counter() - start, 'latencies': [latency for latency, _ in results],
+            'errors': [error for _, error in results if error is not None]}
+
+
+# Summarize a run
+def summarize_run(run: Dict, calls: Dict[str, int], peak_mb: float) -> Dict:
+    """
+    Throughput, latency percentiles in seconds, errors and fake API calls per request.
+    """
+    latencies = np.array(run['latencies'])
+    n = len(latencies)
+    return {'requests': n, 'errors': len(run['errors']), 'error_samples': run['errors'][:3],
+            'throughput': n / run['wall'], 'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'calls_per_request': {endpoint: count / n for endpoint, count in sorted(calls.items())},
+            'peak_mb': peak_mb}
+
+
+# Print results as a table
+def print_results(results: Dict[str, Dict]):
+    print(f'\n{"scenario":<12}{"req":>6}{"err":>6}{"req/s":>9}{"p50 s":>9}{"p95 s":>9}{"p99 s":>9}'
+          f'{"peak MB":>10}  calls/request')
+    for scenario, result in results.items():
+        calls = ', '.join(f'{endpoint} {count:.1f}' for endpoint, count in result['calls_per_request'].items())
+        peak = f'{result["peak_mb"]:.1f}' if result['peak_mb'] is not None else '-'
+        print(f'{scenario:<12}{result["requests"]:>6}{result["errors"]:>6}{result["throughput"]:>9.2f}'
+              f'{result["p50"]:>9.3f}{result["p95"]:>9.3f}{result["p99"]:>9.3f}{peak:>10}  {calls}')
+        for error in result['error_samples']:
+            print(f'{"":<12}error: {error}')
+
+
+# Compare with an earlier run
+def print_comparison(results: Dict[str, Dict], path: str):
+    """
+    Relative change of throughput and latency percentiles for scenarios present in both runs.
+    """
+    with open(path) as f:
+        before = json.load(f)['results']
+    print(f'\nChange vs {path} (negative latency and positive throughput are improvements)')
+    print(f'{"scenario":<12}{"req/s":>9}{"p50":>9}{"p95":>9}{"p99":>9}')
+    for scenario, result in results.items():
+        if scenario not in before:
+            continue
+        changes = [(result[key] - before[scenario][key]) / before[scenario][key] * 100 if before[scenario][key] else 0.0
+                   for key in ('throughput', 'p50', 'p95', 'p99')]
+        print(f'{scenario:<12}' + ''.join(f'{change:>+8.1f}%' for change in changes))
+
+
+# Identify the code that was measured
+def git_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ''
+
+
+async def run_scenarios(args, server: FakeServer) -> Dict[str, Dict]:
+    use_cache = args.distinct > 0
+    results = {}
+    for scenario in args.scenarios:
+        if args.mode == 'handlers':
+            call = handler_call(scenario, args.discord_latency, use_cache, args.users)
+        else:
+            call = function_call(scenario, use_cache)
+
+        # Imports, chain construction and connection setup are not part of the measured run
+        await run_load(call, [make_input(scenario, -1 - i, server) for i in range(args.warm_up)], args.concurrency)
+
+        inputs = [make_input(scenario, i % args.distinct if use_cache else i, server) for i in range(args.requests)]
+        calls_before = dict(server.counters)
+        if args.trace_memory:
+            tracemalloc.start()
+        run = await run_load(call, inputs, args.concurrency)
+        peak_mb = None
+        if args.trace_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        calls = {endpoint: count - calls_before.get(endpoint, 0) for endpoint, count in server.counters.items()}
+        results[scenario] = summarize_run(run, calls, peak_mb)
+
+    from http_client import close_sessions
+    await close_sessions()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', type=str, nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--mode', type=str, default='handlers', choices=['handlers', 'functions'],
+                        help='Drive the Discord handlers in main, or call the command functions directly')
+    parser.add_argument('--requests', type=int, default=50, help='Measured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--warm-up', type=int, default=2, help='Unmeasured requests per scenario')
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='Repeat inputs over this many values and use caches; 0 for all distinct, uncached')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Seconds until the first token')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='Generated tokens per second')
+    parser.add_argument('--completion-tokens', type=int, default=150)
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--page-latency', type=float, default=0.1)
+    parser.add_argument('--page-kb', type=int, default=20)
+    parser.add_argument('--users', type=int, default=0,
+                        help='Send requests from this many users in turn, to exercise quotas and fairness; '
+                             'by default each request comes from a new user')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='Seconds per send, edit and defer')
+    parser.add_argument('--index-docs', type=int, default=200, help='Chunks per in-memory Q&A index')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Measure peak Python heap with tracemalloc, which slows down every request')
+    parser.add_argument('--log-level', type=str, default='WARNING')
+    parser.add_argument('--output', type=str, default=None, help=f'JSON file, by default in {RESULTS_DIR}')
+    parser.add_argument('--compare', type=str, default=None, help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    settings = FakeSettings(llm_latency=args.llm_latency, token_rate=args.token_rate,
+                            completion_tokens=args.completion_tokens, embedding_latency=args.embedding_latency,
+                            search_latency=args.search_latency, page_latency=args.page_latency,
+                            page_kb=args.page_kb)
+    server = FakeServer(settings).start()
+    cache_dir = tempfile.mkdtemp(prefix='bench-load-')
+    configure(server, cache_dir)
+
+    from logger import logger
+    logger.setLevel(args.log_level)
+    # main parses the command line when imported
+    sys.argv = [sys.argv[0]]
+    import search_tools
+    search_tools.GOOGLE_SEARCH_URL = f'{server.url}/customsearch/v1'
+    if {'ask-ey', 'board'} & set(args.scenarios):
+        register_indices(server, args.index_docs)
+
+    results = asyncio.run(run_scenarios(args, server))
+    server.stop()
+
+    print_results(results)
+    # Linux reports kilobytes
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    print(f'\nPeak RSS of the process: {max_rss_mb:.1f} MB')
+    if args.compare:
+        print_comparison(results, args.compare)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'load-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(),
+            'max_rss_mb': max_rss_mb, 'args': vars(args)}
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print(f'Saved results to {output}')
+
+
+if __name__ == '__main__':
+    main()
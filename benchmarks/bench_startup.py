@@ -0,0 +1,92 @@
+"""
+Startup time of the bot: per-module import times of main, and optionally the background warm-up.
+
+Imports are profiled in fresh interpreters with python -X importtime, so nothing is cached.
+
+Usage: python -m benchmarks.bench_startup --runs 3 --top 15 --warm-up
+"""
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+from time import perf_counter
+from typing import Dict, Tuple
+
+from config import WARM_UP_MODULES
+
+
+# Import a module in a fresh interpreter and collect per-module import times
+def profile_import(module: str) -> Tuple[float, Dict[str, float]]:
+    """
+    Return the wall time and the cumulative import time in seconds of module and each of its direct imports.
+    """
+    # main parses the command line when imported
+    code = f'import sys; sys.argv = ["{module}"]; import {module}'
+    start = perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': os.pathsep.join([os.getcwd(), os.getenv('PYTHONPATH', '')])})
+    wall = perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # Lines look like "import time:  self |  cumulative | <indent>name", indented two spaces per nesting level
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # The module itself and what it imports directly; deeper imports are in their parents' time
+        if name.strip() == module or depth == 1:
+            timings[name.strip()] = int(cumulative) / 1e6
+    return wall, timings
+
+
+# Warm up a module the way main does once the bot is connected
+def warm_up_module(name: str) -> float:
+    """
+    Import the module and run its warm_up, returning the time taken.
+    """
+    start = perf_counter()
+    module = importlib.import_module(name)
+    if hasattr(module, 'warm_up'):
+        module.warm_up()
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', type=str, default='main')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--warm-up', action='store_true', help='Also time warming up each command module')
+    args = parser.parse_args()
+
+    walls, runs = [], []
+    for _ in range(args.runs):
+        wall, timings = profile_import(args.module)
+        walls.append(wall)
+        runs.append(timings)
+
+    timings = {name: median(run.get(name, 0.0) for run in runs) for name in runs[0]}
+    print(f'Interpreter start + import {args.module}: {median(walls):.3f}s (median of {args.runs})\n')
+    print(f'{"module":<40}{"import s":>10}')
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'{name:<40}{seconds:>10.3f}')
+
+    if args.warm_up:
+        print(f'\n{"warm-up":<40}{"s":>10}')
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=len(WARM_UP_MODULES)) as executor:
+            futures = {name: executor.submit(warm_up_module, name) for name in WARM_UP_MODULES}
+        for name, future in futures.items():
+            result = f'{future.result():>10.3f}' if future.exception() is None else f'  failed: {future.exception()!r}'
+            print(f'{name:<40}{result}')
+        print(f'{"total (parallel)":<40}{perf_counter() - start:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+CPU time of tokenizing a long page for summarization: re-encoding at every step versus encoding once.
+
+The baseline repeats what the summarize path used to do per request: encode to trim, encode the
+trimmed and full text again to log token counts, and encode once more to split into sections.
+
+Usage: python -m benchmarks.bench_tokenize --tokens 100000 --repeat 5
+"""
+import argparse
+import random
+from statistics import median
+from time import perf_counter
+
+import tiktoken
+
+from config import (SUMMARY_CHUNK_OVERLAP, SUMMARY_CHUNK_TOKENS,
+                    SUMMARY_MAX_PAGE_TOKENS, SUMMARY_MODEL)
+from tokenization import TokenizedText, get_encoding
+
+
+# Generate a page of roughly n_tokens tokens
+def make_page(n_tokens: int, seed: int = 0) -> str:
+    """
+    Random words with punctuation and paragraph breaks, about one token per word.
+    """
+    rng = random.Random(seed)
+    words = open(__file__).read().split() + ['naïve', 'café', '—', '€100', '2023']
+    paragraphs = []
+    while sum(len(p) for p in paragraphs) < n_tokens * 4:
+        paragraphs.append(' '.join(rng.choice(words) for _ in range(rng.randint(20, 120))) + '.')
+    return '\n'.join(paragraphs)
+
+
+# The summarize path before the tokenization service
+def baseline(text: str, max_tokens: int) -> list:
+    enc = tiktoken.encoding_for_model(SUMMARY_MODEL)
+    trimmed = enc.decode(enc.encode(text)[:max_tokens])
+    # Token counts for the log line, each with a freshly looked up encoding
+    len(tiktoken.encoding_for_model(SUMMARY_MODEL).encode(trimmed))
+    len(tiktoken.encoding_for_model(SUMMARY_MODEL).encode(text))
+    # Token splitter
+    tokens = enc.encode(trimmed)
+    sections, start = [], 0
+    while start < len(tokens):
+        sections.append(enc.decode(tokens[start:start + SUMMARY_CHUNK_TOKENS]))
+        if start + SUMMARY_CHUNK_TOKENS >= len(tokens):
+            break
+        start += SUMMARY_CHUNK_TOKENS - SUMMARY_CHUNK_OVERLAP
+    return sections
+
+
+# The summarize path with the tokenization service
+def single_pass(text: str, max_tokens: int) -> list:
+    page = TokenizedText(text)
+    trimmed = page.trim(max_tokens)
+    len(trimmed), len(page)
+    return [section.text for section in trimmed.split(SUMMARY_CHUNK_TOKENS, SUMMARY_CHUNK_OVERLAP)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--max-tokens', type=int, default=SUMMARY_MAX_PAGE_TOKENS)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    get_encoding(SUMMARY_MODEL)  # Load outside the timings
+    print(f'{"tokens":>10}{"baseline ms":>14}{"single-pass ms":>16}{"speedup":>10}{"sections":>10}')
+    for n_tokens in args.tokens:
+        text = make_page(n_tokens)
+        actual = len(get_encoding(SUMMARY_MODEL).encode(text))
+        timings = {}
+        for name, func in (('baseline', baseline), ('single_pass', single_pass)):
+            runs = []
+            for _ in range(args.repeat):
+                start = perf_counter()
+                sections = func(text, args.max_tokens)
+                runs.append((perf_counter() - start) * 1000)
+            timings[name] = median(runs)
+        speedup = timings['baseline'] / timings['single_pass']
+        print(f'{actual:>10,}{timings["baseline"]:>14.1f}{timings["single_pass"]:>16.1f}{speedup:>9.1f}x{len(sections):>10}')
+
+
+if __name__ == '__main__':
+    main()
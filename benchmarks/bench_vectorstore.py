@@ -0,0 +1,88 @@
+"""
+Recall and latency of the local vector store's approximate modes against exact flat search.
+
+Queries are stored document vectors plus Gaussian noise, so no embedding calls are made.
+
+Usage: python -m benchmarks.bench_vectorstore --names board ask-ey --queries 200 --k 4
+"""
+import argparse
+import os
+from time import perf_counter
+
+import numpy as np
+
+from config import LOCAL_INDEX_DIR
+from logger import logger
+from vectorstore import LocalVectorStore, normalize
+
+
+# Build a copy of the store with a different search mode and quantization
+def make_variant(base: LocalVectorStore, search: str, quantized: bool) -> LocalVectorStore:
+    """
+    Copy base into a new store, sharing its IVF index.
+    """
+    store = LocalVectorStore(None, base.dim, search=search, quantized=quantized)
+    store.add_embeddings(base.texts, base._dense(), base.metadatas, base.ids)
+    store.centroids, store.list_ids, store.list_offsets = base.centroids, base.list_ids, base.list_offsets
+    return store
+
+
+# Time queries and compute recall against the exact results
+def run(store: LocalVectorStore, queries: np.ndarray, exact: list, k: int, nprobe: int = None) -> dict:
+    """
+    Return recall@k and p50/p95 latency in milliseconds.
+    """
+    latencies, recalls = [], []
+    for query, truth in zip(queries, exact):
+        start = perf_counter()
+        rows = {row for row, _ in store.search_vector(query, k, nprobe=nprobe)}
+        latencies.append((perf_counter() - start) * 1000)
+        recalls.append(len(rows & truth) / len(truth))
+    return {'recall': float(np.mean(recalls)),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index-dir', type=str, default=LOCAL_INDEX_DIR)
+    parser.add_argument('--names', type=str, nargs='+', default=['board', 'ask-ey'])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--noise', type=float, default=0.02, help='Std of noise added to each query dimension')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for name in args.names:
+        path = os.path.join(args.index_dir, name)
+        if not os.path.exists(path):
+            logger.info(f'Skipping {name}: no local index at {path}')
+            continue
+
+        base = LocalVectorStore.load(path, None, search='flat', mmap=False)
+        if base.centroids is None:
+            base.build_ivf()
+
+        vectors = base._dense()
+        sample = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+        queries = normalize(vectors[sample] + rng.normal(scale=args.noise, size=(len(sample), base.dim)))
+        exact = [{row for row, _ in base.search_vector(query, args.k, search='flat')} for query in queries]
+
+        print(f'\n{name}: {len(base):,} vectors, dim {base.dim}, {len(base.centroids)} IVF lists, k={args.k}')
+        print(f'{"mode":<24}{"recall":>8}{"p50 ms":>10}{"p95 ms":>10}')
+        for quantized in (False, True):
+            dtype = 'int8' if quantized else 'f32'
+            flat = make_variant(base, 'flat', quantized)
+            result = run(flat, queries, exact, args.k)
+            print(f'{"flat-" + dtype:<24}{result["recall"]:>8.3f}{result["p50_ms"]:>10.3f}{result["p95_ms"]:>10.3f}')
+
+            ivf = make_variant(base, 'ivf', quantized)
+            for nprobe in args.nprobe:
+                result = run(ivf, queries, exact, args.k, nprobe)
+                mode = f'ivf-{dtype} nprobe={nprobe}'
+                print(f'{mode:<24}{result["recall"]:>8.3f}{result["p50_ms"]:>10.3f}{result["p95_ms"]:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Local stand-ins for the services the bot calls, for load benchmarks that make no external requests.
+
+FakeServer serves, on one local port:
+- the OpenAI chat, completion and embedding endpoints, with configurable latency and token rate
+- a Google Custom Search endpoint whose results link to the local pages
+- HTML pages of configurable size
+
+Completions are canned but shaped like the real ones, so the SQL chain gets a query it can run,
+the search agent does one search and then answers, and Q&A answers cite a source.
+FakeContext stands in for a Discord command context.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from config import EMBEDDING_DIM
+
+WORDS = ('the model reads every page and keeps the key points of each section so that readers can skim '
+         'a long document in a minute without missing the parts that matter for their work').split()
+NUMBER_PATTERN = re.compile(r'\d+')
+SOURCE_PATTERN = re.compile(r'Source: (\S+)')
+
+
+@dataclass
+class FakeSettings:
+    llm_latency: float = 0.5  # Seconds until the first token
+    token_rate: float = 50.0  # Generated tokens per second
+    completion_tokens: int = 150  # Length of summaries and answers
+    embedding_latency: float = 0.05
+    search_latency: float = 0.2
+    page_latency: float = 0.1
+    page_kb: int = 20  # Size of the HTML pages
+
+
+# Generate filler text
+def words(n: int, seed: int = 0) -> List[str]:
+    """
+    n words, deterministic for a seed.
+    """
+    rng = random.Random(seed)
+    return [rng.choice(WORDS) for _ in range(n)]
+
+
+# Canned completion for a prompt, shaped like what the calling chain expects
+def reply(prompt: str, completion_tokens: int) -> str:
+    """
+    SQL for SQL prompts, a search or final answer for the agent, an answer with sources for Q&A,
+    and bullet points otherwise.
+    """
+    stripped = prompt.rstrip()
+    question = prompt.rsplit('Question:', 1)[-1].strip().split('\n')[0]
+    if stripped.endswith('SQLQuery:'):
+        limit = NUMBER_PATTERN.search(question)
+        return ('SELECT title, authors, average_rating FROM books ORDER BY average_rating DESC '
+                f'LIMIT {limit.group() if limit else 10}')
+    if stripped.endswith('Answer:'):
+        return ' '.join(words(completion_tokens))
+    if 'Action Input:' in prompt:
+        if 'Observation:' in prompt.rsplit('Question:', 1)[-1]:
+            return 'I now know the final answer\nFinal Answer: ' + ' '.join(words(completion_tokens))
+        return f'I should search for this\nAction: Search\nAction Input: {question}'
+    if 'SOURCES' in prompt:
+        sources = SOURCE_PATTERN.findall(prompt)
+        return ' '.join(words(completion_tokens)) + f'\nSOURCES: {sources[-1] if sources else ""}'
+    lines = [words(completion_tokens)[i:i + 15] for i in range(0, completion_tokens, 15)]
+    return '\n'.join('- ' + ' '.join(line) for line in lines)
+
+
+# Split a completion into streamed tokens
+def split_tokens(text: str) -> List[str]:
+    """
+    Words with their leading whitespace, as a rough stand-in for model tokens.
+    """
+    return re.findall(r'\s*\S+', text)
+
+
+# Deterministic unit vector for an embedding input
+def fake_embedding(value, dim: int = EMBEDDING_DIM) -> List[float]:
+    """
+    Random unit vector seeded by the input, which may be text or token ids.
+    """
+    seed = int(hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return np.round(vector / np.linalg.norm(vector), 6).tolist()
+
+
+# HTML page of roughly kb kilobytes, with boilerplate around the article
+def page_html(page_id: str, kb: int) -> str:
+    """
+    Article with a title and paragraphs, plus navigation and footer the extractor should drop.
+    """
+    seed = int(hashlib.sha256(page_id.encode('utf-8')).hexdigest()[:8], 16)
+    paragraphs, size, i = [], 0, 0
+    while size < kb * 1024:
+        paragraph = f'<p>{" ".join(words(80, seed + i))}.</p>'
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+        i += 1
+    return (f'<html><head><title>Page {page_id}</title></head><body>'
+            '<nav><a href="/">Home</a> <a href="/about">About</a></nav>'
+            f'<article><h1>Page {page_id}</h1>{"".join(paragraphs)}</article>'
+            '<footer>Subscribe to the newsletter</footer></body></html>')
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so clients reuse connections as they would with the real APIs
+    server: 'FakeServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: Dict, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        settings = self.server.settings
+        url = urlparse(self.path)
+        if url.path.startswith('/page/'):
+            self.server.count('page')
+            time.sleep(settings.page_latency)
+            kb = int(parse_qs(url.query).get('kb', [settings.page_kb])[0])
+            data = page_html(url.path[len('/page/'):], kb).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif url.path == '/customsearch/v1':
+            self.server.count('search')
+            time.sleep(settings.search_latency)
+            params = parse_qs(url.query)
+            query = params.get('q', [''])[0]
+            num = int(params.get('num', ['10'])[0])
+            digest = hashlib.sha256(query.encode('utf-8')).hexdigest()[:8]
+            self.send_json({'items': [{'title': f'Result {i} for {query}',
+                                       'link': f'{self.server.url}/page/{digest}-{i}',
+                                       'snippet': ' '.join(words(30, i))} for i in range(num)]})
+        else:
+            self.send_json({'error': {'message': f'Unknown path {url.path}'}}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = urlparse(self.path).path
+        if path.endswith('/chat/completions'):
+            prompt = '\n'.join(message.get('content') or '' for message in body.get('messages', []))
+            self.complete(body, [prompt], chat=True)
+        elif path.endswith('/completions'):
+            prompts = body.get('prompt', '')
+            self.complete(body, prompts if isinstance(prompts, list) else [prompts], chat=False)
+        elif path.endswith('/embeddings'):
+            self.embed(body)
+        else:
+            self.send_json({'error': {'message': f'Unknown path {path}'}}, 404)
+
+    def complete(self, body: Dict, prompts: List[str], chat: bool):
+        settings = self.server.settings
+        self.server.count('llm')
+        model = body.get('model', '')
+        texts = [reply(prompt, settings.completion_tokens) for prompt in prompts]
+        tokens = [split_tokens(text) for text in texts]
+        created = int(time.time())
+        time.sleep(settings.llm_latency)
+
+        if not body.get('stream'):
+            time.sleep(sum(len(t) for t in tokens) / settings.token_rate)
+            if chat:
+                choices = [{'index': 0, 'message': {'role': 'assistant', 'content': texts[0]}, 'finish_reason': 'stop'}]
+            else:
+                choices = [{'index': i, 'text': text, 'logprobs': None, 'finish_reason': 'stop'}
+                           for i, text in enumerate(texts)]
+            usage = {'prompt_tokens': sum(len(prompt) // 4 for prompt in prompts),
+                     'completion_tokens': sum(len(t) for t in tokens)}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            self.send_json({'id': 'fake', 'object': 'chat.completion' if chat else 'text_completion',
+                            'created': created, 'model': model, 'choices': choices, 'usage': usage})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, token in enumerate(tokens[0]):
+            if i:
+                time.sleep(1 / settings.token_rate)
+            if chat:
+                choice = {'index': 0, 'delta': {'content': token}, 'finish_reason': None}
+            else:
+                choice = {'index': 0, 'text': token, 'logprobs': None, 'finish_reason': None}
+            event = {'id': 'fake', 'object': 'chat.completion.chunk' if chat else 'text_completion',
+                     'created': created, 'model': model, 'choices': [choice]}
+            self.write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def embed(self, body: Dict):
+        self.server.count('embedding')
+        inputs = body.get('input', [])
+        # A single input is a string or a list of token ids
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        time.sleep(self.server.settings.embedding_latency)
+        self.send_json({'object': 'list', 'model': body.get('model', ''),
+                        'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(value)}
+                                 for i, value in enumerate(inputs)],
+                        'usage': {'prompt_tokens': len(inputs), 'total_tokens': len(inputs)}})
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    Fake OpenAI, search and page server on a local port, serving each request on its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, settings: FakeSettings = None, port: int = 0):
+        super().__init__(('127.0.0.1', port), FakeHandler)
+        self.settings = settings or FakeSettings()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.counters[endpoint] += 1
+
+    def start(self) -> 'FakeServer':
+        """
+        Serve on a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeMessage:
+    """
+    Sent Discord message, editable in place.
+    """
+
+    def __init__(self, content: str, latency: float):
+        self.content = content
+        self.latency = latency
+
+    async def edit(self, content: str = None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.content = content
+
+
+class FakeAuthor:
+    def __init__(self, id: int):
+        self.id = id
+        self.mention = f'<@{id}>'
+
+
+class FakeContext:
+    """
+    Discord command context that records sent messages, with a fixed latency per API call.
+    """
+
+    def __init__(self, latency: float = 0.05, user_id: int = 0, guild_id: Optional[int] = None):
+        self.latency = latency
+        self.author = FakeAuthor(user_id)
+        self.guild_id = guild_id
+        self.messages: List[FakeMessage] = []
+
+    async def defer(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content: str = '', **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(content, self.latency)
+        self.messages.append(message)
+        return message
@@ -0,0 +1,175 @@
+"""
+Read-only query engine for the books database behind the SQL commands.
+
+The schema, a few sample rows and the values of low-cardinality text columns are read once and
+cached, so prompts include them without a round-trip. Connections are opened read-only
+(mode=ro and PRAGMA query_only) and pooled. Each query runs under a time limit enforced by the
+progress handler, and at most SQL_MAX_ROWS rows are returned.
+
+Create the indexes once with: python books_db.py --create-indexes (the Docker build runs it)
+"""
+import argparse
+import queue
+import re
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
+
+from config import (SQL_DB_PATH, SQL_MAX_ROWS, SQL_POOL_SIZE,
+                    SQL_PROGRESS_STEPS, SQL_QUERY_TIMEOUT, SQL_SAMPLE_ROWS,
+                    SQL_STATEMENT_CACHE_SIZE)
+from logger import logger
+from tracing import span
+
+# Authors are matched with LIKE, which only uses a case-insensitive index
+INDEXES = {'idx_books_authors': ('books', '"authors" COLLATE NOCASE'),
+           'idx_books_average_rating': ('books', '"average_rating"'),
+           'idx_books_language_code': ('books', '"language_code"')}
+# Text columns with at most this many distinct values have them listed in the schema
+MAX_LISTED_VALUES = 30
+READ_ONLY_PATTERN = re.compile(r'^\s*(select|with)\b', re.IGNORECASE)
+
+
+@dataclass
+class QueryResult:
+    columns: List[str]
+    rows: List[Tuple]
+    truncated: bool
+    time: float
+
+    def __str__(self) -> str:
+        text = f'{self.columns}\n{self.rows}'
+        if self.truncated:
+            text += f'\n(only the first {len(self.rows)} rows are shown)'
+        return text
+
+
+class BooksDB:
+    """
+    Pool of read-only connections to a SQLite database, with its schema cached.
+    """
+
+    def __init__(self, path: str = SQL_DB_PATH, pool_size: int = SQL_POOL_SIZE,
+                 timeout: float = SQL_QUERY_TIMEOUT, max_rows: int = SQL_MAX_ROWS):
+        self.path = path
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self._pool: queue.Queue = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        self.table_infos = self._read_table_infos()
+        self.table_info = '\n\n'.join(self.table_infos.values())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                               cached_statements=SQL_STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection from the pool, waiting for one if all are in use.
+        """
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def _read_table_infos(self) -> Dict[str, str]:
+        """
+        CREATE statement, sample rows and listed values of each table, like LangChain's table info.
+        """
+        infos = {}
+        with self.connection() as conn:
+            tables = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                                  "AND name NOT LIKE 'sqlite_%'").fetchall()
+            for name, create in tables:
+                cursor = conn.execute(f'SELECT * FROM "{name}" LIMIT {SQL_SAMPLE_ROWS}')
+                columns = [column[0] for column in cursor.description]
+                rows = ['\t'.join(str(value) for value in row) for row in cursor.fetchall()]
+                info = f'{create}\n\n/*\n{len(rows)} rows from {name} table:\n' + '\n'.join(['\t'.join(columns), *rows])
+                for column, type_ in conn.execute(f'SELECT name, type FROM pragma_table_info("{name}")'):
+                    if type_.upper() != 'TEXT':
+                        continue
+                    values = conn.execute(f'SELECT DISTINCT "{column}" FROM "{name}" '
+                                          f'LIMIT {MAX_LISTED_VALUES + 1}').fetchall()
+                    if len(values) <= MAX_LISTED_VALUES:
+                        info += f'\n\nValues of {column}: ' + ', '.join(str(value) for value, in values)
+                infos[name] = info + '\n*/'
+        logger.info(f'Cached schema of {len(infos)} tables from {self.path}')
+        return infos
+
+    def run(self, sql: str, params: Tuple = ()) -> QueryResult:
+        """
+        Run a single SELECT statement within the time limit, returning at most max_rows rows.
+
+        Each connection keeps its compiled statements, so parameterized queries are prepared once.
+        """
+        if not READ_ONLY_PATTERN.match(sql):
+            raise sqlite3.OperationalError('Only SELECT statements are allowed')
+
+        with span('query') as query_span, self.connection() as conn:
+            # The time limit starts once a connection is free, so waiting for the pool doesn't count
+            start = perf_counter()
+            deadline = start + self.timeout
+            # Returning a true value from the handler interrupts the query
+            conn.set_progress_handler(lambda: perf_counter() > deadline, SQL_PROGRESS_STEPS)
+            try:
+                cursor = conn.execute(sql, params)
+                rows = cursor.fetchmany(self.max_rows + 1)
+                columns = [column[0] for column in cursor.description or []]
+                cursor.close()
+            except sqlite3.OperationalError as e:
+                if str(e) == 'interrupted':
+                    raise sqlite3.OperationalError(f'Query took longer than {self.timeout}s') from e
+                raise
+            except (sqlite3.Warning, sqlite3.ProgrammingError) as e:
+                # Several statements raise Warning on Python 3.9 and ProgrammingError later. Neither is an
+                # OperationalError, which the SQL chains retry and the handlers answer
+                raise sqlite3.OperationalError(f'Invalid query: {e}') from e
+            finally:
+                conn.set_progress_handler(None, 0)
+
+            query_span.set(rows=len(rows))
+        result = QueryResult(columns, rows[:self.max_rows], len(rows) > self.max_rows, perf_counter() - start)
+        logger.info(f'Ran query in {result.time:.3f}s, {len(result.rows)} rows: {sql} {params or ""}')
+        return result
+
+
+# Get the shared database engine
+@lru_cache(maxsize=None)
+def get_books_db() -> BooksDB:
+    """
+    Read-only books database, opened on first use.
+    """
+    return BooksDB()
+
+
+# Add the indexes the SQL commands filter and sort on
+def create_indexes(path: str = SQL_DB_PATH):
+    """
+    Create missing indexes and refresh the planner statistics. Needs write access to the database.
+    """
+    conn = sqlite3.connect(path)
+    with conn:
+        for index, (table, column) in INDEXES.items():
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {index} ON "{table}" ({column})')
+        conn.execute('ANALYZE')
+    conn.close()
+    logger.info(f'Created indexes {", ".join(INDEXES)} on {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--create-indexes', action='store_true')
+    parser.add_argument('--path', type=str, default=SQL_DB_PATH)
+    args = parser.parse_args()
+
+    if args.create_indexes:
+        create_indexes(args.path)
+    print(BooksDB(args.path).table_info)
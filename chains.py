@@ -0,0 +1,78 @@
+"""
+Registry of pre-built chains and agents, so requests reuse them instead of rebuilding.
+
+Each command registers a builder. A chain is built on first use for each (command, model,
+temperature, ...) combination and kept in a bounded LRU cache. Chains hold no per-request state,
+so worker threads share them.
+"""
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable
+
+from config import CHAIN_CACHE_SIZE
+from logger import logger
+from tracing import register_cache
+
+
+class ChainRegistry:
+    """
+    Builds chains on first use and keeps the most recently used ones.
+    """
+
+    def __init__(self, maxsize: int = CHAIN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.builders: Dict[str, Callable] = {}
+        self.hits = 0
+        self.misses = 0
+        self._chains: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, command: str) -> Callable:
+        """
+        Decorator registering builder(model, temperature, *args) for command.
+        """
+        def decorator(builder: Callable) -> Callable:
+            self.builders[command] = builder
+            return builder
+        return decorator
+
+    def get(self, command: str, model: str, temperature: float, *args: Hashable):
+        """
+        Get the chain for command, building it if it isn't cached.
+        """
+        key = (command, model, temperature, *args)
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                self._chains.move_to_end(key)
+                self.hits += 1
+                return chain
+
+        # Built outside the lock; a concurrent miss on the same key just builds it twice
+        chain = self.builders[command](model, temperature, *args)
+        logger.info(f'Built chain {key}')
+        with self._lock:
+            self.misses += 1
+            self._chains[key] = chain
+            self._chains.move_to_end(key)
+            while len(self._chains) > self.maxsize:
+                self._chains.popitem(last=False)
+        return chain
+
+    def clear(self):
+        """
+        Drop all cached chains.
+        """
+        with self._lock:
+            self._chains.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit and miss counters and the number of cached chains.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._chains)}
+
+
+# Shared by all commands
+CHAINS = ChainRegistry()
+register_cache('chains', CHAINS.stats)
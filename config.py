@@ -16,13 +16,177 @@ SUMMARY_MAX_TOKENS = SUMMARY_MAX_TOKENS_DICT[SUMMARY_MODEL]
 
 # Config for search
 SEARCH_MODEL = DEFAULT_MODEL
+SEARCH_NUM_RESULTS = 10  # Google returns at most 10 results per request
+SEARCH_CACHE_SIZE = 1024  # Queries and pages kept
+SEARCH_CACHE_TTL = 60 * 60  # Seconds
+SEARCH_CONCURRENCY = 4  # Queries in flight per process
+SEARCH_MAX_QUERIES = 4  # Queries run from one agent step
+SEARCH_PREFETCH_PAGES = 0  # Top result pages whose text is added to the results; 0 to disable
+SEARCH_PAGE_EXCERPT_TOKENS = 300  # Text extracted from each of them
 
 # Config for SQL
 SQL_MODEL = DEFAULT_MODEL
+SQL_DB_PATH = 'data/books.db'
+SQL_POOL_SIZE = 4  # Read-only connections
+SQL_QUERY_TIMEOUT = 5  # Seconds before a query is interrupted
+SQL_PROGRESS_STEPS = 1000  # Virtual machine instructions between time limit checks
+SQL_MAX_ROWS = 50  # Rows returned to the model
+SQL_SAMPLE_ROWS = 3  # Sample rows per table in the prompt
+SQL_STATEMENT_CACHE_SIZE = 256  # Compiled statements kept per connection
+
+# Config for the cache of generated SQL, results and answers; entries are dropped when the database changes
+SQL_CACHE_PATH = 'data/cache/sql_cache.db'
+SQL_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds an answer is served for
+SQL_CACHE_MAX_QUERIES = 1000  # Prepared statements kept
+SQL_CACHE_MAX_RESULTS = 256  # Query results kept in memory
 
 # Config for Q&A
 QA_MODEL = DEFAULT_MODEL
 PINECONE_ENV = 'us-west4-gcp'
 PINECONE_INDEX_NAME_EY = 'ask-ey'
 PINECONE_INDEX_NAME_BOARD = 'board'
+PINECONE_API_KEY_ENV_DICT = {PINECONE_INDEX_NAME_EY: 'PINECONE_API_KEY_EY',
+                             PINECONE_INDEX_NAME_BOARD: 'PINECONE_API_KEY_BOARD'}
 EMBEDDING_MODEL = 'text-embedding-ada-002'
+EMBEDDING_DIM = 1536
+
+# Config for dispatching blocking commands to a worker pool
+WORKER_POOL_TYPE = 'thread'  # 'thread' or 'process'
+WORKER_POOL_SIZE = 8
+COMMAND_CONCURRENCY_DICT = {'summarize': 4,
+                            'eli5': 4,
+                            'search': 2,
+                            'sql': 4,
+                            'sql-agent': 2,
+                            'ask-ey': 4,
+                            'board': 4}
+
+# Config for scheduling requests by estimated cost
+SCHEDULER_SLOTS = 8  # Requests running at once, across commands, in standalone mode
+SCHEDULER_HEAVY_SLOTS = 4  # Of which expensive ones, so that cheap ones always find a free slot
+SCHEDULER_HEAVY_COST = 8000  # Estimated cost above which a request is expensive
+SCHEDULER_USER_CONCURRENCY = 2  # Requests of one user running at once
+# Usual prompt tokens besides the input, and LLM calls, per command
+COMMAND_COST_DICT = {'summarize': (4000, 1),
+                     'eli5': (4000, 1),
+                     'search': (1500, 4),
+                     'sql': (1500, 2),
+                     'sql-agent': (1500, 6),
+                     'ask-ey': (2500, 1),
+                     'board': (2500, 1)}
+MODEL_COST_DICT = {'gpt-3.5-turbo': 1, 'gpt-4': 20}  # Price relative to the default model
+CHARS_PER_TOKEN = 4  # For estimating input tokens without loading a tokenizer
+USER_QUOTA_TOKENS = 500_000  # Estimated cost a user can spend at once, refilled over QUOTA_PERIOD
+GUILD_QUOTA_TOKENS = 5_000_000
+QUOTA_PERIOD = 60 * 60  # Seconds
+
+# Config for the job queue between the gateway and worker processes (python main.py --mode gateway)
+JOB_QUEUE_PATH = 'data/queue/jobs.db'
+JOB_LEASE_SECONDS = 60  # A job whose worker stops extending its lease is run again
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5  # Seconds, times the attempt number
+JOB_POLL_INTERVAL = 0.2  # Seconds between checks of the queue, by the gateway and by idle workers
+JOB_PROGRESS_INTERVAL = 1.0  # Seconds between progress updates of streamed jobs
+JOB_TIMEOUT = 900  # Seconds the gateway waits for a job; interaction tokens expire after 15 minutes
+JOB_RETENTION = 24 * 60 * 60  # Seconds finished jobs are kept
+WORKER_CONCURRENCY = 8  # Jobs each worker process runs at once
+GATEWAY_WORKERS = 2  # Worker processes the gateway's scheduler hands out slots for, unless --workers is given
+
+# Config for the url cache
+URL_CACHE_PATH = 'data/cache/url_cache.db'
+URL_CACHE_TTL = 60 * 60  # Seconds before a cached page is revalidated
+URL_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Config for the response cache; commands without a TTL (in seconds) are not cached
+RESPONSE_CACHE_PATH = 'data/cache/response_cache.db'
+# SQL answers are cached by sql_cache, which knows when the database changed
+RESPONSE_CACHE_TTL_DICT = {'search': 60 * 60,
+                           'ask-ey': 24 * 60 * 60,
+                           'board': 24 * 60 * 60}
+RESPONSE_CACHE_SEMANTIC_COMMANDS = []  # Off by default; e.g. ['ask-ey', 'board'] to match similar questions
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.97
+
+# Config for the local vector store
+VECTOR_BACKEND = 'pinecone'  # 'pinecone' or 'local'
+LOCAL_INDEX_DIR = 'data/index'
+LOCAL_INDEX_SEARCH = 'ivf'  # 'flat' (exact) or 'ivf' (approximate)
+LOCAL_INDEX_QUANTIZE = False  # Store vectors as int8
+LOCAL_INDEX_NPROBE = 8  # IVF lists scanned per query
+
+# Config for embedding ingestion
+INGEST_CHUNK_SIZE = 1500  # Characters per chunk
+INGEST_CHUNK_OVERLAP = 50
+INGEST_BATCH_SIZE = 100  # Texts per embedding call
+INGEST_CONCURRENCY = 4  # Embedding calls in flight
+INGEST_MAX_RETRIES = 6
+
+# Config for crawling the Q&A corpora (python crawler.py)
+CRAWL_DIR = 'data/corpus'  # Parquet partitions per site, ready for ingest.py
+CRAWL_STATE_PATH = 'data/corpus/crawl.db'  # Validators and content hashes of crawled pages
+CRAWL_CONCURRENCY = 16  # Pages in flight across sites
+CRAWL_HOST_CONCURRENCY = 2  # Pages in flight per host
+CRAWL_HOST_DELAY = 0.5  # Seconds between requests to a host, unless its robots.txt asks for more
+CRAWL_BATCH_SIZE = 100  # Changed pages per parquet file
+CRAWL_USER_AGENT = 'discord-llm-crawler/1.0'
+
+# Config for the embedding cache
+EMBEDDING_CACHE_DIR = 'data/cache/embeddings'
+EMBEDDING_CACHE_CAPACITY = 50000  # Vectors; about 150MB on disk as float16
+EMBEDDING_CACHE_DTYPE = 'float16'
+
+# Config for retrieval
+RETRIEVAL_TOP_K = 4  # Chunks passed to the Q&A chain
+RETRIEVAL_FETCH_K = 20  # Candidates fetched per index and ranking before fusion
+RETRIEVAL_HYBRID = True  # Fuse BM25 keyword results with vector results
+RRF_K = 60  # Reciprocal-rank fusion constant
+MMR_LAMBDA = 0.7  # 1 = relevance only, 0 = diversity only
+MMR_DUPLICATE_THRESHOLD = 0.9  # Token overlap above which a chunk counts as a duplicate
+
+# Config for packing retrieved chunks into the Q&A prompt
+QA_PACK_CANDIDATES = 12  # Chunks retrieved before packing
+# Upper bound on context tokens per model, below what the model allows, to bound cost and latency
+QA_CONTEXT_MAX_TOKENS_DICT = {'gpt-3.5-turbo': 2000,
+                              'gpt-4': 5000}
+QA_ANSWER_TOKENS = 512  # Reserved for the answer
+QA_MIN_CHUNK_TOKENS = 100  # Don't trim the last chunk below this
+
+# Config for summarizing long pages with map-reduce
+SUMMARY_MAX_PAGE_TOKENS = 60000  # Pages are truncated beyond this
+SUMMARY_CHUNK_TOKENS = 3000  # Tokens per section summarized in the map step
+SUMMARY_CHUNK_OVERLAP = 100
+SUMMARY_MAP_MAX_TOKENS = 300  # Max length of each section summary
+SUMMARY_MAP_CONCURRENCY = 8  # Section summaries in flight per request
+
+# Config for fetching pages and extracting their text
+FETCH_TIMEOUT = 10  # Seconds
+FETCH_MAX_BYTES = 5 * 1024 * 1024  # Downloads stop beyond this
+FETCH_CHUNK_BYTES = 64 * 1024
+EXTRACT_CHARS_PER_TOKEN = 6  # Generous, so that early termination rarely leaves the page short of the budget
+EXTRACT_MIN_LINE_CHARS = 20  # Shorter lines other than headings are dropped as boilerplate
+EXTRACT_MAX_LINK_DENSITY = 0.5  # Lines that are mostly link text are dropped as menus
+
+# Config for the shared HTTP clients
+HTTP_TIMEOUT = 60  # Seconds, for requests that don't set their own
+HTTP_MAX_HOSTS = 32  # Hosts with a pool of kept-alive connections
+HTTP_MAX_CONNECTIONS_PER_HOST = 16
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_RETRIES = 3  # On connection errors and 429/5xx responses
+HTTP_BACKOFF_FACTOR = 0.5
+
+# Config for reusing built chains and agents
+CHAIN_CACHE_SIZE = 64  # (command, model, temperature) combinations kept
+
+# Config for sending responses to Discord
+OUTPUT_FILE_THRESHOLD = 6000  # Characters; longer responses are attached as a file with a preview
+OUTPUT_SOURCE_CHARS = 1000  # Characters of each Q&A source shown in its embed
+OUTPUT_SEND_BURST = 5  # Messages sent or edited per channel before pacing kicks in
+OUTPUT_SEND_PERIOD = 2.0  # Seconds for a full burst to refill, like Discord's webhook buckets
+
+# Config for tracing and metrics
+METRICS_ADDR = '127.0.0.1'
+METRICS_PORT = 8000  # Serves /metrics; None to disable
+TRACE_EXPORT_PATH = None  # JSON lines file spans are appended to, e.g. 'data/traces/spans.jsonl'; None to disable
+
+# Config for startup
+WARM_UP = True  # Initialize backends in the background once the bot is connected
+WARM_UP_MODULES = ['summarize', 'search', 'sql', 'qa']
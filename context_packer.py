@@ -0,0 +1,98 @@
+"""
+Pack retrieved chunks into the Q&A prompt up to a per-model token budget.
+
+Chunks are taken in retrieval order. Overlap with an already packed chunk from the same source
+is stripped, and the last chunk that doesn't fit is trimmed rather than dropped.
+"""
+from typing import List, Tuple
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.chains.qa_with_sources.stuff_prompt import (EXAMPLE_PROMPT,
+                                                           PROMPT)
+from langchain.docstore.document import Document
+
+from config import (QA_ANSWER_TOKENS, QA_CONTEXT_MAX_TOKENS_DICT,
+                    QA_MIN_CHUNK_TOKENS, QA_PACK_CANDIDATES,
+                    SUMMARY_MAX_TOKENS_DICT)
+from logger import logger
+from retrieval import HybridRetriever
+from tokenization import get_encoding
+
+DOCUMENT_SEPARATOR = '\n\n'  # How the stuff chain joins documents
+MIN_OVERLAP_CHARS = 20  # Shorter matches are likely coincidental
+MAX_OVERLAP_CHARS = 500
+
+
+# Compute the tokens available for documents in the prompt
+def context_budget(question: str, model: str) -> int:
+    """
+    Model's prompt budget less the prompt template, question and space reserved for the answer,
+    capped per model by QA_CONTEXT_MAX_TOKENS_DICT to bound cost and latency.
+    """
+    enc = get_encoding(model)
+    overhead = len(enc.encode(PROMPT.format(question=question, summaries='')))
+    return min(SUMMARY_MAX_TOKENS_DICT[model] - overhead - QA_ANSWER_TOKENS, QA_CONTEXT_MAX_TOKENS_DICT[model])
+
+
+# Strip the part of text that overlaps an adjacent chunk
+def strip_overlap(previous: str, text: str) -> str:
+    """
+    Remove a prefix of text that repeats the end of previous, or a suffix that repeats its start.
+    """
+    for size in range(min(len(previous), len(text), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+        if previous.startswith(text[-size:]):
+            return text[:-size].rstrip()
+    return text
+
+
+# Pack documents into a token budget
+def pack_documents(docs: List[Document], budget: int, model: str) -> Tuple[List[Document], int]:
+    """
+    Return the packed documents and the number of tokens they use.
+    """
+    enc = get_encoding(model)
+    packed, used = [], 0
+    for doc in docs:
+        source = doc.metadata.get('source', '')
+        text = doc.page_content
+
+        # Skip chunks already covered and strip overlap with chunks from the same source
+        same_source = [p.page_content for p in packed if p.metadata.get('source', '') == source]
+        if any(text in previous for previous in same_source):
+            continue
+        for previous in same_source:
+            text = strip_overlap(previous, text)
+        if not text:
+            continue
+
+        overhead = len(enc.encode(EXAMPLE_PROMPT.format(page_content='', source=source) + DOCUMENT_SEPARATOR))
+        tokens = enc.encode(text)
+        remaining = budget - used - overhead
+        if len(tokens) <= remaining:
+            packed.append(Document(page_content=text, metadata=doc.metadata))
+            used += len(tokens) + overhead
+            continue
+
+        # Trim the chunk that doesn't fit, unless too little of it would be left to be useful
+        if remaining >= QA_MIN_CHUNK_TOKENS:
+            packed.append(Document(page_content=enc.decode(tokens[:remaining]), metadata=doc.metadata))
+            used += remaining + overhead
+        break
+    return packed, used
+
+
+class PackedRetriever(HybridRetriever):
+    """
+    Hybrid retriever that packs its results into the model's context budget.
+    """
+    model: str
+    k: int = QA_PACK_CANDIDATES
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        candidates = self.engine.retrieve(query, self.index_names, self.k)
+        budget = context_budget(query, self.model)
+        docs, used = pack_documents(candidates, budget, self.model)
+        logger.info(f'Packed {len(docs)}/{len(candidates)} chunks into {used}/{budget} context tokens ({self.model})')
+        return docs
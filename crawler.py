@@ -0,0 +1,491 @@
+"""
+Incremental crawler for the corpora behind the Q&A indices.
+
+Reads each site's RSS feed, sitemap or index page, then fetches its pages concurrently. Requests
+to a host are limited to CRAWL_HOST_CONCURRENCY at a time and spaced by CRAWL_HOST_DELAY, or by
+the crawl delay in its robots.txt, whose disallowed paths are skipped.
+
+Pages are only fetched and written again if they changed:
+- pages whose sitemap lastmod is the same as at the last crawl aren't requested,
+- other pages are requested with the ETag and Last-Modified of the last crawl, and a 304 response
+  is skipped,
+- pages whose extracted text hashes to the same value as before are skipped.
+Pages whose text became too short are written with empty text, so that ingest.py drops them.
+
+Changed pages are written as they come in, CRAWL_BATCH_SIZE at a time, to parquet files
+partitioned by site: data/corpus/site=<name>/part-<time>-<n>.parquet. ingest.py reads these
+directories and keeps the latest version of each url.
+
+Usage: python crawler.py --sites paulgraham lethain
+       python ingest.py --index board data/corpus/site=paulgraham data/corpus/site=lethain ...
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bs4 import BeautifulSoup
+
+from config import (CRAWL_BATCH_SIZE, CRAWL_CONCURRENCY, CRAWL_DIR,
+                    CRAWL_HOST_CONCURRENCY, CRAWL_HOST_DELAY,
+                    CRAWL_STATE_PATH, CRAWL_USER_AGENT, FETCH_TIMEOUT)
+from http_client import arequest, close_sessions
+from logger import logger
+
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+SCHEMA = pa.schema([('url', pa.string()), ('title', pa.string()), ('text', pa.string()),
+                    ('content_hash', pa.string()), ('fetched_at', pa.float64())])
+
+
+@dataclass(frozen=True)
+class Site:
+    """
+    Where to find a site's pages and how to extract their text.
+    """
+    name: str
+    feed: str
+    feed_type: str  # 'rss', 'sitemap' or 'links' (an index page linking to every page)
+    include: Optional[str] = None  # Pattern urls must match
+    exclude: Optional[str] = None  # Pattern of urls to skip
+    require_lastmod: bool = False  # Skip sitemap entries without lastmod, which are listing pages
+    paragraphs: bool = True  # Extract <p> elements, else all text on the page
+    skip: Tuple[str, ...] = ()  # Paragraphs containing these are dropped
+    skip_classes: Tuple[str, ...] = ()  # Paragraphs with these classes are dropped
+    stop: Optional[str] = None  # Paragraphs from the first one containing this on are dropped
+    min_line_chars: int = 5  # Shorter lines are dropped
+    min_chars: int = 0  # Pages with less text, like talks that are mostly slides, are skipped
+
+
+# Extraction rules from notebooks/scrape.ipynb
+SITES = {site.name: site for site in [
+    Site('paulgraham', 'http://www.aaronsw.com/2002/feeds/pgessays.rss', 'rss', paragraphs=False),
+    Site('lethain', 'https://lethain.com/sitemap.xml', 'sitemap', require_lastmod=True,
+         exclude=r'^https://lethain\.com/(tags/.*|posts/|about/)?$',
+         stop="Hi folks. I'm Will aka @lethain", min_chars=1000),
+    Site('charitymajors', 'https://charity.wtf/sitemap-1.xml', 'sitemap', require_lastmod=True,
+         exclude=r'^https://charity\.wtf/about/$', stop='[…]', min_chars=1000),
+    Site('naval', 'https://nav.al/sitemap-1.xml', 'sitemap', require_lastmod=True,
+         stop='Modal body text goes here.', min_chars=500),
+    Site('pmarca', 'https://pmarchive.com/', 'links', include=r'\.html$',
+         skip=('An archive of the best articles from Marc', 'Maintained by your friends at'),
+         stop='This article was written by Marc Andreessen and originally published on his blog, blog.pmarca.com.',
+         min_chars=500),
+    Site('eugeneyan', 'https://eugeneyan.com/sitemap.xml', 'sitemap', include=r'^https://eugeneyan\.com/writing/.',
+         skip_classes=('date',), stop='To cite this content, please use:', min_line_chars=20, min_chars=500),
+]}
+
+
+@dataclass
+class Entry:
+    url: str
+    title: Optional[str] = None
+    lastmod: Optional[str] = None
+
+
+@dataclass
+class Fetched:
+    status: int
+    body: bytes = b''
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    charset: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        # The notebook re-decoded pages that requests took for latin-1; without a declared charset, assume utf-8
+        return self.body.decode(self.charset or 'utf-8', errors='replace')
+
+
+@dataclass
+class PageState:
+    lastmod: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: Optional[str]
+
+
+# Hash extracted text, to recognize pages whose content didn't change
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Parse the pages listed in an RSS feed or sitemap
+def parse_feed(xml: bytes) -> Tuple[List[Entry], List[str]]:
+    """
+    Return the feed's entries, and the child sitemaps if it is a sitemap index.
+    """
+    entries, sitemaps = [], []
+    root = ET.fromstring(xml)
+    for element in root.iter():
+        # Sitemaps are namespaced, RSS feeds aren't
+        tag = element.tag.rsplit('}', 1)[-1]
+        fields = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in element}
+        if tag == 'item' and fields.get('link'):
+            entries.append(Entry(fields['link'], fields.get('title') or None))
+        elif tag == 'url' and fields.get('loc'):
+            entries.append(Entry(fields['loc'], lastmod=fields.get('lastmod') or None))
+        elif tag == 'sitemap' and fields.get('loc'):
+            sitemaps.append(fields['loc'])
+    return entries, sitemaps
+
+
+# Parse the pages linked from an index page
+def parse_links(html: str, base_url: str) -> List[Entry]:
+    """
+    Links to pages on the same host, without fragments, in order of first appearance.
+    """
+    host = urlsplit(base_url).hostname
+    urls = {}
+    for a in BeautifulSoup(html, PARSER).find_all('a', href=True):
+        url = urljoin(base_url, a['href'])
+        if '#' not in url and urlsplit(url).hostname == host:
+            urls.setdefault(url, Entry(url, a.get_text().strip() or None))
+    return list(urls.values())
+
+
+# Extract a page's title and text with its site's rules
+def extract_text(html: str, site: Site) -> Tuple[Optional[str], str]:
+    """
+    Return the page title and its text, one stripped line per paragraph.
+    """
+    soup = BeautifulSoup(html, PARSER)
+    title = soup.title.get_text().strip() if soup.title else None
+    if not site.paragraphs:
+        lines = soup.get_text().splitlines()
+    else:
+        lines = []
+        for p in soup.find_all('p'):
+            text = p.get_text()
+            if any(cls in p.get('class', ()) for cls in site.skip_classes):
+                continue
+            if any(skip in text for skip in site.skip):
+                continue
+            if site.stop and site.stop in text:
+                break
+            lines.append(text)
+    lines = (line.strip() for line in lines)
+    return title, '\n'.join(line for line in lines if len(line) > site.min_line_chars)
+
+
+class CrawlState:
+    """
+    Sitemap lastmod, HTTP validators and content hash of every crawled page, in SQLite.
+    """
+
+    def __init__(self, path: str = CRAWL_STATE_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                site TEXT NOT NULL,
+                lastmod TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                crawled_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def load(self, site: str) -> Dict[str, PageState]:
+        rows = self._conn.execute('SELECT url, lastmod, etag, last_modified, content_hash FROM pages WHERE site = ?',
+                                  (site,))
+        return {url: PageState(*state) for url, *state in rows}
+
+    def save(self, site: str, pages: Dict[str, PageState]):
+        now = time.time()
+        self._conn.executemany("""
+            INSERT OR REPLACE INTO pages (url, site, lastmod, etag, last_modified, content_hash, crawled_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(url, site, state.lastmod, state.etag, state.last_modified, state.content_hash, now)
+              for url, state in pages.items()])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class PartitionWriter:
+    """
+    Writes a site's changed pages to parquet files in batches, recording their state once they are on disk.
+    """
+
+    def __init__(self, site: str, state: CrawlState, out_dir: str = CRAWL_DIR, batch_size: int = CRAWL_BATCH_SIZE):
+        self.site = site
+        self.state = state
+        self.dir = os.path.join(out_dir, f'site={site}')
+        self.batch_size = batch_size
+        # Names sort by time of the run, so ingest can tell which version of a page is the latest
+        self.prefix = time.strftime('part-%Y%m%dT%H%M%S', time.gmtime())
+        self.parts = 0
+        self.rows: List[Dict] = []
+        self.pending: Dict[str, PageState] = {}
+        os.makedirs(self.dir, exist_ok=True)
+
+    async def add(self, url: str, state: PageState, row: Optional[Dict] = None):
+        """
+        Record the state of a crawled page, and write row if the page changed.
+        """
+        self.pending[url] = state
+        if row is not None:
+            self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        rows, pending = self.rows, self.pending
+        self.rows, self.pending = [], {}
+        if rows:
+            path = os.path.join(self.dir, f'{self.prefix}-{self.parts:04d}.parquet')
+            self.parts += 1
+            table = pa.Table.from_pylist(rows, schema=SCHEMA)
+            # Written to a temporary name first, so readers never see a partial file
+            await asyncio.to_thread(pq.write_table, table, f'{path}.tmp', compression='gzip')
+            os.replace(f'{path}.tmp', path)
+            logger.info(f'Wrote {len(rows)} pages to {path}')
+        if pending:
+            await asyncio.to_thread(self.state.save, self.site, pending)
+
+
+class HostLimiter:
+    """
+    Limits concurrent requests per host and spaces out their starts.
+    """
+
+    def __init__(self, concurrency: int = CRAWL_HOST_CONCURRENCY, delay: float = CRAWL_HOST_DELAY):
+        self.delay = delay
+        self._slots: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(concurrency))
+        self._next_start: Dict[str, float] = {}
+
+    @asynccontextmanager
+    async def slot(self, host: str, delay: Optional[float] = None):
+        async with self._slots[host]:
+            now = monotonic()
+            start = max(now, self._next_start.get(host, 0.0))
+            self._next_start[host] = start + max(self.delay, delay or 0.0)
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+class Crawler:
+    """
+    Crawls sites concurrently, politely, and only re-fetches and re-writes what changed.
+    """
+
+    def __init__(self, state: CrawlState, out_dir: str = CRAWL_DIR, concurrency: int = CRAWL_CONCURRENCY,
+                 host_concurrency: int = CRAWL_HOST_CONCURRENCY, host_delay: float = CRAWL_HOST_DELAY,
+                 full: bool = False):
+        self.state = state
+        self.out_dir = out_dir
+        self.full = full  # Fetch every page and write it, changed or not
+        self.pages = asyncio.Semaphore(concurrency)
+        self.hosts = HostLimiter(host_concurrency, host_delay)
+        self._robots: Dict[str, asyncio.Future] = {}
+
+    async def _fetch_robots(self, origin: str) -> RobotFileParser:
+        robots = RobotFileParser(f'{origin}/robots.txt')
+        try:
+            fetched = await self.fetch(f'{origin}/robots.txt', check_robots=False)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.info(f'Fetching {origin}/robots.txt failed: {e!r}')
+            fetched = Fetched(0)
+        # Like RobotFileParser.read: an unauthorized robots.txt disallows everything, a missing one nothing,
+        # and a host that can't serve it is left alone until the next crawl
+        if fetched.status == 200:
+            robots.parse(fetched.text.splitlines())
+        elif fetched.status in (401, 403):
+            robots.disallow_all = True
+        elif 400 <= fetched.status < 500:
+            robots.allow_all = True
+        else:
+            logger.info(f'No robots.txt from {origin} (status {fetched.status}), skipping its pages')
+            robots.disallow_all = True
+        return robots
+
+    async def robots(self, url: str) -> RobotFileParser:
+        """
+        The robots.txt rules of url's host, fetched once per crawl.
+        """
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        if origin not in self._robots:
+            self._robots[origin] = asyncio.ensure_future(self._fetch_robots(origin))
+        return await self._robots[origin]
+
+    async def fetch(self, url: str, headers: Dict[str, str] = None, check_robots: bool = True) -> Fetched:
+        """
+        GET url within the host's limits. Urls that robots.txt disallows aren't requested and get a 403.
+        """
+        delay = None
+        if check_robots:
+            robots = await self.robots(url)
+            if not robots.can_fetch(CRAWL_USER_AGENT, url):
+                return Fetched(403)
+            delay = robots.crawl_delay(CRAWL_USER_AGENT)
+        # Take the host's slot first, so that pages waiting on a slow host don't hold up other hosts
+        async with self.hosts.slot(urlsplit(url).netloc, float(delay) if delay else None), self.pages:
+            response = await arequest('GET', url, headers={'User-Agent': CRAWL_USER_AGENT, **(headers or {})},
+                                      timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT))
+            try:
+                body = await response.read() if response.status == 200 else b''
+                return Fetched(response.status, body, response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'), response.charset)
+            finally:
+                response.release()
+
+    async def discover(self, site: Site) -> List[Entry]:
+        """
+        The pages listed by the site's feed, sitemap (following sitemap indexes) or index page, filtered by its rules.
+        """
+        entries, feeds = [], [site.feed]
+        while feeds:
+            feed = feeds.pop()
+            fetched = await self.fetch(feed)
+            if fetched.status != 200:
+                raise ValueError(f'Fetching {feed} for {site.name} returned {fetched.status}')
+            if site.feed_type == 'links':
+                entries += await asyncio.to_thread(parse_links, fetched.text, feed)
+            else:
+                found, sitemaps = parse_feed(fetched.body)
+                entries += found
+                feeds += sitemaps
+
+        unique = {}
+        for entry in entries:
+            if site.require_lastmod and not entry.lastmod:
+                continue
+            if site.include and not re.search(site.include, entry.url):
+                continue
+            if site.exclude and re.search(site.exclude, entry.url):
+                continue
+            unique.setdefault(entry.url, entry)
+        return list(unique.values())
+
+    async def crawl_page(self, site: Site, entry: Entry, known: Optional[PageState], writer: PartitionWriter,
+                         stats: Counter):
+        """
+        Fetch a page unless it is known to be unchanged, and write it if its text changed.
+        """
+        if not self.full and known is not None and known.content_hash and entry.lastmod \
+                and entry.lastmod == known.lastmod:
+            stats['unchanged_lastmod'] += 1
+            return
+
+        headers = {}
+        if not self.full and known is not None:
+            if known.etag:
+                headers['If-None-Match'] = known.etag
+            if known.last_modified:
+                headers['If-Modified-Since'] = known.last_modified
+
+        try:
+            fetched = await self.fetch(entry.url, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f'Fetching {entry.url} failed: {e!r}')
+            stats['failed'] += 1
+            return
+        if fetched.status == 304:
+            stats['not_modified'] += 1
+            await writer.add(entry.url, PageState(entry.lastmod, fetched.etag or known.etag,
+                                                  fetched.last_modified or known.last_modified, known.content_hash))
+            return
+        if fetched.status != 200:
+            logger.info(f'Fetching {entry.url} returned {fetched.status}')
+            stats['failed'] += 1
+            return
+
+        title, text = await asyncio.to_thread(extract_text, fetched.text, site)
+        if len(text) < site.min_chars:
+            # Written with empty text, so that ingest drops the page instead of keeping an older version of it
+            text = ''
+        digest = content_hash(text)
+        state = PageState(entry.lastmod, fetched.etag, fetched.last_modified, digest)
+        unchanged = not self.full and known is not None and known.content_hash == digest
+        if not text:
+            stats['too_short'] += 1
+        elif unchanged:
+            stats['unchanged_content'] += 1
+        else:
+            stats['written'] += 1
+        await writer.add(entry.url, state, None if unchanged else {
+            'url': entry.url, 'title': entry.title or title, 'text': text,
+            'content_hash': digest, 'fetched_at': time.time()})
+
+    async def crawl_site(self, site: Site) -> Counter:
+        """
+        Crawl a site's pages and write the changed ones to its partition.
+        """
+        start_time = perf_counter()
+        stats = Counter()
+        known = await asyncio.to_thread(self.state.load, site.name)
+        entries = await self.discover(site)
+        stats['pages'] = len(entries)
+        logger.info(f'Crawling {len(entries)} pages of {site.name} ({len(known)} crawled before)')
+
+        writer = PartitionWriter(site.name, self.state, self.out_dir)
+        try:
+            await asyncio.gather(*[self.crawl_page(site, entry, known.get(entry.url), writer, stats)
+                                   for entry in entries])
+        finally:
+            await writer.flush()
+        logger.info(f'Crawled {site.name} in {perf_counter() - start_time:.1f}s: {dict(stats)}')
+        return stats
+
+    async def crawl(self, sites: List[Site]) -> Dict[str, Counter]:
+        """
+        Crawl sites concurrently. A site that fails doesn't stop the others.
+        """
+        results = await asyncio.gather(*[self.crawl_site(site) for site in sites], return_exceptions=True)
+        stats = {}
+        for site, result in zip(sites, results):
+            if isinstance(result, Exception):
+                logger.error(f'Crawling {site.name} failed: {result!r}')
+                result = Counter(error=1)
+            stats[site.name] = result
+        return stats
+
+
+async def main(args):
+    state = CrawlState(args.state)
+    crawler = Crawler(state, args.out, args.concurrency, args.host_concurrency, args.host_delay, args.full)
+    try:
+        stats = await crawler.crawl([SITES[name] for name in args.sites])
+    finally:
+        await close_sessions()
+        state.close()
+    for name, site_stats in stats.items():
+        print(f'{name}: {dict(site_stats)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sites', type=str, nargs='+', default=list(SITES), choices=list(SITES))
+    parser.add_argument('--out', type=str, default=CRAWL_DIR, help='Directory of the site partitions')
+    parser.add_argument('--state', type=str, default=CRAWL_STATE_PATH)
+    parser.add_argument('--concurrency', type=int, default=CRAWL_CONCURRENCY)
+    parser.add_argument('--host-concurrency', type=int, default=CRAWL_HOST_CONCURRENCY)
+    parser.add_argument('--host-delay', type=float, default=CRAWL_HOST_DELAY)
+    parser.add_argument('--full', action='store_true', help='Fetch and write every page, even unchanged ones')
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,109 @@
+"""
+Dispatch blocking commands to a worker pool so they don't block the Discord event loop.
+"""
+import asyncio
+import contextvars
+from collections import defaultdict
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from functools import partial
+from typing import AsyncIterator, Callable, Dict
+
+from config import (COMMAND_CONCURRENCY_DICT, WORKER_POOL_SIZE,
+                    WORKER_POOL_TYPE)
+from logger import logger
+from tracing import QUEUE_DEPTH, RUNNING
+
+
+# Create the executor that runs blocking calls
+def create_executor(pool_type: str = WORKER_POOL_TYPE, pool_size: int = WORKER_POOL_SIZE) -> Executor:
+    """
+    Create a thread or process pool executor.
+    """
+    if pool_type == 'thread':
+        return ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='worker')
+    if pool_type == 'process':
+        return ProcessPoolExecutor(max_workers=pool_size)
+    raise ValueError(f'Unknown worker pool type: {pool_type}')
+
+
+class Dispatcher:
+    """
+    Runs blocking functions on a worker pool with per-command concurrency limits.
+
+    Commands without a configured limit are bounded only by the pool size.
+    """
+
+    def __init__(self, executor: Executor = None, concurrency: Dict[str, int] = None):
+        self.executor = executor or create_executor()
+        self.concurrency = COMMAND_CONCURRENCY_DICT if concurrency is None else concurrency
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._waiting = defaultdict(int)  # Requests waiting for a concurrency slot
+        self._running = defaultdict(int)  # Requests currently executing
+
+    def _semaphore(self, command: str) -> asyncio.Semaphore:
+        # Created lazily so that the semaphore binds to the running event loop
+        if command not in self._semaphores:
+            limit = self.concurrency.get(command, 0)
+            self._semaphores[command] = asyncio.Semaphore(limit) if limit > 0 else None
+        return self._semaphores[command]
+
+    async def run(self, command: str, func: Callable, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the worker pool and await its result.
+        """
+        semaphore = self._semaphore(command)
+        loop = asyncio.get_running_loop()
+
+        self._waiting[command] += 1
+        QUEUE_DEPTH.labels(command).set(self._waiting[command])
+        logger.info(f'Queued {command}: {self.queue_depth(command)} waiting, {self._running[command]} running')
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+        finally:
+            self._waiting[command] -= 1
+            QUEUE_DEPTH.labels(command).set(self._waiting[command])
+
+        self._running[command] += 1
+        RUNNING.labels(command).set(self._running[command])
+        call = partial(func, *args, **kwargs)
+        if isinstance(self.executor, ThreadPoolExecutor):
+            # Run in a copy of the context so that spans opened by func nest under the request.
+            # Contexts can't be pickled, so spans in worker processes start their own traces
+            call = partial(contextvars.copy_context().run, call)
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        finally:
+            self._running[command] -= 1
+            RUNNING.labels(command).set(self._running[command])
+            if semaphore is not None:
+                semaphore.release()
+
+    def stream(self, command: str, func: Callable[..., AsyncIterator], *args, **kwargs) -> AsyncIterator:
+        """
+        Call the async generator function func. It runs on the event loop, so the pool isn't involved.
+        """
+        return func(*args, **kwargs)
+
+    def queue_depth(self, command: str = None) -> int:
+        """
+        Number of requests waiting for a concurrency slot, for one command or in total.
+        """
+        if command is not None:
+            return self._waiting[command]
+        return sum(self._waiting.values())
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Waiting and running counts per command.
+        """
+        commands = set(self._waiting) | set(self._running)
+        return {command: {'waiting': self._waiting[command], 'running': self._running[command]}
+                for command in sorted(commands)}
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shut down the worker pool.
+        """
+        self.executor.shutdown(wait=wait)
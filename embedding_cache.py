@@ -0,0 +1,212 @@
+"""
+Persistent cache of embeddings, keyed by (model, normalized text).
+
+Vectors live in one fixed-capacity memory-mapped file; a SQLite index maps keys to slots.
+When the cache is full, the least recently used slot is reused.
+
+The bot, workers and ingest.py share the cache directory. Lookups and stores each hold SQLite's
+write lock (BEGIN IMMEDIATE) from choosing slots until the vectors are read or written, so two
+processes never pick the same slot, and a slot isn't reused while another process reads it.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+
+from config import (EMBEDDING_CACHE_CAPACITY, EMBEDDING_CACHE_DIR,
+                    EMBEDDING_CACHE_DTYPE, EMBEDDING_DIM, EMBEDDING_MODEL)
+from logger import logger
+from tracing import register_cache, span
+
+
+# Build the cache key for a text
+def embedding_key(model: str, text: str) -> str:
+    """
+    Hash of model and whitespace-normalized text. Case is kept since embeddings are case-sensitive.
+    """
+    text = re.sub(r'\s+', ' ', text.strip())
+    return hashlib.sha256(f'{model}\n{text}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Fixed-capacity, memory-mapped embedding cache with LRU eviction.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_DIR, dim: int = EMBEDDING_DIM,
+                 capacity: int = EMBEDDING_CACHE_CAPACITY, dtype: str = EMBEDDING_CACHE_DTYPE):
+        self.dim = dim
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        meta = {'dim': dim, 'capacity': capacity, 'dtype': self.dtype.name}
+        meta_path = os.path.join(path, 'meta.json')
+        vectors_path = os.path.join(path, 'vectors.bin')
+        index_path = os.path.join(path, 'index.db')
+
+        # Start over if the layout changed, since slots would no longer line up
+        stored = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                stored = json.load(f)
+            if stored != meta:
+                logger.info(f'Embedding cache layout changed, resetting {path}')
+                for stale in (vectors_path, index_path):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+        if stored != meta:
+            # Moved into place, so that processes opening the cache meanwhile never read a partial file
+            tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+
+        mode = 'r+' if os.path.exists(vectors_path) else 'w+'
+        self.vectors = np.memmap(vectors_path, dtype=self.dtype, mode=mode, shape=(capacity, dim))
+
+        # Autocommit, so that transactions can take the write lock up front with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+        """)
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up embeddings for texts; misses are None.
+        """
+        keys = [embedding_key(model, text) for text in texts]
+        with self._lock, self._transaction():
+            slots = {}
+            for key in set(keys):
+                row = self._conn.execute('SELECT slot FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    slots[key] = row[0]
+            if slots:
+                now = time.time()
+                self._conn.executemany('UPDATE entries SET last_used = ? WHERE key = ?',
+                                       [(now, key) for key in slots])
+            results = [self.vectors[slots[key]].astype(np.float32).tolist() if key in slots else None
+                       for key in keys]
+
+        n_hits = sum(result is not None for result in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """
+        Store embeddings, evicting the least recently used entries when full.
+        """
+        # Converted first, so that a bad vector fails before any slot is overwritten
+        vectors = [np.asarray(vector, dtype=self.dtype).reshape(self.dim) for vector in vectors]
+        with self._lock, self._transaction():
+            now = time.time()
+            for text, vector in zip(texts, vectors):
+                key = embedding_key(model, text)
+                row = self._conn.execute('SELECT slot FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    slot = row[0]
+                else:
+                    slot = self._free_slot()
+                self.vectors[slot] = vector
+                self._conn.execute('INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)',
+                                   (key, slot, now))
+            # Written out before the commit, so other processes never see a slot before its vector
+            self.vectors.flush()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Hold the database's write lock, across processes, for the enclosed block.
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def _free_slot(self) -> int:
+        # Slots fill up in order and evicted slots are reused immediately, so used slots are always 0..count-1
+        count = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        if count < self.capacity:
+            return count
+        key, slot = self._conn.execute('SELECT key, slot FROM entries ORDER BY last_used LIMIT 1').fetchone()
+        self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return slot
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit and miss counters.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that consult the embedding cache before calling the underlying model.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str = EMBEDDING_MODEL):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        results = self.cache.get_many(self.model, texts)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            with span('embed', texts=len(missing)):
+                vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            self.cache.put_many(self.model, [texts[i] for i in missing], vectors)
+            for i, vector in zip(missing, vectors):
+                results[i] = vector
+        return results
+
+    def embed_query(self, text: str) -> List[float]:
+        result = self.cache.get_many(self.model, [text])[0]
+        if result is None:
+            with span('embed', texts=1):
+                result = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model, [text], [result])
+        return result
+
+
+# Get the process-wide embeddings client backed by the shared cache
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Shared embedding cache, created on first use.
+    """
+    cache = EmbeddingCache()
+    register_cache('embedding', cache.stats)
+    return cache
+
+
+# Get embeddings for a model, backed by the shared cache
+def cached_embeddings(model: str = EMBEDDING_MODEL) -> CachedEmbeddings:
+    """
+    OpenAI embeddings for model, wrapped with the shared embedding cache.
+    """
+    return CachedEmbeddings(OpenAIEmbeddings(model=model), get_embedding_cache(), model)
@@ -0,0 +1,358 @@
+"""
+Streaming extraction of the main text content from html pages.
+
+The body is parsed as it downloads, with lxml's target parser when it is installed and the stdlib
+HTMLParser otherwise. Script, style and navigation markup is skipped, as are elements whose class
+or id marks them as boilerplate, and text inside <article>/<main> is preferred when the page has
+it. If that leaves no text, e.g. since the whole body sits in a <div class="has-sidebar">, the page
+is parsed again keeping all of its text. Downloads stop at FETCH_MAX_BYTES or once enough text was
+extracted for the token budget. Error responses raise FetchError instead of being extracted.
+"""
+import asyncio
+import codecs
+import re
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from config import (EXTRACT_CHARS_PER_TOKEN, EXTRACT_MAX_LINK_DENSITY,
+                    EXTRACT_MIN_LINE_CHARS, FETCH_CHUNK_BYTES,
+                    FETCH_MAX_BYTES, FETCH_TIMEOUT, SUMMARY_MAX_PAGE_TOKENS)
+from http_client import arequest, get_session
+from logger import logger
+from tracing import record, span
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Bump when extraction changes, so cached text is extracted again
+EXTRACTOR_VERSION = 3
+
+SKIP_TAGS = {'script', 'style', 'noscript', 'template', 'svg', 'canvas', 'iframe', 'nav', 'header', 'footer',
+             'aside', 'form', 'button', 'select', 'head'}
+MAIN_TAGS = {'article', 'main'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+BLOCK_TAGS = HEADING_TAGS | MAIN_TAGS | {'p', 'div', 'section', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'pre',
+                                         'blockquote', 'table', 'tr', 'td', 'th', 'br', 'hr', 'figcaption', 'body'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+BOILERPLATE_PATTERN = re.compile(r'(^|[\s_-])(nav|navbar|menu|sidebar|footer|header|comments?|share|sharing|social|'
+                                 r'related|cookie|banner|subscribe|newsletter|breadcrumbs?|advert|ads|promo|popup|'
+                                 r'modal)([\s_-]|$)', re.IGNORECASE)
+
+
+class FetchError(ValueError):
+    """
+    Raised for a page that returned an error status.
+    """
+
+
+class ContentHandler:
+    """
+    Parser target that collects text blocks, skipping boilerplate subtrees.
+
+    With strict off, only script, style and similar tags are skipped and every block is kept.
+    """
+
+    def __init__(self, strict: bool = True):
+        self.strict = strict
+        self.blocks: List[Dict] = []  # {'text', 'main', 'heading', 'link_chars'}
+        self.main_chars = 0
+        self.total_chars = 0
+        self._parts: List[str] = []
+        self._link_chars = 0
+        self._skip: Optional[List] = None  # [tag, depth] of the subtree being skipped
+        self._main_depth = 0
+        self._link_depth = 0
+        self._heading = False
+
+    def start(self, tag: str, attrs: Dict[str, str]):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if self._skip is not None:
+            if tag == self._skip[0]:
+                self._skip[1] += 1
+            return
+        if self._is_boilerplate(tag, attrs):
+            self.flush()
+            if tag not in VOID_TAGS:
+                self._skip = [tag, 1]
+            return
+        if tag in BLOCK_TAGS:
+            self.flush()
+        if tag in MAIN_TAGS:
+            self._main_depth += 1
+        elif tag in HEADING_TAGS:
+            self._heading = True
+        elif tag == 'a':
+            self._link_depth += 1
+
+    def _is_boilerplate(self, tag: str, attrs: Dict[str, str]) -> bool:
+        if tag in ('header', 'footer') and self._main_depth:
+            return False  # An article's own header holds its title
+        if tag in SKIP_TAGS:
+            return True
+        if not self.strict or tag in MAIN_TAGS or tag in ('html', 'body'):
+            return False
+        return BOILERPLATE_PATTERN.search(f'{attrs.get("class") or ""} {attrs.get("id") or ""}') is not None
+
+    def end(self, tag: str):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if self._skip is not None:
+            if tag == self._skip[0]:
+                self._skip[1] -= 1
+                if self._skip[1] == 0:
+                    self._skip = None
+            return
+        if tag in BLOCK_TAGS:
+            self.flush()
+        if tag in MAIN_TAGS:
+            self._main_depth = max(self._main_depth - 1, 0)
+        elif tag in HEADING_TAGS:
+            self._heading = False
+        elif tag == 'a':
+            self._link_depth = max(self._link_depth - 1, 0)
+
+    def data(self, data: str):
+        if self._skip is None:
+            self._parts.append(data)
+            if self._link_depth:
+                self._link_chars += len(data.strip())
+
+    def flush(self):
+        """
+        End the current block.
+        """
+        text = ' '.join(''.join(self._parts).split())
+        if text:
+            main = self._main_depth > 0
+            self.blocks.append({'text': text, 'main': main, 'heading': self._heading,
+                                'link_chars': self._link_chars})
+            self.total_chars += len(text)
+            if main:
+                self.main_chars += len(text)
+        self._parts, self._link_chars = [], 0
+
+    def close(self):
+        self.flush()
+
+    def text(self) -> str:
+        """
+        Main content if the page marks it, else all content, without short lines and link lists.
+        """
+        if not self.strict:
+            return '\n'.join(block['text'] for block in self.blocks)
+        prefer_main = self.main_chars > 0
+        lines = []
+        for block in self.blocks:
+            if prefer_main and not block['main']:
+                continue
+            text = block['text']
+            if block['link_chars'] > EXTRACT_MAX_LINK_DENSITY * len(text):
+                continue
+            if not block['heading'] and len(text) < EXTRACT_MIN_LINE_CHARS:
+                continue
+            lines.append(text)
+        return '\n'.join(lines)
+
+
+class StdlibParser(HTMLParser):
+    """
+    Feeds the stdlib parser's events to a ContentHandler, like lxml's target parser does.
+    """
+
+    def __init__(self, target: ContentHandler):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, {name: value or '' for name, value in attrs})
+        if tag in VOID_TAGS:
+            self.target.end(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, {name: value or '' for name, value in attrs})
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in VOID_TAGS:
+            self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+    def close(self):
+        super().close()
+        self.target.close()
+
+
+# Create a parser that feeds its events to handler
+def make_parser(handler: ContentHandler):
+    """
+    lxml's target parser when it is installed, else the stdlib parser.
+    """
+    if etree is not None:
+        return etree.HTMLParser(target=handler, recover=True, no_network=True)
+    return StdlibParser(handler)
+
+
+class StreamingExtractor:
+    """
+    Incrementally parses html and reports when enough text was extracted for the token budget.
+    """
+
+    def __init__(self, max_tokens: int = SUMMARY_MAX_PAGE_TOKENS):
+        self.handler = ContentHandler()
+        self.parser = make_parser(self.handler)
+        # Characters are a cheap, generous stand-in for tokens; the text is trimmed exactly later
+        self.max_chars = max_tokens * EXTRACT_CHARS_PER_TOKEN
+        self.chunks: List[str] = []
+        self.parse_time = 0.0  # Seconds spent parsing, interleaved with the download
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Parse the next chunk of html. Returns True once the token budget is reached.
+        """
+        start = perf_counter()
+        self.chunks.append(chunk)
+        self.parser.feed(chunk)
+        self.parse_time += perf_counter() - start
+        handler = self.handler
+        return (handler.main_chars if handler.main_chars else handler.total_chars) >= self.max_chars
+
+    def close(self) -> str:
+        """
+        Finish parsing and return the extracted text.
+        """
+        start = perf_counter()
+        close_parser(self.parser, self.handler)
+        text = self.handler.text()
+        if not text:
+            # Everything was dropped as boilerplate; parse again, keeping all text
+            handler = ContentHandler(strict=False)
+            parser = make_parser(handler)
+            parser.feed(self.html)
+            close_parser(parser, handler)
+            text = handler.text()
+            logger.info(f'No main text found, kept all {len(text):,} chars')
+        self.parse_time += perf_counter() - start
+        return text
+
+    @property
+    def html(self) -> str:
+        return ''.join(self.chunks)
+
+
+# Finish parsing
+def close_parser(parser, handler: ContentHandler):
+    try:
+        parser.close()
+    except Exception as e:
+        # lxml raises on documents it couldn't recover anything from
+        logger.info(f'Html parser failed to close: {e}')
+        handler.close()
+
+
+# Extract the main text from a complete html document
+def extract_text(html: str, max_tokens: int = SUMMARY_MAX_PAGE_TOKENS) -> str:
+    """
+    Extract the main text from html.
+    """
+    extractor = StreamingExtractor(max_tokens)
+    for start in range(0, len(html), FETCH_CHUNK_BYTES):
+        if extractor.feed(html[start:start + FETCH_CHUNK_BYTES]):
+            break
+    return extractor.close()
+
+
+@dataclass
+class FetchedPage:
+    status: int
+    html: str
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    truncated: bool
+
+
+# Pick the decoder for a response body
+def get_decoder(charset: Optional[str]) -> codecs.IncrementalDecoder:
+    """
+    Incremental decoder for the declared charset, defaulting to UTF-8 rather than HTTP's Latin-1.
+    """
+    try:
+        return codecs.getincrementaldecoder(charset or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+# Fetch a page and extract its text while it downloads
+def fetch_page(url: str, headers: Dict[str, str] = None, max_bytes: int = FETCH_MAX_BYTES,
+               max_tokens: int = SUMMARY_MAX_PAGE_TOKENS) -> FetchedPage:
+    """
+    Stream url with a timeout, stopping at max_bytes or once max_tokens worth of text was extracted.
+    """
+    # The fetch span includes parsing, which is also recorded on its own
+    with span('fetch', url=url) as fetch_span:
+        with get_session().get(url, headers=headers, stream=True, timeout=FETCH_TIMEOUT) as response:
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            fetch_span.set(status=response.status_code)
+            if response.status_code == 304:
+                return FetchedPage(304, '', '', etag, last_modified, False)
+            if not 200 <= response.status_code < 300:
+                raise FetchError(f'{url} returned HTTP {response.status_code}')
+
+            charset = re.search(r'charset=["\']?([\w.:-]+)', response.headers.get('Content-Type', ''))
+            decoder = get_decoder(charset.group(1) if charset else None)
+            extractor = StreamingExtractor(max_tokens)
+            received, truncated = 0, False
+            for chunk in response.iter_content(chunk_size=FETCH_CHUNK_BYTES):
+                received += len(chunk)
+                if extractor.feed(decoder.decode(chunk)) or received >= max_bytes:
+                    truncated = True
+                    break
+            extractor.feed(decoder.decode(b'', final=True))
+
+        text = extractor.close()
+        fetch_span.set(bytes=received, truncated=truncated)
+        record('parse', extractor.parse_time, chars=len(text))
+    logger.info(f'Fetched {received:,} bytes{" (truncated)" if truncated else ""}, extracted {len(text):,} chars from {url}')
+    return FetchedPage(response.status_code, extractor.html, text, etag, last_modified, truncated)
+
+
+# Fetch a page and extract its text while it downloads, without blocking the event loop
+async def afetch_page(url: str, headers: Dict[str, str] = None, max_bytes: int = FETCH_MAX_BYTES,
+                      max_tokens: int = SUMMARY_MAX_PAGE_TOKENS) -> FetchedPage:
+    """
+    Asynchronous fetch_page. Parsing runs in the default executor since it is CPU-bound.
+    """
+    loop = asyncio.get_running_loop()
+    with span('fetch', url=url) as fetch_span:
+        response = await arequest('GET', url, headers=headers, timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT))
+        async with response:
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            fetch_span.set(status=response.status)
+            if response.status == 304:
+                return FetchedPage(304, '', '', etag, last_modified, False)
+            if not 200 <= response.status < 300:
+                raise FetchError(f'{url} returned HTTP {response.status}')
+
+            decoder = get_decoder(response.charset)
+            extractor = StreamingExtractor(max_tokens)
+            received, truncated = 0, False
+            async for chunk in response.content.iter_chunked(FETCH_CHUNK_BYTES):
+                received += len(chunk)
+                done = await loop.run_in_executor(None, extractor.feed, decoder.decode(chunk))
+                if done or received >= max_bytes:
+                    truncated = True
+                    break
+            extractor.feed(decoder.decode(b'', final=True))
+
+        text = await loop.run_in_executor(None, extractor.close)
+        fetch_span.set(bytes=received, truncated=truncated)
+        record('parse', extractor.parse_time, chars=len(text))
+    logger.info(f'Fetched {received:,} bytes{" (truncated)" if truncated else ""}, extracted {len(text):,} chars from {url}')
+    return FetchedPage(response.status, extractor.html, text, etag, last_modified, truncated)
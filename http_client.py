@@ -0,0 +1,189 @@
+"""
+Process-wide HTTP clients shared by page fetching, search and OpenAI calls.
+
+One requests Session serves blocking calls and one aiohttp ClientSession serves the event loop,
+so connections are kept alive and reused instead of paying a TCP+TLS handshake per request.
+Connections per host are capped, requests time out by default, and 429/5xx responses are retried
+with jittered exponential backoff, honoring Retry-After.
+
+HTTP/2 isn't available here: requests, aiohttp and the openai client built on them speak HTTP/1.1
+only, so keep-alive pooling is where the handshake savings come from.
+"""
+import asyncio
+import random
+import threading
+from collections import Counter
+from typing import Dict, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import (HTTP_BACKOFF_FACTOR, HTTP_MAX_CONNECTIONS,
+                    HTTP_MAX_CONNECTIONS_PER_HOST, HTTP_MAX_HOSTS,
+                    HTTP_MAX_RETRIES, HTTP_TIMEOUT)
+from logger import logger
+from tracing import register_pools
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Non-idempotent requests are only retried when the server signals it didn't process them
+SAFE_RETRY_STATUSES = (429, 503)
+
+COUNTERS = Counter()
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_aiohttp_session: Optional[aiohttp.ClientSession] = None
+
+
+class JitterRetry(Retry):
+    """
+    Retry with full jitter on the exponential backoff, and status retries of POSTs only on 429/503.
+    """
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+    def is_retry(self, method, status_code, has_retry_after=False) -> bool:
+        if method.upper() in Retry.DEFAULT_ALLOWED_METHODS:
+            return super().is_retry(method, status_code, has_retry_after)
+        return bool(self.total) and status_code in SAFE_RETRY_STATUSES
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        COUNTERS['retries'] += 1
+        if response is not None:
+            COUNTERS[f'retries_{response.status}'] += 1
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class SharedSession(requests.Session):
+    """
+    Session with a default timeout.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        COUNTERS['requests'] += 1
+        return super().request(method, url, **kwargs)
+
+
+# Create a requests session with the shared pool limits, retries and timeout
+def new_session() -> requests.Session:
+    """
+    Session that retries 429/5xx with jittered backoff and caps connections per host.
+    """
+    retry = JitterRetry(total=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                        status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    # pool_block makes callers wait for a free connection, capping concurrency per host
+    adapter = HTTPAdapter(pool_connections=HTTP_MAX_HOSTS, pool_maxsize=HTTP_MAX_CONNECTIONS_PER_HOST,
+                          pool_block=True, max_retries=retry)
+    session = SharedSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Get the shared requests session
+def get_session() -> requests.Session:
+    """
+    Process-wide requests session, created on first use.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+
+# Get the shared aiohttp session for the running event loop
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """
+    Process-wide aiohttp session, created on first use from within the event loop.
+    """
+    global _aiohttp_session
+    loop = asyncio.get_running_loop()
+    if _aiohttp_session is None or _aiohttp_session.closed or _aiohttp_session._loop is not loop:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                         ttl_dns_cache=300)
+        _aiohttp_session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return _aiohttp_session
+
+
+# Send an async request, retrying 429/5xx with jittered backoff
+async def arequest(method: str, url: str, max_retries: int = HTTP_MAX_RETRIES, **kwargs) -> aiohttp.ClientResponse:
+    """
+    Request url on the shared aiohttp session. The caller reads and releases the response.
+    """
+    session = get_aiohttp_session()
+    for attempt in range(max_retries + 1):
+        COUNTERS['requests'] += 1
+        response = await session.request(method, url, **kwargs)
+        if response.status not in RETRY_STATUSES or attempt == max_retries:
+            return response
+        retry_after = response.headers.get('Retry-After', '')
+        response.release()
+        delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, HTTP_BACKOFF_FACTOR * 2 ** attempt)
+        COUNTERS['retries'] += 1
+        COUNTERS[f'retries_{response.status}'] += 1
+        logger.info(f'{method} {url} returned {response.status}, retrying in {delay:.1f}s')
+        await asyncio.sleep(delay)
+
+
+# Route the openai client through the shared sessions
+def use_shared_sessions():
+    """
+    Make openai (and so LangChain's OpenAI wrappers) use the shared aiohttp session, and sessions like the shared one.
+
+    openai.aiosession is a context variable, so call this in each task that makes async openai calls.
+    """
+    # Imported here since openai loads pandas and numpy on import, which would slow down startup
+    import openai
+
+    # A factory rather than the shared session: openai keeps one session per thread and closes it every few
+    # minutes, which would close the shared pool under page fetching and search
+    openai.requestssession = new_session
+    try:
+        openai.aiosession.set(get_aiohttp_session())
+    except RuntimeError:
+        pass  # No running event loop
+
+
+# Pool utilization and request counters
+def stats() -> Dict:
+    """
+    Requests and retries so far, and open and idle connections per host.
+    """
+    pools = {}
+    if _session is not None:
+        pool_manager = _session.get_adapter('https://').poolmanager
+        for key in pool_manager.pools.keys():
+            pool = pool_manager.pools.get(key)
+            if pool is None:
+                continue  # Evicted meanwhile
+            pools[f'{pool.scheme}://{pool.host}'] = {'opened': pool.num_connections, 'requests': pool.num_requests,
+                                                    'idle': sum(conn is not None for conn in list(pool.pool.queue))}
+    connector = _aiohttp_session.connector if _aiohttp_session is not None and not _aiohttp_session.closed else None
+    aio = {}
+    if connector is not None:
+        aio = {'in_use': sum(len(conns) for conns in connector._acquired_per_host.values()),
+               'idle': sum(len(conns) for conns in connector._conns.values()), 'limit': connector.limit}
+    return {**COUNTERS, 'pools': pools, 'aiohttp': aio}
+
+
+register_pools(stats)
+
+
+# Close the shared sessions
+async def close_sessions():
+    """
+    Close the shared sessions on shutdown.
+    """
+    global _session, _aiohttp_session
+    if _aiohttp_session is not None and not _aiohttp_session.closed:
+        await _aiohttp_session.close()
+    _aiohttp_session = None
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
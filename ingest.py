@@ -0,0 +1,259 @@
+"""
+Incremental embedding ingestion for the Q&A indices.
+
+Streams parquet rows (url, text) through the text splitter and content-hashes each chunk. Inputs are
+parquet files or directories of them, like the site partitions written by crawler.py.
+Only chunks that aren't in the index's manifest are embedded and upserted; chunks that
+disappeared from a re-ingested url are deleted. Progress is checkpointed to the manifest,
+so an interrupted run resumes where it left off.
+
+Usage: python ingest.py --index board data/charitymajors.parquet data/naval.parquet
+       python ingest.py --index board data/corpus/site=charitymajors data/corpus/site=naval
+"""
+import argparse
+import glob
+import hashlib
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import openai
+import pinecone
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from config import (EMBEDDING_MODEL, INGEST_BATCH_SIZE, INGEST_CHUNK_OVERLAP,
+                    INGEST_CHUNK_SIZE, INGEST_CONCURRENCY, INGEST_MAX_RETRIES,
+                    LOCAL_INDEX_DIR, LOCAL_INDEX_SEARCH,
+                    PINECONE_API_KEY_ENV_DICT, PINECONE_ENV,
+                    PINECONE_INDEX_NAME_BOARD, PINECONE_INDEX_NAME_EY,
+                    VECTOR_BACKEND)
+from embedding_cache import cached_embeddings
+from http_client import use_shared_sessions
+from logger import logger
+from manifest import Chunk, Manifest, manifest_path
+from vectorstore import LocalVectorStore
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+                    openai.error.ServiceUnavailableError, openai.error.APIConnectionError)
+
+
+# Hash a chunk so that unchanged chunks are recognized across runs
+def chunk_id(source: str, text: str) -> str:
+    """
+    Content hash of a chunk and the url it came from.
+    """
+    return hashlib.sha256(f'{source}\n{text}'.encode('utf-8')).hexdigest()
+
+
+# Stream (url, text) rows from parquet files
+def read_file(path: str, batch_size: int = 64) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (url, text) rows without loading the whole file into memory.
+    """
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=['url', 'text']):
+        yield from zip(batch.column('url').to_pylist(), batch.column('text').to_pylist())
+
+
+# Stream (url, text) rows from parquet files and directories
+def read_rows(paths: List[str], batch_size: int = 64) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (url, text) rows of each file, or of each directory's files.
+
+    The crawler writes a page again when it changes, in a file whose name sorts after the earlier ones.
+    Directories are read newest file first. Only the first row of each url across all paths is kept, since
+    later rows of the url would delete its chunks as stale. Rows with empty text are yielded too, so that
+    the chunks of a page that lost its text are deleted.
+    """
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True),
+                           key=os.path.basename, reverse=True)
+        else:
+            files = [path]
+        for file in files:
+            for url, text in read_file(file, batch_size):
+                if url in seen:
+                    continue
+                seen.add(url)
+                yield url, text or ''
+
+
+# Split rows into chunks grouped by url
+def split_rows(rows: Iterator[Tuple[str, str]], splitter: RecursiveCharacterTextSplitter) -> Iterator[Tuple[str, List[Chunk]]]:
+    """
+    Yield (url, chunks) for each row.
+    """
+    for url, text in rows:
+        splits = splitter.split_text(text) if text else []
+        yield url, [(chunk_id(url, split), url, split) for split in splits]
+
+
+# Embed texts, backing off when rate limited
+def embed_with_backoff(embeddings: Embeddings, texts: List[str], max_retries: int = INGEST_MAX_RETRIES) -> List[List[float]]:
+    """
+    Embed texts with exponential backoff and jitter on rate limits and transient errors.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            # Honor Retry-After if the API sent one, else back off exponentially with full jitter
+            retry_after = (getattr(e, 'headers', None) or {}).get('retry-after')
+            delay = float(retry_after) if retry_after else random.uniform(0, min(60, 2 ** attempt))
+            logger.info(f'Embedding failed ({e.__class__.__name__}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+class LocalSink:
+    """
+    Upserts into a local vector store, saving it at each checkpoint.
+    """
+
+    def __init__(self, name: str, embeddings: Embeddings):
+        self.path = os.path.join(LOCAL_INDEX_DIR, name)
+        self.embeddings = embeddings
+        self.store = None
+        self.dirty = False  # Unsaved changes since the last checkpoint
+        self.changed = False  # Any changes in this run
+        if os.path.exists(os.path.join(self.path, 'meta.json')):
+            self.store = LocalVectorStore.load(self.path, embeddings, mmap=False)
+
+    def upsert(self, chunks: List[Chunk], vectors: List[List[float]]):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.store is None:
+            self.store = LocalVectorStore(self.embeddings, vectors.shape[1])
+        # This Q&A chain relies on the url being in the 'source' key
+        self.store.add_embeddings([text for _, _, text in chunks], vectors,
+                                  [{'source': source} for _, source, _ in chunks],
+                                  [id_ for id_, _, _ in chunks])
+        self.dirty = self.changed = True
+
+    def delete(self, ids: List[str]):
+        if self.store is not None and self.store.delete(ids):
+            self.dirty = self.changed = True
+
+    def checkpoint(self):
+        if self.store is not None and self.dirty:
+            self.store.save(self.path)
+            self.dirty = False
+
+    def finish(self):
+        # New vectors were assigned to existing lists; re-cluster so the lists stay balanced
+        if self.changed and LOCAL_INDEX_SEARCH == 'ivf' and len(self.store):
+            self.store.build_ivf()
+            self.dirty = True
+        self.checkpoint()
+
+
+class PineconeSink:
+    """
+    Upserts into a Pinecone index. Every upsert is durable, so checkpoints are no-ops.
+    """
+
+    def __init__(self, name: str):
+        pinecone.init(api_key=os.getenv(PINECONE_API_KEY_ENV_DICT[name]), environment=PINECONE_ENV)
+        self.index = pinecone.Index(name)
+
+    def upsert(self, chunks: List[Chunk], vectors: List[List[float]]):
+        # LangChain's Pinecone store reads the text from the 'text' metadata key
+        self.index.upsert(vectors=[(id_, vector, {'text': text, 'source': source})
+                                   for (id_, source, text), vector in zip(chunks, vectors)])
+
+    def delete(self, ids: List[str]):
+        if ids:
+            self.index.delete(ids=ids)
+
+    def checkpoint(self):
+        pass
+
+    def finish(self):
+        logger.info(f'Index stats: {self.index.describe_index_stats()}')
+
+
+# Group new chunks into embedding batches, deleting stale chunks along the way
+def delta_batches(docs: Iterator[Tuple[str, List[Chunk]]], manifest: Manifest, sink, stats: Dict[str, int],
+                  batch_size: int) -> Iterator[List[Chunk]]:
+    """
+    Yield batches of chunks that aren't in the manifest yet.
+    """
+    batch = []
+    for source, chunks in docs:
+        existing = manifest.ids_for_source(source)
+        current = {id_ for id_, _, _ in chunks}
+
+        stale = list(existing - current)
+        if stale:
+            sink.delete(stale)
+            manifest.remove(stale)
+            stats['deleted'] += len(stale)
+
+        manifest.fill_texts([chunk for chunk in chunks if chunk[0] in existing])
+        for chunk in chunks:
+            if chunk[0] in existing:
+                stats['skipped'] += 1
+                continue
+            existing.add(chunk[0])  # Identical splits within a page are embedded once
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+# Ingest parquet files into an index
+def ingest(name: str, paths: List[str], backend: str = VECTOR_BACKEND, batch_size: int = INGEST_BATCH_SIZE,
+           concurrency: int = INGEST_CONCURRENCY) -> Dict[str, int]:
+    """
+    Embed and upsert only the chunks that changed since the last run.
+    """
+    embeddings = cached_embeddings(EMBEDDING_MODEL)
+    manifest = Manifest(manifest_path(name, backend))
+    sink = LocalSink(name, embeddings) if backend == 'local' else PineconeSink(name)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=INGEST_CHUNK_SIZE, chunk_overlap=INGEST_CHUNK_OVERLAP)
+
+    stats = {'embedded': 0, 'skipped': 0, 'deleted': 0}
+    batches = delta_batches(split_rows(read_rows(paths), splitter), manifest, sink, stats, batch_size)
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # Embed up to `concurrency` batches at a time, then upsert and checkpoint them together
+            window = [batch for _, batch in zip(range(concurrency), batches)]
+            if not window:
+                break
+            results = executor.map(lambda batch: embed_with_backoff(embeddings, [text for _, _, text in batch]), window)
+            for batch, vectors in zip(window, results):
+                sink.upsert(batch, vectors)
+                manifest.add(batch)
+                stats['embedded'] += len(batch)
+            sink.checkpoint()
+            manifest.commit()
+            logger.info(f'Checkpoint: {stats} ({time.perf_counter() - start_time:.1f}s)')
+
+    sink.finish()
+    manifest.commit()
+    logger.info(f'Finished ingesting {name}: {stats} in {time.perf_counter() - start_time:.1f}s')
+    return stats
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    use_shared_sessions()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='+', help='Parquet files with url and text columns, or directories of them')
+    parser.add_argument('--index', type=str, required=True, choices=[PINECONE_INDEX_NAME_EY, PINECONE_INDEX_NAME_BOARD])
+    parser.add_argument('--backend', type=str, default=VECTOR_BACKEND, choices=['local', 'pinecone'])
+    parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=INGEST_CONCURRENCY)
+    args = parser.parse_args()
+    ingest(args.index, args.paths, args.backend, args.batch_size, args.concurrency)
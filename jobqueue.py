@@ -0,0 +1,349 @@
+"""
+SQLite-backed job queue between the Discord gateway and worker processes.
+
+The gateway submits a job per command and waits for its result. Workers claim jobs with a lease,
+extend it while they run them, and acknowledge them with the result or fail them. A job whose
+worker died is claimed again once its lease expires, and failed jobs are retried with a delay up
+to JOB_MAX_ATTEMPTS times. Errors that another attempt wouldn't fix, like a bad SQL query, fail the
+job right away and are raised again in the gateway. Streamed commands publish their text so far
+as progress, which the gateway edits into the message as it grows. Once a streamed job published
+progress it isn't retried, since another attempt would generate different text than the user saw.
+
+SQLite in WAL mode allows many processes on one machine to share the queue. Workers on other
+nodes need a database file on storage that supports SQLite's locking.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from config import (JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL,
+                    JOB_QUEUE_PATH, JOB_RETENTION, JOB_RETRY_DELAY,
+                    JOB_TIMEOUT)
+from extract import FetchError
+from logger import logger
+from tracing import QUEUE_DEPTH, span
+
+# Errors raised again in the gateway with their type, so handlers can reply to them. They aren't retried
+ERROR_TYPES = {'ValueError': ValueError, 'OperationalError': sqlite3.OperationalError, 'FetchError': FetchError}
+
+
+class JobError(Exception):
+    """
+    Raised in the gateway for a job that failed with another error, timed out or lost its streamed text.
+    """
+
+
+@dataclass
+class Job:
+    id: str
+    command: str
+    payload: Dict[str, Any]
+    status: str  # queued, running, done or failed
+    attempts: int
+    result: Any = None
+    error: Optional[str] = None
+    error_type: Optional[str] = None
+    progress: str = ''
+
+    def raise_error(self):
+        """
+        Raise the job's error, with its original type if the handlers expect it.
+        """
+        raise ERROR_TYPES.get(self.error_type, JobError)(self.error)
+
+
+class JobQueue:
+    """
+    Jobs in a SQLite table, claimed with expiring leases.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, lease: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_delay: float = JOB_RETRY_DELAY):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Autocommit, so that claims can take the write lock up front with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                command TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                progress TEXT NOT NULL DEFAULT '',
+                result TEXT,
+                error TEXT,
+                error_type TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at);
+        """)
+
+    def submit(self, command: str, payload: Dict[str, Any]) -> str:
+        """
+        Queue a job and return its id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT INTO jobs (id, command, payload, status, available_at, created_at, updated_at) '
+                               "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                               (job_id, command, json.dumps(payload), now, now, now))
+        return job_id
+
+    def claim(self, worker: str, commands: List[str] = None) -> Optional[Job]:
+        """
+        Lease the oldest available job, or one whose worker let its lease expire.
+        """
+        now = time.time()
+        where = ("((status = 'queued' AND available_at <= ?) OR (status = 'running' AND lease_until < ?))")
+        params: List[Any] = [now, now]
+        if commands:
+            where += f' AND command IN ({", ".join("?" * len(commands))})'
+            params += commands
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Jobs that took down their worker on every attempt, or already streamed text, aren't tried again
+                self._conn.execute("UPDATE jobs SET status = 'failed', error = 'Worker stopped responding', "
+                                   "error_type = 'WorkerLost', lease_until = NULL, updated_at = ? "
+                                   "WHERE status = 'running' AND lease_until < ? AND (attempts >= ? OR progress != '')",
+                                   (now, now, self.max_attempts))
+                row = self._conn.execute(f'SELECT id, command, payload, status, attempts FROM jobs WHERE {where} '
+                                         'ORDER BY available_at LIMIT 1', params).fetchone()
+                if row is None:
+                    self._conn.execute('COMMIT')
+                    return None
+                job_id, command, payload, status, attempts = row
+                if status == 'running':
+                    logger.info(f'Lease of job {job_id} ({command}) expired, claiming it again')
+                self._conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, "
+                                   'worker = ?, updated_at = ? WHERE id = ?',
+                                   (now + self.lease, worker, now, job_id))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return Job(job_id, command, json.loads(payload), 'running', attempts + 1)
+
+    def _update(self, job: Job, worker: str, sql: str, params: tuple) -> bool:
+        """
+        Update a job only while worker holds its lease. Returns False if the lease was lost.
+        """
+        with self._lock:
+            cursor = self._conn.execute(f"UPDATE jobs SET {sql}, updated_at = ? WHERE id = ? AND worker = ? "
+                                        "AND status = 'running'", (*params, time.time(), job.id, worker))
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job: Job, worker: str) -> bool:
+        """
+        Extend the lease on a running job.
+        """
+        return self._update(job, worker, 'lease_until = ?', (time.time() + self.lease,))
+
+    def progress(self, job: Job, worker: str, text: str) -> bool:
+        """
+        Publish the text a streamed job has produced so far.
+        """
+        return self._update(job, worker, 'progress = ?', (text,))
+
+    def ack(self, job: Job, worker: str, result: Any) -> bool:
+        """
+        Mark a job done with its result.
+        """
+        return self._update(job, worker, "status = 'done', result = ?, lease_until = NULL", (json.dumps(result),))
+
+    def fail(self, job: Job, worker: str, error: BaseException, retry: bool = True) -> bool:
+        """
+        Retry a job after a delay, or fail it for good if it ran out of attempts, the error would recur
+        or retry is False, e.g. since it streamed text already.
+        """
+        error_type = type(error).__name__
+        if not retry or error_type in ERROR_TYPES or job.attempts >= self.max_attempts:
+            return self._update(job, worker, "status = 'failed', error = ?, error_type = ?, lease_until = NULL",
+                                (str(error), error_type))
+        logger.info(f'Job {job.id} ({job.command}) failed on attempt {job.attempts}, retrying: {error!r}')
+        return self._update(job, worker, "status = 'queued', error = ?, error_type = ?, available_at = ?, "
+                                         "lease_until = NULL, progress = ''",
+                            (str(error), error_type, time.time() + self.retry_delay * job.attempts))
+
+    def get(self, job_ids: List[str]) -> Dict[str, Job]:
+        """
+        Current state of jobs by id.
+        """
+        if not job_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute('SELECT id, command, payload, status, attempts, result, error, error_type, '
+                                      f'progress FROM jobs WHERE id IN ({", ".join("?" * len(job_ids))})',
+                                      job_ids).fetchall()
+        return {row[0]: Job(row[0], row[1], json.loads(row[2]), row[3], row[4],
+                            json.loads(row[5]) if row[5] is not None else None, row[6], row[7], row[8])
+                for row in rows}
+
+    def cancel(self, job_id: str):
+        """
+        Drop a job nobody waits for anymore, unless a worker already runs it.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ? AND status = 'queued'", (job_id,))
+
+    def purge(self, retention: float = JOB_RETENTION) -> int:
+        """
+        Delete finished jobs older than retention seconds.
+        """
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                                      (time.time() - retention,)).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Number of jobs by status.
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+class JobWatch:
+    """
+    The gateway's view of a submitted job, updated by the poller.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.job: Optional[Job] = None
+        self.done = asyncio.Event()
+        self.changed = asyncio.Event()
+
+    def update(self, job: Job):
+        progressed = self.job is None or job.progress != self.job.progress
+        self.job = job
+        if job.status in ('done', 'failed'):
+            self.done.set()
+        if progressed or self.done.is_set():
+            self.changed.set()
+
+
+class QueueDispatcher:
+    """
+    Runs commands as jobs on worker processes, with the same interface as Dispatcher.
+
+    One poller task reads the state of all pending jobs every JOB_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, queue: JobQueue = None, poll_interval: float = JOB_POLL_INTERVAL, timeout: float = JOB_TIMEOUT):
+        self.queue = queue or JobQueue()
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._watches: Dict[str, JobWatch] = {}
+        self._poller: Optional[asyncio.Task] = None
+
+    async def _poll(self):
+        while self._watches:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                jobs = await asyncio.to_thread(self.queue.get, list(self._watches))
+            except sqlite3.Error as e:
+                logger.error(f'Polling the job queue failed: {e!r}')
+                continue
+            waiting = {}
+            for job_id, job in jobs.items():
+                if job_id in self._watches:
+                    self._watches[job_id].update(job)
+                    if job.status == 'queued':
+                        waiting[job.command] = waiting.get(job.command, 0) + 1
+            for command in {watch.command for watch in self._watches.values()}:
+                QUEUE_DEPTH.labels(command).set(waiting.get(command, 0))
+
+    async def _submit(self, command: str, func: Callable, args: tuple, kwargs: Dict) -> Tuple[str, JobWatch]:
+        # Command functions are LazyCommands, which name the function for the worker to import
+        payload = {'module': func.module, 'function': func.__name__, 'args': list(args), 'kwargs': kwargs}
+        with span('enqueue'):
+            job_id = await asyncio.to_thread(self.queue.submit, command, payload)
+        watch = self._watches[job_id] = JobWatch(command)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        return job_id, watch
+
+    async def _release(self, job_id: str, watch: JobWatch):
+        self._watches.pop(job_id, None)
+        if not watch.done.is_set():
+            # Awaited, so that the job is dropped before the caller moves on or the loop shuts down
+            await asyncio.to_thread(self.queue.cancel, job_id)
+
+    async def run(self, command: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run func(*args, **kwargs) as a job and await its result.
+        """
+        job_id, watch = await self._submit(command, func, args, kwargs)
+        try:
+            with span('job', job_id=job_id):
+                await asyncio.wait_for(watch.done.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            raise JobError(f'No result after {self.timeout:g}s')
+        finally:
+            await self._release(job_id, watch)
+        if watch.job.status == 'failed':
+            watch.job.raise_error()
+        return watch.job.result
+
+    async def stream(self, command: str, func: Callable, *args, **kwargs) -> AsyncIterator[str]:
+        """
+        Run the async generator func(*args, **kwargs) as a job, yielding its text as the worker publishes it.
+        """
+        job_id, watch = await self._submit(command, func, args, kwargs)
+        sent = ''
+        deadline = time.time() + self.timeout
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(watch.changed.wait(), max(0.0, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    raise JobError(f'No result after {self.timeout:g}s')
+                watch.changed.clear()
+                job = watch.job
+                if job.status == 'failed':
+                    job.raise_error()
+                # Before it is done, a job that was retried before streaming anything has no progress yet
+                text = job.result if job.status == 'done' else job.progress
+                if not isinstance(text, str) or not text.startswith(sent):
+                    raise JobError('The response changed while it was streamed')
+                if len(text) > len(sent):
+                    yield text[len(sent):]
+                    sent = text
+                if job.status == 'done':
+                    return
+        finally:
+            await self._release(job_id, watch)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Jobs this gateway waits for, per command.
+        """
+        counts: Dict[str, Dict[str, int]] = {}
+        for watch in self._watches.values():
+            status = watch.job.status if watch.job is not None else 'queued'
+            counts.setdefault(watch.command, {}).setdefault(status, 0)
+            counts[watch.command][status] += 1
+        return counts
+
+    def shutdown(self, wait: bool = True):
+        if self._poller is not None:
+            self._poller.cancel()
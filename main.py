@@ -2,29 +2,42 @@
 Bot for discord server that utilizes OpenAI's api for commands.
 """
 import argparse
+import asyncio
+import importlib
 import os
+from functools import wraps
 from sqlite3 import OperationalError
+from time import perf_counter
+from typing import AsyncIterator
 
 import interactions
 from dotenv import load_dotenv
 
-from config import DEFAULT_MODEL
+from config import (DEFAULT_MODEL, GATEWAY_WORKERS, WARM_UP,
+                    WARM_UP_MODULES)
+from dispatch import Dispatcher
+from http_client import use_shared_sessions
+from jobqueue import JobError, QueueDispatcher
 from logger import logger
-from qa import qa_board, qa_ey
-from search import search_agent
-from sql import sql_agent, sql_chain
-from summarize import eli5_url, summarize_url
+from output import (footer, send, send_sources, send_text,
+                    stream_to_discord)
+from response_cache import ResponseCache, normalize_url
+from scheduler import Rejected, Scheduler, worker_slots
+from singleflight import SingleFlight, flight_key
+from tracing import register_cache, start_metrics_server, traced_command
+
+START_TIME = perf_counter()
 
 # Parse arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--env', type=str, default='prod')
+parser.add_argument('--mode', type=str, default='standalone', choices=['standalone', 'gateway'],
+                    help='Run commands in this process, or as jobs on worker processes (python worker.py)')
+parser.add_argument('--workers', type=int, default=GATEWAY_WORKERS,
+                    help='Worker processes started next to the gateway, to size its scheduler slots')
 args = parser.parse_args()
 logger.info(f'Arguments: {args.__dict__}')
 
-# Discord arguments
-MAX_INITIAL_MESSAGE_LENGTH = 1900
-MAX_MESSAGE_LENGTH = 2000
-
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
@@ -38,6 +51,74 @@ if args.env == 'dev':
 bot = interactions.Client(TOKEN)
 logger.info(f'Bot initialized: {bot.__dict__}')
 
+# Run blocking chains on a worker pool so the gateway loop stays responsive,
+# or in gateway mode, as jobs on separate worker processes
+dispatcher = QueueDispatcher() if args.mode == 'gateway' else Dispatcher()
+response_cache = ResponseCache()
+register_cache('response', response_cache.stats)
+# Concurrent identical requests share one computation
+flights = SingleFlight()
+# Requests that call a model are charged to their user's quota and wait for a slot.
+# A gateway has a slot for every job its workers can run at once
+scheduler = Scheduler(*worker_slots(args.workers)) if args.mode == 'gateway' else Scheduler()
+
+
+class LazyCommand:
+    """
+    Command resolved from its module on first call. Command modules import LangChain and connect to
+    their backends, so they are imported on first use or by the warm-up, after the bot connects.
+    """
+
+    def __init__(self, module: str, name: str):
+        self.module = module
+        self.__name__ = name
+
+    def __call__(self, *args, **kwargs):
+        # Share one pooled HTTP session across OpenAI, search and page fetches
+        use_shared_sessions()
+        return getattr(importlib.import_module(self.module), self.__name__)(*args, **kwargs)
+
+
+qa_ey = LazyCommand('qa', 'qa_ey')
+qa_board = LazyCommand('qa', 'qa_board')
+search_agent = LazyCommand('search', 'search_agent')
+sql_agent = LazyCommand('sql', 'sql_agent')
+sql_chain = LazyCommand('sql', 'sql_chain')
+astream_summarize_url = LazyCommand('summarize', 'astream_summarize_url')
+astream_eli5_url = LazyCommand('summarize', 'astream_eli5_url')
+
+
+# Import command modules and initialize their backends in parallel
+async def warm_up():
+    """
+    Warm up each module in WARM_UP_MODULES on its own thread. A backend that fails to initialize
+    is logged and retried on first use, and doesn't affect the others.
+    """
+    loop = asyncio.get_running_loop()
+
+    def warm_up_module(name: str):
+        start_time = perf_counter()
+        use_shared_sessions()
+        module = importlib.import_module(name)
+        if hasattr(module, 'warm_up'):
+            module.warm_up()
+        logger.info(f'Warmed up {name} in {perf_counter() - start_time:.2f}s')
+
+    results = await asyncio.gather(*(loop.run_in_executor(None, warm_up_module, name)
+                                     for name in WARM_UP_MODULES), return_exceptions=True)
+    for name, result in zip(WARM_UP_MODULES, results):
+        if isinstance(result, Exception):
+            logger.error(f'Warm-up of {name} failed: {result!r}')
+
+
+@bot.event
+async def on_ready():
+    logger.info(f'Connected to gateway in {perf_counter() - START_TIME:.2f}s since imports')
+    # Gateways don't run commands themselves
+    if WARM_UP and args.mode == 'standalone':
+        asyncio.create_task(warm_up())
+
+
 # Define reusable options
 OPTIONS_TEMPERATURE = interactions.Option(name='temperature', description='Lower values = more focused responses, higher values = more random', required=False,
                                           type=interactions.OptionType.NUMBER, min_value=0.0, max_value=2.0)
@@ -49,131 +130,210 @@ OPTIONS_SHOW_SOURCE = interactions.Option(name='show_source', description='Show
                                           type=interactions.OptionType.BOOLEAN,
                                           choices=[interactions.Choice(name='yes', value=True),
                                                    interactions.Choice(name='no', value=False)])
+OPTIONS_NO_CACHE = interactions.Option(name='no_cache', description='Skip cached responses and run the command again', required=False,
+                                       type=interactions.OptionType.BOOLEAN)
 
 
 @bot.command(name=f'{CMD_PREFIX}hello', description='Says hello without hitting any APIs. Used for health checks.', scope=GUILD_ID)
 async def _hello(ctx: interactions.CommandContext):
-    await ctx.send(f'Hello {ctx.author.mention}! How are you?')
+    await send(ctx, f'Hello {ctx.author.mention}! How are you?')
+
+
+# Charge a request to the user and guild it came from
+def admit(ctx: interactions.CommandContext, command: str, model: str, text: str):
+    """
+    Ticket for a scheduler slot. Raises Rejected if the user or guild is over quota.
+    """
+    guild_id = getattr(ctx, 'guild_id', None)
+    return scheduler.admit(command, model, text, str(ctx.author.id), str(guild_id) if guild_id else None)
+
+
+# Decorator replying to requests the scheduler turned down, and to jobs the workers couldn't finish
+def replies_to_errors(coro):
+    @wraps(coro)
+    async def wrapper(ctx: interactions.CommandContext, *args, **kwargs):
+        try:
+            return await coro(ctx, *args, **kwargs)
+        except Rejected as e:
+            await send(ctx, str(e))
+        except JobError as e:
+            await send(ctx, f'Error: {e}. Please try again.')
+    return wrapper
+
+
+# Run a command through the response cache
+async def run_cached(ctx: interactions.CommandContext, command: str, func, text: str, temperature: float, model: str,
+                     no_cache: bool = False, **kwargs):
+    """
+    Return (result, time, cached), serving from the response cache unless no_cache is set. kwargs are passed to func.
+
+    Cache misses are charged to the user's quota and wait for a scheduler slot. Identical requests that
+    arrive while one is running wait for its result instead of running again, free of charge.
+    """
+    if not no_cache:
+        start_time = perf_counter()
+        result = await asyncio.to_thread(response_cache.get, command, model, temperature, text)
+        if result is not None:
+            logger.info(f'Response cache hit for {command}: {text}')
+            return result, perf_counter() - start_time, True
+
+    key = flight_key(command, model, temperature, text)
+    # Requests that join an identical one in flight share its work and aren't charged for it
+    ticket = None if flights.in_flight(key) else admit(ctx, command, model, text)
+
+    async def compute():
+        async with scheduler.slot(ticket):
+            start_time = perf_counter()
+            result = await dispatcher.run(command, func, text, temperature, model=model, **kwargs)
+            time = perf_counter() - start_time
+        await asyncio.to_thread(response_cache.set, command, model, temperature, text, result)
+        return result, time
+
+    result, time = await flights.run(key, compute)
+    return result, time, False
+
+
+# Stream a command's tokens while holding a scheduler slot
+async def run_stream(ticket, command: str, func, text: str, temperature: float, model: str) -> AsyncIterator[str]:
+    """
+    Yield the tokens of func(text, temperature, model) once the request gets a slot.
+    """
+    async with scheduler.slot(ticket):
+        async for token in dispatcher.stream(command, func, text, temperature, model):
+            yield token
 
 
 @bot.command(name=f'{CMD_PREFIX}summarize', description='Summarizes a URL in bullet points', scope=GUILD_ID,
              options=[interactions.Option(name='url', description='URL to summarize', required=True, type=interactions.OptionType.STRING),
                       OPTIONS_TEMPERATURE, OPTIONS_MODEL])
+@traced_command('summarize')
+@replies_to_errors
 async def _summarize(ctx: interactions.CommandContext, url: str, temperature: float = None, model: str = DEFAULT_MODEL):
     logger.info(f'Summarize: {url}, Temp: {temperature}, Model: {model}')
     await ctx.defer()
-    summary, time = summarize_url(url, temperature, model)
-    summary += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-    await ctx.send(f'Here is the summary of {url}:\n\n{summary[:MAX_INITIAL_MESSAGE_LENGTH]}')
-    for i in range(MAX_INITIAL_MESSAGE_LENGTH, len(summary), MAX_MESSAGE_LENGTH):
-        await ctx.send(f'{summary[i:i+MAX_MESSAGE_LENGTH]}')
+    key = flight_key('summarize', model, temperature, url, normalize_url)
+    ticket = None if flights.in_flight(key) else admit(ctx, 'summarize', model, url)
+    tokens = flights.stream(key, run_stream, ticket, 'summarize', astream_summarize_url, url, temperature, model)
+    try:
+        await stream_to_discord(ctx, f'Here is the summary of {url}:\n\n', tokens, temperature, model)
+    except ValueError as e:
+        await send(ctx, f'Error: {e}. Please try again.')
 
 
 @ bot.command(name=f'{CMD_PREFIX}eli5', description='Explains a URL to a five-year old', scope=GUILD_ID,
               options=[interactions.Option(name='url', description='URL to explain', required=True, type=interactions.OptionType.STRING),
                        OPTIONS_TEMPERATURE, OPTIONS_MODEL])
+@traced_command('eli5')
+@replies_to_errors
 async def _eli5(ctx: interactions.CommandContext, url: str, temperature: float = None, model: str = DEFAULT_MODEL):
     logger.info(f'ELI5: {url}, Temp: {temperature}, Model: {model}')
     await ctx.defer()
-    explanation, time = eli5_url(url, temperature, model)
-    explanation += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-    await ctx.send(f'Here is the explanation of {url}:\n\n{explanation[:MAX_INITIAL_MESSAGE_LENGTH]}')
-    for i in range(MAX_INITIAL_MESSAGE_LENGTH, len(explanation), MAX_MESSAGE_LENGTH):
-        await ctx.send(f'{explanation[i:i+MAX_MESSAGE_LENGTH]}')
+    key = flight_key('eli5', model, temperature, url, normalize_url)
+    ticket = None if flights.in_flight(key) else admit(ctx, 'eli5', model, url)
+    tokens = flights.stream(key, run_stream, ticket, 'eli5', astream_eli5_url, url, temperature, model)
+    try:
+        await stream_to_discord(ctx, f'Here is the explanation of {url}:\n\n', tokens, temperature, model)
+    except ValueError as e:
+        await send(ctx, f'Error: {e}. Please try again.')
 
 
 @bot.command(name=f'{CMD_PREFIX}search', description='Searches the internet for a query', scope=GUILD_ID,
              options=[interactions.Option(name='query', description='Query to search for', required=True, type=interactions.OptionType.STRING),
-                      OPTIONS_TEMPERATURE, OPTIONS_MODEL])
-async def _search_agent(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL):
+                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_NO_CACHE])
+@traced_command('search')
+@replies_to_errors
+async def _search_agent(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL, no_cache: bool = False):
     logger.info(f'Search: {query}, Temp: {temperature}, Model: {model}')
     await ctx.defer()
     try:
-        result, time = search_agent(query, temperature, model)
-        result += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-        await ctx.send(f'{result[:MAX_INITIAL_MESSAGE_LENGTH]}')
-        for i in range(MAX_INITIAL_MESSAGE_LENGTH, len(result), MAX_MESSAGE_LENGTH):
-            await ctx.send(f'{result[i:i+MAX_MESSAGE_LENGTH]}')
+        result, time, cached = await run_cached(ctx, 'search', search_agent, query, temperature, model, no_cache)
+        result += footer(temperature, model, time, cached)
+        await send_text(ctx, result, preview_marker='**Output:**')
     except ValueError as e:
-        await ctx.send(f'Error: {e}. Please try again.')
+        await send(ctx, f'Error: {e}. Please try again.')
 
 
 @bot.command(name=f'{CMD_PREFIX}table', description='Describes the books table.', scope=GUILD_ID)
 async def _table(ctx: interactions.CommandContext):
-    await ctx.send(f'The books table has the following columns: id, title, author, language, average rating, ratings count, and text reviews count.')
+    await send(ctx, f'The books table has the following columns: id, title, author, language, average rating, ratings count, and text reviews count.')
 
 
 @bot.command(name=f'{CMD_PREFIX}sql', description='Queries a database', scope=GUILD_ID,
              options=[interactions.Option(name='query', description='Query to search for', required=True, type=interactions.OptionType.STRING),
-                      OPTIONS_TEMPERATURE, OPTIONS_MODEL])
-async def _sql_chain(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL):
+                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_NO_CACHE])
+@traced_command('sql')
+@replies_to_errors
+async def _sql_chain(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL, no_cache: bool = False):
     logger.info(f'SQL-chain: {query}, Temp: {temperature}, Model: {model}')
     await ctx.defer()
     try:
-        result, time = sql_chain(query, temperature, model)
-        result += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-        await ctx.send(f'{result[:MAX_INITIAL_MESSAGE_LENGTH]}')
-        for i in range(MAX_INITIAL_MESSAGE_LENGTH, len(result), MAX_MESSAGE_LENGTH):
-            await ctx.send(f'{result[i:i+MAX_MESSAGE_LENGTH]}')
+        result, time, cached = await run_cached(ctx, 'sql', sql_chain, query, temperature, model, no_cache,
+                                                 use_cache=not no_cache)
+        result += footer(temperature, model, time, cached)
+        await send_text(ctx, result, preview_marker='**Output:**')
     except OperationalError as e:
-        await ctx.send(f'Error: {e}. Please try again.')
+        await send(ctx, f'Error: {e}. Please try again.')
 
 
 @bot.command(name=f'{CMD_PREFIX}sql-agent', description='Queries a database', scope=GUILD_ID,
              options=[interactions.Option(name='query', description='Query to search for', required=True, type=interactions.OptionType.STRING),
-                      OPTIONS_TEMPERATURE, OPTIONS_MODEL])
-async def _sql_agent(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL):
+                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_NO_CACHE])
+@traced_command('sql-agent')
+@replies_to_errors
+async def _sql_agent(ctx: interactions.CommandContext, query: str, temperature: float = None, model: str = DEFAULT_MODEL, no_cache: bool = False):
     logger.info(f'SQL-agent: {query}, Temp: {temperature}, Model: {model}')
     await ctx.defer()
     try:
-        result, time = sql_agent(query, temperature, model)
-        result += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-        await ctx.send(f'{result[:MAX_INITIAL_MESSAGE_LENGTH]}')
-        for i in range(MAX_INITIAL_MESSAGE_LENGTH, len(result), MAX_MESSAGE_LENGTH):
-            await ctx.send(f'{result[i:i+MAX_MESSAGE_LENGTH]}')
+        result, time, cached = await run_cached(ctx, 'sql-agent', sql_agent, query, temperature, model, no_cache,
+                                                 use_cache=not no_cache)
+        result += footer(temperature, model, time, cached)
+        await send_text(ctx, result, preview_marker='**Output:**')
     except ValueError as e:
-        await ctx.send(f'Error: {e}. Please try again.')
+        await send(ctx, f'Error: {e}. Please try again.')
 
 
 @bot.command(name=f'{CMD_PREFIX}ask-ey', description='Asks eugeneyan.com a question', scope=GUILD_ID,
              options=[interactions.Option(name='question', description='Question to ask', required=True, type=interactions.OptionType.STRING),
-                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_SHOW_SOURCE])
-async def _ask_ey(ctx: interactions.CommandContext, question: str, temperature: float = None, model: str = DEFAULT_MODEL, show_source: bool = False):
+                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_SHOW_SOURCE, OPTIONS_NO_CACHE])
+@traced_command('ask-ey')
+@replies_to_errors
+async def _ask_ey(ctx: interactions.CommandContext, question: str, temperature: float = None, model: str = DEFAULT_MODEL, show_source: bool = False, no_cache: bool = False):
     logger.info(
         f'Ask ey: {question}, Temp: {temperature}, Model: {model}, Show source: {show_source}')
     await ctx.defer()
     # The first element is the answer, the rest are sources
-    result_list, time = qa_ey(question, temperature, model)
+    result_list, time, cached = await run_cached(ctx, 'ask-ey', qa_ey, question, temperature, model, no_cache)
 
     result = result_list[0]
-    result += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-    await ctx.send(f'{result[:MAX_MESSAGE_LENGTH]}')
+    result += footer(temperature, model, time, cached)
+    await send_text(ctx, result)
 
     if show_source:
-        # Send sources as individual messages
-        for source in result_list[1:]:
-            await ctx.send(f'{source[:MAX_MESSAGE_LENGTH]}')
+        # Send sources as embeds, several per message
+        await send_sources(ctx, result_list[1:])
 
 
 @bot.command(name=f'{CMD_PREFIX}board', description='Asks board of advisors a question', scope=GUILD_ID,
              options=[interactions.Option(name='question', description='Question to ask', required=True, type=interactions.OptionType.STRING),
-                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_SHOW_SOURCE])
-async def _ask_board(ctx: interactions.CommandContext, question: str, temperature: float = None, model: str = DEFAULT_MODEL, show_source: bool = False):
+                      OPTIONS_TEMPERATURE, OPTIONS_MODEL, OPTIONS_SHOW_SOURCE, OPTIONS_NO_CACHE])
+@traced_command('board')
+@replies_to_errors
+async def _ask_board(ctx: interactions.CommandContext, question: str, temperature: float = None, model: str = DEFAULT_MODEL, show_source: bool = False, no_cache: bool = False):
     logger.info(
         f'Ask board: {question}, Temp: {temperature}, Model: {model}, Show source: {show_source}')
     await ctx.defer()
     # The first element is the answer, the rest are sources
-    result_list, time = qa_board(question, temperature, model)
+    result_list, time, cached = await run_cached(ctx, 'board', qa_board, question, temperature, model, no_cache)
 
     result = result_list[0]
-    result += f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s`'
-    await ctx.send(f'{result[:MAX_MESSAGE_LENGTH]}')
+    result += footer(temperature, model, time, cached)
+    await send_text(ctx, result)
 
     if show_source:
-        # Send sources as individual messages
-        for source in result_list[1:]:
-            await ctx.send(f'{source[:MAX_MESSAGE_LENGTH]}')
+        # Send sources as embeds, several per message
+        await send_sources(ctx, result_list[1:])
 
 
 if __name__ == '__main__':
+    start_metrics_server()
     bot.start()
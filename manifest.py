@@ -0,0 +1,68 @@
+"""
+Manifest of the chunks embedded into an index, written by ingest.py.
+
+Besides driving incremental ingestion, it keeps the text of each chunk, so that keyword search
+also works over indices whose texts are only held remotely, like the Pinecone ones.
+"""
+import os
+import sqlite3
+import time
+from typing import List, Tuple
+
+from config import LOCAL_INDEX_DIR
+
+# A chunk is (id, source url, text)
+Chunk = Tuple[str, str, str]
+
+
+# Locate the manifest of an index
+def manifest_path(name: str, backend: str) -> str:
+    """
+    Path of the manifest of index name on backend.
+    """
+    return os.path.join(LOCAL_INDEX_DIR, f'{name}.{backend}.manifest.db')
+
+
+class Manifest:
+    """
+    Record of the chunks already embedded into an index, used for deltas and checkpointing.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, source TEXT NOT NULL, '
+                           "embedded_at REAL NOT NULL, text TEXT NOT NULL DEFAULT '')")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source)')
+        # Manifests written before texts were kept get them filled in as their chunks are seen again
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(chunks)')}
+        if 'text' not in columns:
+            self._conn.execute("ALTER TABLE chunks ADD COLUMN text TEXT NOT NULL DEFAULT ''")
+
+    def ids_for_source(self, source: str) -> set:
+        return {row[0] for row in self._conn.execute('SELECT id FROM chunks WHERE source = ?', (source,))}
+
+    def add(self, chunks: List[Chunk]):
+        now = time.time()
+        self._conn.executemany('INSERT OR REPLACE INTO chunks (id, source, embedded_at, text) VALUES (?, ?, ?, ?)',
+                               [(id_, source, now, text) for id_, source, text in chunks])
+
+    def fill_texts(self, chunks: List[Chunk]):
+        self._conn.executemany("UPDATE chunks SET text = ? WHERE id = ? AND text = ''",
+                               [(text, id_) for id_, _, text in chunks])
+
+    def remove(self, ids: List[str]):
+        self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(id_,) for id_ in ids])
+
+    def commit(self):
+        self._conn.commit()
+
+    def documents(self) -> Tuple[List[str], List[dict]]:
+        """
+        Texts of the embedded chunks and their metadata, in the form the vector stores return them.
+        """
+        texts, metadatas = [], []
+        for source, text in self._conn.execute("SELECT source, text FROM chunks WHERE text != '' ORDER BY rowid"):
+            texts.append(text)
+            metadatas.append({'source': source})
+        return texts, metadatas
@@ -0,0 +1,253 @@
+"""
+Sending responses to Discord.
+
+Long text is split on paragraph, line and sentence boundaries, and code blocks cut in two are
+closed and reopened. Text longer than OUTPUT_FILE_THRESHOLD is attached as a file with a preview.
+Q&A sources are sent as embeds, several per message.
+
+Discord limits how many messages a channel's webhook can send or edit in a short time. Sends
+and edits are paced with a token bucket per channel, so a burst of messages is spread out
+before it runs into 429 responses.
+"""
+import asyncio
+import io
+import re
+from time import monotonic, perf_counter
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import interactions
+
+from config import (OUTPUT_FILE_THRESHOLD, OUTPUT_SEND_BURST,
+                    OUTPUT_SEND_PERIOD, OUTPUT_SOURCE_CHARS)
+from logger import logger
+from tracing import record, span
+from utils import remove_empty_lines
+
+# Discord limits
+MAX_INITIAL_MESSAGE_LENGTH = 1900
+MAX_MESSAGE_LENGTH = 2000
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+MAX_EMBED_TITLE_LENGTH = 256
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between edits of a streamed message, to stay within rate limits
+
+FENCE = '```'
+# Preferred places to split a message, best first
+BREAKS = ('\n\n', '\n', '. ', ' ')
+SOURCE_PATTERN = re.compile(r'\*\*Source:\*\* (.*)\n\n\*\*URL:\*\* (.*)', re.DOTALL)
+WRAPPED_URL_PATTERN = re.compile(r'<(https?://\S+?)>')
+
+
+class Pacer:
+    """
+    Token bucket per channel: burst sends right away, then one every period / burst seconds.
+    """
+
+    def __init__(self, burst: int = OUTPUT_SEND_BURST, period: float = OUTPUT_SEND_PERIOD):
+        self.burst = burst
+        self.rate = burst / period
+        self.waits = 0
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # Channel -> (tokens, time of last update)
+
+    def delay(self, key: str) -> float:
+        """
+        Take a token for key and return how long to wait for it.
+        """
+        now = monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        # Tokens go negative while sends are queued, so later sends wait behind earlier ones
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > 1000:
+            self._buckets = {k: v for k, v in self._buckets.items() if v[0] + (now - v[1]) * self.rate < self.burst}
+        return max(0.0, -tokens / self.rate)
+
+    async def wait(self, key: str):
+        """
+        Wait until a message can be sent or edited in channel key.
+        """
+        delay = self.delay(key)
+        if delay > 0:
+            self.waits += 1
+            record('discord.wait', delay)
+            await asyncio.sleep(delay)
+
+
+PACER = Pacer()
+
+
+# Send a message, paced and timed as a stage of the request
+async def send(ctx: interactions.CommandContext, content: str = None, **kwargs) -> interactions.Message:
+    """
+    Send content to the channel of ctx. kwargs, like embeds or files, are passed to ctx.send.
+    """
+    await PACER.wait(str(getattr(ctx, 'channel_id', '')))
+    with span('discord.send', chars=len(content or '')):
+        if content is None:
+            return await ctx.send(**kwargs)
+        return await ctx.send(content, **kwargs)
+
+
+# Edit a sent message, paced and timed as a stage of the request
+async def edit(message: interactions.Message, content: str):
+    """
+    Replace the content of message.
+    """
+    await PACER.wait(str(getattr(message, 'channel_id', '')))
+    with span('discord.edit', chars=len(content)):
+        await message.edit(content=content)
+
+
+# Footer appended to every response
+def footer(temperature: float, model: str, time: float, cached: bool = False) -> str:
+    """
+    Footer with the request parameters and latency.
+    """
+    cached_str = ', Cached' if cached else ''
+    return f'\n\n `Temp: {temperature}, Model: {model}, Time: {time:.2f}s{cached_str}`'
+
+
+# Find the code block left open at the end of text
+def open_fence(text: str) -> str:
+    """
+    Opening line of an unclosed ``` block, e.g. "```sql", or an empty string. A line that opens and closes
+    a block, e.g. "```x = 1```", leaves it as it was.
+    """
+    opened = ''
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(FENCE) and FENCE not in stripped[len(FENCE):]:
+            opened = '' if opened else stripped
+    return opened
+
+
+# Find where to end a chunk of text
+def find_break(text: str, limit: int) -> int:
+    """
+    Position after the last paragraph, line, sentence or word break within limit, or limit if there is none
+    in its second half.
+    """
+    for separator in BREAKS:
+        i = text.rfind(separator, 0, limit)
+        if i > limit // 2:
+            return i + len(separator)
+    return limit
+
+
+# Split text into the chunks that fit into discord messages
+def split_message(text: str, first_limit: int = MAX_INITIAL_MESSAGE_LENGTH,
+                  limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split text into a first chunk of at most first_limit and the rest in chunks of at most limit characters.
+
+    Chunks end on the best break available, and a code block cut in two is closed and reopened.
+    Chunks only depend on the text up to them, so they don't change as streamed text grows.
+    """
+    chunks, reopen = [], ''
+    while True:
+        budget = (limit if chunks else first_limit) - len(reopen)
+        if len(text) <= budget:
+            chunks.append(reopen + text)
+            return chunks
+        # Leave room to close a code block
+        cut = find_break(text, budget - len(FENCE) - 1)
+        chunk = reopen + text[:cut].rstrip()
+        text = text[cut:].lstrip()
+        opened = open_fence(chunk)
+        if opened:
+            chunk += f'\n{FENCE}'
+        chunks.append(chunk)
+        reopen = f'{opened}\n' if opened else ''
+        if not text:
+            return chunks
+
+
+# Send text as one or more messages, or as a file if it is very long
+async def send_text(ctx: interactions.CommandContext, text: str,
+                    preview_marker: Optional[str] = None) -> List[interactions.Message]:
+    """
+    Send text split into messages. Text longer than OUTPUT_FILE_THRESHOLD is attached as a markdown file
+    with a one-message preview, which starts at the last preview_marker if given, e.g. an agent's output.
+    """
+    if len(text) <= OUTPUT_FILE_THRESHOLD:
+        return [await send(ctx, chunk) for chunk in split_message(text)]
+
+    start = text.rfind(preview_marker) if preview_marker else -1
+    note = f'\n\n_Full response ({len(text)} characters) attached._'
+    preview = split_message(text[max(start, 0):], MAX_INITIAL_MESSAGE_LENGTH - len(note))[0]
+    logger.info(f'Sending {len(text)} characters as a file')
+    file = interactions.File(filename='response.md', fp=io.StringIO(text))
+    return [await send(ctx, preview + note, files=file)]
+
+
+# Truncate text to a length, marking the cut
+def truncate(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length - 1].rstrip() + '…'
+
+
+# Send Q&A sources as embeds
+async def send_sources(ctx: interactions.CommandContext, sources: List[str]) -> List[interactions.Message]:
+    """
+    Send sources formatted by prettify_qa_response as embeds, packed into as few messages as Discord allows.
+    """
+    embeds, unparsed = [], []
+    for source in sources:
+        match = SOURCE_PATTERN.fullmatch(source)
+        if match is None:
+            unparsed.append(source)
+            continue
+        # Urls were wrapped in <> to keep Discord from previewing them, which embeds don't do
+        content, url = (WRAPPED_URL_PATTERN.sub(r'\1', group.strip()) for group in match.groups())
+        embeds.append(interactions.Embed(title=truncate(url, MAX_EMBED_TITLE_LENGTH),
+                                         url=url if url.startswith('http') else None,
+                                         description=truncate(content, OUTPUT_SOURCE_CHARS)))
+
+    messages, batch, batch_chars = [], [], 0
+    for embed in embeds:
+        chars = len(embed.title) + len(embed.description)
+        if batch and (len(batch) == MAX_EMBEDS_PER_MESSAGE or batch_chars + chars > MAX_EMBED_CHARS_PER_MESSAGE):
+            messages.append(await send(ctx, embeds=batch))
+            batch, batch_chars = [], 0
+        batch.append(embed)
+        batch_chars += chars
+    if batch:
+        messages.append(await send(ctx, embeds=batch))
+    if unparsed:
+        messages += await send_text(ctx, '\n\n'.join(unparsed))
+    return messages
+
+
+# Stream tokens into a discord message that is edited in place
+async def stream_to_discord(ctx: interactions.CommandContext, header: str, tokens: AsyncIterator[str],
+                            temperature: float, model: str) -> str:
+    """
+    Edit streamed tokens into a message, rolling over into follow-up messages when it is full.
+    """
+    start_time = perf_counter()
+    messages, sent_chunks = [], []
+    body = ''
+
+    async def flush(text: str):
+        for i, chunk in enumerate(split_message(text)):
+            if i < len(messages):
+                if chunk != sent_chunks[i]:
+                    await edit(messages[i], chunk)
+                    sent_chunks[i] = chunk
+            else:
+                messages.append(await send(ctx, chunk))
+                sent_chunks.append(chunk)
+
+    last_flush = 0.0
+    async for token in tokens:
+        if not body:
+            logger.info(f'Time to first token: {perf_counter() - start_time:.2f}s')
+        body += token
+        if perf_counter() - last_flush >= STREAM_EDIT_INTERVAL:
+            await flush(f'{header}{remove_empty_lines(body)}')
+            last_flush = perf_counter()
+
+    time = perf_counter() - start_time
+    body = remove_empty_lines(body)
+    body += footer(temperature, model, time)
+    await flush(f'{header}{body}')
+    return body
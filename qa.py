@@ -2,51 +2,111 @@
 Module for Q&A on a vector index
 """
 import os
+import threading
+from functools import partial
+from time import perf_counter
+from typing import List, Tuple
 
 import pinecone
 from dotenv import load_dotenv
 from langchain.chains import RetrievalQAWithSourcesChain
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import Pinecone
-
-from config import (EMBEDDING_MODEL, PINECONE_ENV, PINECONE_INDEX_NAME_BOARD,
-                    PINECONE_INDEX_NAME_EY, QA_MODEL)
+from langchain.vectorstores.base import VectorStore
+
+from chains import CHAINS
+from config import (EMBEDDING_MODEL, LOCAL_INDEX_DIR,
+                    PINECONE_API_KEY_ENV_DICT, PINECONE_ENV,
+                    PINECONE_INDEX_NAME_BOARD, PINECONE_INDEX_NAME_EY,
+                    QA_MODEL, VECTOR_BACKEND)
+from context_packer import PackedRetriever
+from embedding_cache import cached_embeddings
 from logger import logger
-from utils import prettify_qa_response, timer
+from manifest import Manifest, manifest_path
+from retrieval import RetrievalEngine
+from tracing import get_llm_callback
+from utils import prettify_qa_response
+from vectorstore import LocalVectorStore
 
 # Load env variables
 load_dotenv()
 
-# Initialize embeddings
-embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
-
-# Initialize Pinecone index for ask-ey
-pinecone.init(api_key=os.getenv('PINECONE_API_KEY_EY'),
-              environment=PINECONE_ENV)
-index = pinecone.Index(PINECONE_INDEX_NAME_EY)
-logger.info(
-    f'Stats for {PINECONE_INDEX_NAME_EY}: {index.describe_index_stats()}')
-store_ey = Pinecone.from_existing_index(
-    index_name=PINECONE_INDEX_NAME_EY, embedding=embeddings)
-
-# Initialize Pinecone index for board
-pinecone.init(api_key=os.getenv('PINECONE_API_KEY_BOARD'),
-              environment=PINECONE_ENV)
-index = pinecone.Index(PINECONE_INDEX_NAME_BOARD)
-logger.info(
-    f'Stats for {PINECONE_INDEX_NAME_BOARD}: {index.describe_index_stats()}')
-store_board = Pinecone.from_existing_index(
-    index_name=PINECONE_INDEX_NAME_BOARD, embedding=embeddings)
-
-
-@timer
-def qa_ey(question: str, temperature: float = None, model: str = QA_MODEL) -> str:
-
-    llm = ChatOpenAI(temperature=temperature, model_name=model)
-    chain = RetrievalQAWithSourcesChain.from_chain_type(llm, chain_type='stuff',
-                                                        retriever=store_ey.as_retriever(),
-                                                        return_source_documents=True)
+# pinecone.init sets process-wide credentials and each index has its own API key, so loads are serialized
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+# Load an index on first use
+def get_store(name: str) -> VectorStore:
+    """
+    Load the vector store for an index from disk or connect to it on Pinecone, once.
+    """
+    with _stores_lock:
+        if name not in _stores:
+            start_time = perf_counter()
+            # Embeddings are cached so that repeated questions skip the embedding call
+            embeddings = cached_embeddings(EMBEDDING_MODEL)
+            if VECTOR_BACKEND == 'local':
+                _stores[name] = LocalVectorStore.load(os.path.join(LOCAL_INDEX_DIR, name), embeddings)
+            else:
+                pinecone.init(api_key=os.getenv(PINECONE_API_KEY_ENV_DICT[name]), environment=PINECONE_ENV)
+                _stores[name] = Pinecone.from_existing_index(index_name=name, embedding=embeddings)
+            logger.info(f'Loaded {name} index ({VECTOR_BACKEND}) in {perf_counter() - start_time:.2f}s')
+        return _stores[name]
+
+
+# Load the chunk texts of a Pinecone index for keyword search
+def get_corpus(name: str) -> Tuple[List[str], List[dict]]:
+    """
+    Texts and metadatas of the chunks ingested into name, from its manifest, or nothing if there is none.
+    """
+    path = manifest_path(name, VECTOR_BACKEND)
+    if not os.path.exists(path):
+        logger.info(f'No manifest for {name} at {path}')
+        return [], []
+    return Manifest(path).documents()
+
+
+# Register indices with the retrieval engine, loaded on first use
+ENGINE = RetrievalEngine()
+ENGINE.register_loader(PINECONE_INDEX_NAME_EY, partial(get_store, PINECONE_INDEX_NAME_EY))
+ENGINE.register_loader(PINECONE_INDEX_NAME_BOARD, partial(get_store, PINECONE_INDEX_NAME_BOARD))
+# Pinecone doesn't return a whole index's texts, so keyword search runs over the chunks ingest.py recorded
+if VECTOR_BACKEND != 'local':
+    ENGINE.register_corpus(PINECONE_INDEX_NAME_EY, partial(get_corpus, PINECONE_INDEX_NAME_EY))
+    ENGINE.register_corpus(PINECONE_INDEX_NAME_BOARD, partial(get_corpus, PINECONE_INDEX_NAME_BOARD))
+
+
+# Load the indices ahead of the first question
+def warm_up():
+    """
+    Load both indices.
+    """
+    for name in (PINECONE_INDEX_NAME_EY, PINECONE_INDEX_NAME_BOARD):
+        store = ENGINE.store(name)
+        if VECTOR_BACKEND != 'local':
+            logger.info(f'Stats for {name}: {store._index.describe_index_stats()}')
+
+
+# Build the Q&A chain over one or more indices
+@CHAINS.register('qa')
+def build_qa_chain(model: str, temperature: float, index_names: Tuple[str, ...]) -> RetrievalQAWithSourcesChain:
+    """
+    Create a retrieval Q&A chain that packs retrieved chunks into the model's context.
+    """
+    llm = ChatOpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()])
+    retriever = PackedRetriever(engine=ENGINE, index_names=list(index_names), model=model)
+    return RetrievalQAWithSourcesChain.from_chain_type(llm, chain_type='stuff',
+                                                       retriever=retriever,
+                                                       return_source_documents=True)
+
+
+# Q&A over one or more indices
+def qa(question: str, index_names: List[str], temperature: float = None, model: str = QA_MODEL) -> list:
+    """
+    Answers a question from the given indices. The first element is the answer, the rest are sources.
+    """
+    chain = CHAINS.get('qa', model, temperature, tuple(index_names))
 
     response = chain({'question': question})
     pretty_response = prettify_qa_response(response)
@@ -54,15 +114,9 @@ def qa_ey(question: str, temperature: float = None, model: str = QA_MODEL) -> st
     return pretty_response
 
 
-@timer
-def qa_board(question: str, temperature: float = None, model: str = QA_MODEL) -> str:
+def qa_ey(question: str, temperature: float = None, model: str = QA_MODEL) -> list:
+    return qa(question, [PINECONE_INDEX_NAME_EY], temperature, model)
 
-    llm = ChatOpenAI(temperature=temperature, model_name=model)
-    chain = RetrievalQAWithSourcesChain.from_chain_type(llm, chain_type='stuff',
-                                                        retriever=store_board.as_retriever(),
-                                                        return_source_documents=True)
 
-    response = chain({'question': question})
-    pretty_response = prettify_qa_response(response)
-
-    return pretty_response
+def qa_board(question: str, temperature: float = None, model: str = QA_MODEL) -> list:
+    return qa(question, [PINECONE_INDEX_NAME_BOARD], temperature, model)
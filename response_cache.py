@@ -0,0 +1,196 @@
+"""
+Cache of command responses, keyed on (command, model, temperature, normalized input).
+
+Commands can optionally fall back to an embedding-similarity lookup when there is no exact match.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+
+from config import (EMBEDDING_MODEL, RESPONSE_CACHE_PATH,
+                    RESPONSE_CACHE_SEMANTIC_COMMANDS,
+                    RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+                    RESPONSE_CACHE_TTL_DICT)
+from logger import logger
+
+# Query parameters that only track clicks and never change the page
+TRACKING_PARAMS = {'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid', 'gclid', 'ref'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+# Normalize input so that trivially different questions share a cache entry
+def normalize_input(text: str) -> str:
+    """
+    Lowercase, collapse whitespace, and strip trailing punctuation.
+    """
+    text = re.sub(r'\s+', ' ', text.strip().lower())
+    return text.rstrip('?!. ')
+
+
+# Normalize url so that trivially different links share a cache entry
+def normalize_url(url: str) -> str:
+    """
+    Lowercase scheme and host, drop default ports, fragments and tracking params, and sort the query.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    path = parts.path or '/'
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                             if k.lower() not in TRACKING_PARAMS))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+# Format temperature so that e.g. 0 and 0.0 share a cache entry
+def format_temperature(temperature: Optional[float]) -> str:
+    """
+    Format temperature as a fixed-precision string, or 'default' if unset.
+    """
+    return 'default' if temperature is None else f'{float(temperature):.2f}'
+
+
+# Build the exact-match cache key
+def cache_key(command: str, model: str, temperature: Optional[float], text: str) -> str:
+    """
+    Hash of command, model, temperature and normalized input.
+    """
+    raw = json.dumps([command, model, format_temperature(temperature), normalize_input(text)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with per-command TTLs and optional semantic lookup.
+
+    Commands without a TTL in ttl_dict are never cached.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl_dict: Dict[str, float] = None,
+                 semantic_commands: List[str] = None, threshold: float = RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+                 embed_fn: Callable[[str], List[float]] = None):
+        self.ttl_dict = RESPONSE_CACHE_TTL_DICT if ttl_dict is None else ttl_dict
+        self.semantic_commands = set(RESPONSE_CACHE_SEMANTIC_COMMANDS if semantic_commands is None else semantic_commands)
+        self.threshold = threshold
+        self._embed_fn = embed_fn
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                command TEXT NOT NULL,
+                model TEXT NOT NULL,
+                temperature TEXT NOT NULL,
+                input TEXT NOT NULL,
+                value TEXT NOT NULL,
+                embedding BLOB,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_scope ON responses(command, model, temperature);
+        """)
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Embed text as a unit-length float32 vector.
+
+        The question is embedded as is, like retrieval embeds it, so that a miss reuses the embedding cache entry.
+        """
+        if self._embed_fn is None:
+            # Imported here since it pulls in LangChain, which would slow down startup
+            from embedding_cache import cached_embeddings
+            self._embed_fn = cached_embeddings(EMBEDDING_MODEL).embed_query
+        vector = np.asarray(self._embed_fn(text), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get(self, command: str, model: str, temperature: Optional[float], text: str) -> Optional[Any]:
+        """
+        Get a cached response, trying an exact match before a semantic one.
+        """
+        if command not in self.ttl_dict:
+            return None
+        min_created_at = time.time() - self.ttl_dict[command]
+
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM responses WHERE key = ? AND created_at >= ?',
+                                     (cache_key(command, model, temperature, text), min_created_at)).fetchone()
+        if row is not None:
+            self.hits += 1
+            return json.loads(row[0])
+
+        if command in self.semantic_commands:
+            value = self._get_similar(command, model, temperature, text, min_created_at)
+            if value is not None:
+                self.semantic_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def _get_similar(self, command: str, model: str, temperature: Optional[float], text: str, min_created_at: float):
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT input, value, embedding FROM responses
+                WHERE command = ? AND model = ? AND temperature = ? AND created_at >= ? AND embedding IS NOT NULL
+            """, (command, model, format_temperature(temperature), min_created_at)).fetchall()
+        if not rows:
+            return None
+
+        try:
+            query = self.embed(text)
+        except Exception as e:
+            logger.info(f'Skipping semantic cache lookup: {e}')
+            return None
+
+        matrix = np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        logger.info(f'Semantic cache hit for "{text}": "{rows[best][0]}" ({scores[best]:.3f})')
+        return json.loads(rows[best][1])
+
+    def set(self, command: str, model: str, temperature: Optional[float], text: str, value: Any):
+        """
+        Store a response if the command is cacheable.
+        """
+        if command not in self.ttl_dict:
+            return
+
+        embedding = None
+        if command in self.semantic_commands:
+            try:
+                embedding = self.embed(text).tobytes()
+            except Exception as e:
+                logger.info(f'Caching without embedding: {e}')
+
+        with self._lock:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO responses (key, command, model, temperature, input, value, embedding, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (cache_key(command, model, temperature, text), command, model,
+                  format_temperature(temperature),
+                  normalize_input(text), json.dumps(value), embedding, time.time()))
+            self._conn.execute('DELETE FROM responses WHERE command = ? AND created_at < ?',
+                               (command, time.time() - self.ttl_dict[command]))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Exact hit, semantic hit and miss counters.
+        """
+        return {'hits': self.hits, 'semantic_hits': self.semantic_hits, 'misses': self.misses}
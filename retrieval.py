@@ -0,0 +1,220 @@
+"""
+Retrieval over one or more registered indices, fusing vector and BM25 keyword results.
+
+Each index contributes a vector-similarity ranking and, when its texts are available, a BM25 ranking:
+local stores hold their texts, and other stores can register a loader for them, e.g. from the ingest
+manifest. The rankings are merged with reciprocal-rank fusion (RRF), then MMR picks the top k while
+skipping near-duplicate chunks.
+"""
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
+
+from config import (MMR_DUPLICATE_THRESHOLD, MMR_LAMBDA, RETRIEVAL_FETCH_K,
+                    RETRIEVAL_HYBRID, RETRIEVAL_TOP_K, RRF_K)
+from logger import logger
+from tracing import span
+from vectorstore import LocalVectorStore
+
+TOKEN_PATTERN = re.compile(r'\w+')
+STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'for', 'from', 'how', 'i', 'in', 'is', 'it',
+             'of', 'on', 'or', 'should', 'that', 'the', 'to', 'was', 'what', 'when', 'where', 'which', 'who',
+             'why', 'with', 'you'}
+
+
+# Tokenize text for keyword search
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens without stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    In-memory inverted index scored with Okapi BM25.
+    """
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths = []
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.doc_lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings[token].append((row, tf))
+        self.avg_length = sum(self.doc_lengths) / max(len(self.doc_lengths), 1)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """
+        Return (row, score) pairs for the k best-matching documents.
+        """
+        n_docs = len(self.doc_lengths)
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[row] / self.avg_length)
+                scores[row] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+# Similarity between two chunks, used to penalize near-duplicates
+def jaccard(a: set, b: set) -> float:
+    """
+    Jaccard similarity of two token sets.
+    """
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+# Pick k documents balancing relevance against redundancy
+def mmr(docs: List[Document], relevance: List[float], k: int, lambda_: float = MMR_LAMBDA,
+        duplicate_threshold: float = MMR_DUPLICATE_THRESHOLD) -> List[Document]:
+    """
+    Maximal marginal relevance selection, with token-set Jaccard as the similarity.
+
+    Candidates at least duplicate_threshold similar to a selected document are dropped outright.
+    """
+    top = max(relevance, default=1.0) or 1.0
+    relevance = [score / top for score in relevance]
+    tokens = [set(tokenize(doc.page_content)) for doc in docs]
+
+    selected, candidates = [], list(range(len(docs)))
+    while candidates and len(selected) < k:
+        best = max(candidates, key=lambda i: lambda_ * relevance[i] -
+                   (1 - lambda_) * max((jaccard(tokens[i], tokens[j]) for j in selected), default=0.0))
+        selected.append(best)
+        candidates = [i for i in candidates if i != best and jaccard(tokens[i], tokens[best]) < duplicate_threshold]
+    return [docs[i] for i in selected]
+
+
+class RetrievalEngine:
+    """
+    Queries registered indices concurrently and fuses their results.
+    """
+
+    def __init__(self, max_workers: int = 8, hybrid: bool = RETRIEVAL_HYBRID):
+        self.stores: Dict[str, VectorStore] = {}
+        self.loaders: Dict[str, Callable[[], VectorStore]] = {}
+        self.corpus_loaders: Dict[str, Callable[[], Tuple[List[str], List[dict]]]] = {}
+        self.hybrid = hybrid
+        self._bm25: Dict[str, Optional[Tuple[BM25Index, List[str], List[dict]]]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='retrieval')
+
+    def register(self, name: str, store: VectorStore):
+        """
+        Register a vector store under a name.
+        """
+        self.stores[name] = store
+
+    def register_loader(self, name: str, loader: Callable[[], VectorStore]):
+        """
+        Register a function that loads the vector store for name on first use.
+        """
+        self.loaders[name] = loader
+
+    def register_corpus(self, name: str, loader: Callable[[], Tuple[List[str], List[dict]]]):
+        """
+        Register a function that loads the texts and metadatas of the chunks in name, for keyword search
+        over a store that doesn't hold them locally.
+        """
+        self.corpus_loaders[name] = loader
+
+    def store(self, name: str) -> VectorStore:
+        """
+        Get the vector store for name, loading it if it was registered with a loader.
+        """
+        if name not in self.stores:
+            self.stores[name] = self.loaders[name]()
+        return self.stores[name]
+
+    def _bm25_index(self, name: str) -> Optional[Tuple[BM25Index, List[str], List[dict]]]:
+        # Built on first use, from the store's own texts or else from its registered corpus
+        with self._lock:
+            if name not in self._bm25:
+                store = self.store(name)
+                if isinstance(store, LocalVectorStore):
+                    texts, metadatas = store.texts, store.metadatas
+                elif name in self.corpus_loaders:
+                    texts, metadatas = self.corpus_loaders[name]()
+                else:
+                    texts, metadatas = [], []
+                if texts:
+                    self._bm25[name] = (BM25Index(texts), texts, metadatas)
+                    logger.info(f'Built BM25 index for {name} over {len(texts)} chunks')
+                else:
+                    self._bm25[name] = None
+                    logger.info(f'No texts for {name}, using vector search only')
+            return self._bm25[name]
+
+    def _keyword_search(self, name: str, query: str, k: int) -> List[Document]:
+        bm25 = self._bm25_index(name)
+        if bm25 is None:
+            return []
+        index, texts, metadatas = bm25
+        return [Document(page_content=texts[row], metadata=dict(metadatas[row]))
+                for row, _ in index.search(query, k)]
+
+    def _vector_search(self, name: str, embedding: List[float], k: int) -> List[Document]:
+        return [doc for doc, _ in self.store(name).similarity_search_by_vector_with_score(embedding, k=k)]
+
+    def retrieve(self, query: str, index_names: List[str], k: int = RETRIEVAL_TOP_K,
+                 fetch_k: int = RETRIEVAL_FETCH_K) -> List[Document]:
+        """
+        Retrieve the top k documents for query across index_names.
+        """
+        # All indices share one embedding model, so the query is embedded once
+        embedding = self.store(index_names[0]).embeddings.embed_query(query)
+
+        with span('retrieve', indices=len(index_names)) as retrieve_span:
+            futures = []
+            for name in index_names:
+                futures.append(self._executor.submit(self._vector_search, name, embedding, fetch_k))
+                if self.hybrid:
+                    futures.append(self._executor.submit(self._keyword_search, name, query, fetch_k))
+            rankings = [future.result() for future in futures]
+            retrieve_span.set(candidates=sum(len(ranking) for ranking in rankings))
+
+        # Reciprocal-rank fusion over every ranking, identifying chunks by source and content
+        fused, docs = defaultdict(float), {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                key = (doc.metadata.get('source'), doc.page_content)
+                fused[key] += 1 / (RRF_K + rank + 1)
+                docs.setdefault(key, doc)
+
+        keys = sorted(fused, key=fused.get, reverse=True)
+        selected = mmr([docs[key] for key in keys], [fused[key] for key in keys], k)
+        logger.info(f'Retrieved {len(selected)} of {len(keys)} candidates from {index_names}')
+        return selected
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    LangChain retriever over a RetrievalEngine.
+    """
+    engine: RetrievalEngine
+    index_names: List[str]
+    k: int = RETRIEVAL_TOP_K
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.engine.retrieve(query, self.index_names, self.k)
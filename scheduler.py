@@ -0,0 +1,238 @@
+"""
+Scheduling of commands by estimated cost, with per-user and per-guild quotas.
+
+Each request's cost is estimated in tokens from its input, the command's usual prompt size and
+number of LLM calls, and the model's price relative to the default model. A request is turned
+down if its user or guild has spent its token bucket, and is otherwise queued for one of
+SCHEDULER_SLOTS slots, or in gateway mode, one per job its workers run at once (worker_slots):
+
+- Expensive requests, like agents or anything on gpt-4, use at most SCHEDULER_HEAVY_SLOTS of them,
+  so that cheap requests always find a free slot. Commands that don't call a model and cached
+  responses aren't scheduled at all.
+- A user runs at most SCHEDULER_USER_CONCURRENCY requests at once. Freed slots go to the cheap
+  lane first, then to the user with the fewest running requests, then in order of arrival.
+
+Someone spamming agent runs on gpt-4 thus waits behind their own requests, then runs out of quota,
+while everyone else keeps getting slots. Requests are charged when admitted, and refunded if they
+are cancelled before getting a slot or fail while running.
+"""
+import asyncio
+import math
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from itertools import count
+from time import monotonic, perf_counter
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from config import (CHARS_PER_TOKEN, COMMAND_COST_DICT, GUILD_QUOTA_TOKENS,
+                    MODEL_COST_DICT, QUOTA_PERIOD, SCHEDULER_HEAVY_COST,
+                    SCHEDULER_HEAVY_SLOTS, SCHEDULER_SLOTS,
+                    SCHEDULER_USER_CONCURRENCY, USER_QUOTA_TOKENS,
+                    WORKER_CONCURRENCY)
+from logger import logger
+from tracing import QUEUE_WAIT, REJECTED, span
+
+
+class Rejected(Exception):
+    """
+    Raised for a request over its user's or guild's quota. The message is meant for the user.
+    """
+
+
+# Estimate what a request will cost
+def estimate_cost(command: str, model: str, text: str) -> float:
+    """
+    Tokens the request will likely use, in units of the default model's price.
+    """
+    prompt_tokens, calls = COMMAND_COST_DICT.get(command, (0, 0))
+    return calls * (prompt_tokens + len(text) / CHARS_PER_TOKEN) * MODEL_COST_DICT.get(model, 1)
+
+
+# Size the slots of a gateway to its workers
+def worker_slots(workers: int, concurrency: int = WORKER_CONCURRENCY) -> Tuple[int, int]:
+    """
+    Slots and heavy slots for workers that each run concurrency jobs at once, with the same share of heavy slots.
+    """
+    slots = workers * concurrency
+    return slots, max(1, slots * SCHEDULER_HEAVY_SLOTS // SCHEDULER_SLOTS)
+
+
+# Describe how long to wait, for messages to users
+def format_wait(seconds: float) -> str:
+    """
+    Seconds under a minute, else minutes, rounded up.
+    """
+    value, unit = math.ceil(seconds), 'second'
+    if value >= 60:
+        value, unit = math.ceil(seconds / 60), 'minute'
+    return f'{value} {unit}{"" if value == 1 else "s"}'
+
+
+class TokenBuckets:
+    """
+    A token bucket per key, holding up to capacity tokens and refilled over period seconds.
+    """
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # Key -> (tokens, time of last update)
+
+    def level(self, key: str) -> float:
+        tokens, updated = self._buckets.get(key, (self.capacity, monotonic()))
+        return min(self.capacity, tokens + (monotonic() - updated) * self.rate)
+
+    def wait_time(self, key: str, cost: float) -> float:
+        """
+        Seconds until key can spend cost; 0 if it can now. Costs above capacity need a full bucket.
+        """
+        return max(0.0, min(cost, self.capacity) - self.level(key)) / self.rate
+
+    def give(self, key: str, cost: float):
+        """
+        Return what take charged for cost.
+        """
+        self._buckets[key] = (min(self.capacity, self.level(key) + min(cost, self.capacity)), monotonic())
+
+    def take(self, key: str, cost: float):
+        now = monotonic()
+        self._buckets[key] = (self.level(key) - min(cost, self.capacity), now)
+        # Full buckets hold no information
+        if len(self._buckets) > 10000:
+            self._buckets = {k: v for k, v in self._buckets.items()
+                             if v[0] + (now - v[1]) * self.rate < self.capacity}
+
+
+@dataclass
+class Ticket:
+    command: str
+    user: str
+    guild: Optional[str]
+    cost: float
+    heavy: bool
+    seq: int
+    future: Optional[asyncio.Future] = field(default=None, repr=False)
+    refunded: bool = False
+
+
+class Scheduler:
+    """
+    Admits requests within quota and hands out slots by lane, per-user load and arrival.
+    """
+
+    def __init__(self, slots: int = SCHEDULER_SLOTS, heavy_slots: int = SCHEDULER_HEAVY_SLOTS,
+                 heavy_cost: float = SCHEDULER_HEAVY_COST, user_concurrency: int = SCHEDULER_USER_CONCURRENCY,
+                 user_quota: float = USER_QUOTA_TOKENS, guild_quota: float = GUILD_QUOTA_TOKENS,
+                 quota_period: float = QUOTA_PERIOD):
+        self.slots = slots
+        self.heavy_slots = heavy_slots
+        self.heavy_cost = heavy_cost
+        self.user_concurrency = user_concurrency
+        self.users = TokenBuckets(user_quota, quota_period)
+        self.guilds = TokenBuckets(guild_quota, quota_period)
+        self.waiting: List[Ticket] = []
+        self.running = 0
+        self.running_heavy = 0
+        self.user_running: Dict[str, int] = defaultdict(int)
+        self._seq = count()
+
+    def admit(self, command: str, model: str, text: str, user: str, guild: Optional[str]) -> Ticket:
+        """
+        Charge the request's estimated cost to its user and guild, or raise Rejected if either is out of quota.
+        """
+        cost = estimate_cost(command, model, text)
+        for kind, buckets, key in (('user', self.users, user), ('guild', self.guilds, guild)):
+            if key is None:
+                continue
+            wait = buckets.wait_time(key, cost)
+            if wait > 0:
+                REJECTED.labels(command, kind).inc()
+                logger.info(f'Rejected {command} on {model} for {kind} {key}: cost {cost:.0f}, '
+                            f'{buckets.level(key):.0f} tokens left')
+                who = 'You have' if kind == 'user' else 'This server has'
+                raise Rejected(f'{who} used up the quota for now. Please try again in {format_wait(wait)}, '
+                               'or use a cheaper model.')
+        self.users.take(user, cost)
+        if guild is not None:
+            self.guilds.take(guild, cost)
+        return Ticket(command, user, guild, cost, cost > self.heavy_cost, next(self._seq))
+
+    def refund(self, ticket: Ticket):
+        """
+        Give a request's cost back to its user and guild, once.
+        """
+        if ticket.refunded:
+            return
+        ticket.refunded = True
+        self.users.give(ticket.user, ticket.cost)
+        if ticket.guild is not None:
+            self.guilds.give(ticket.guild, ticket.cost)
+
+    def _eligible(self, ticket: Ticket) -> bool:
+        if ticket.heavy and self.running_heavy >= self.heavy_slots:
+            return False
+        return self.user_running[ticket.user] < self.user_concurrency
+
+    def _start(self, ticket: Ticket):
+        self.running += 1
+        self.running_heavy += ticket.heavy
+        self.user_running[ticket.user] += 1
+
+    def _dispatch(self):
+        """
+        Hand free slots to the best eligible waiting tickets.
+        """
+        while self.running < self.slots:
+            eligible = [ticket for ticket in self.waiting if self._eligible(ticket)]
+            if not eligible:
+                return
+            ticket = min(eligible, key=lambda t: (t.heavy, self.user_running[t.user], t.seq))
+            self.waiting.remove(ticket)
+            self._start(ticket)
+            ticket.future.set_result(None)
+
+    def _release(self, ticket: Ticket):
+        self.running -= 1
+        self.running_heavy -= ticket.heavy
+        self.user_running[ticket.user] -= 1
+        if not self.user_running[ticket.user]:
+            del self.user_running[ticket.user]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, ticket: Ticket) -> AsyncIterator[Ticket]:
+        """
+        Wait for a slot for an admitted request and hold it for the enclosed block.
+        """
+        start = perf_counter()
+        with span('schedule', cost=round(ticket.cost), heavy=ticket.heavy):
+            ticket.future = asyncio.get_running_loop().create_future()
+            self.waiting.append(ticket)
+            self._dispatch()
+            if not ticket.future.done():
+                logger.info(f'Queued {ticket.command} for user {ticket.user} ({len(self.waiting)} waiting, '
+                            f'{self.running} running)')
+                try:
+                    await ticket.future
+                except asyncio.CancelledError:
+                    if ticket in self.waiting:
+                        self.waiting.remove(ticket)
+                    elif ticket.future.done() and not ticket.future.cancelled():
+                        self._release(ticket)  # Granted just as the request was cancelled
+                    self.refund(ticket)
+                    raise
+        QUEUE_WAIT.labels(ticket.command).observe(perf_counter() - start)
+        try:
+            yield ticket
+        except Exception:
+            self.refund(ticket)
+            raise
+        finally:
+            self._release(ticket)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Waiting and running requests.
+        """
+        return {'waiting': len(self.waiting), 'running': self.running, 'running_heavy': self.running_heavy}
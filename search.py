@@ -5,20 +5,31 @@ from dotenv import load_dotenv
 from langchain import LLMChain
 from langchain.agents import AgentExecutor, Tool, ZeroShotAgent
 from langchain.chat_models import ChatOpenAI
-from langchain.utilities import GoogleSearchAPIWrapper
 
+from chains import CHAINS
 from config import SEARCH_MODEL
 from logger import logger
-from utils import prettify_agent_response, timer
+from search_tools import get_search_tool
+from tracing import get_llm_callback
+from utils import prettify_agent_response
+
+
+# Search through the shared tool, so repeated searches are served from its cache
+def search(tool_input: str) -> str:
+    """
+    Search Google for one query, or several separated by " | ".
+    """
+    return get_search_tool()(tool_input)
+
 
 # Create tools
 load_dotenv()
-search = GoogleSearchAPIWrapper()
 TOOLS = [
     Tool(
         name="Search",
-        func=search.run,
-        description="Useful for when you need to answer questions about current events"
+        func=search,
+        description="Useful for when you need to answer questions about current events. "
+                    "To search several things at once, separate the queries with \" | \""
     )
 ]
 TOOL_STRINGS = "\n".join(
@@ -44,31 +55,39 @@ Thought: {agent_scratchpad}"""
 FORMAT_INSTRUCTIONS = FORMAT_INSTRUCTIONS.format(tool_names=TOOL_NAMES)
 
 
-# Search agent biaed on zeroshot
-@timer
-def search_agent(question: str, temperature: float = None, model: str = SEARCH_MODEL) -> str:
+# Prompt for the search agent, built once
+PROMPT = ZeroShotAgent.create_prompt(
+    TOOLS,
+    prefix=PREFIX,
+    suffix=SUFFIX,
+    format_instructions=FORMAT_INSTRUCTIONS,
+    input_variables=['input', 'agent_scratchpad']
+)
+logger.info(PROMPT.template)
+
+
+# Build the search agent for a model and temperature
+@CHAINS.register('search')
+def build_search_agent(model: str, temperature: float) -> AgentExecutor:
     """
-    Calls OpenAI API and searches the web to find the best answer to a question.
+    Create zero-shot agent with the search tool.
     """
-    # Write prompt and create zero-shot agent
-    prompt = ZeroShotAgent.create_prompt(
-        TOOLS,
-        prefix=PREFIX,
-        suffix=SUFFIX,
-        format_instructions=FORMAT_INSTRUCTIONS,
-        input_variables=['input', 'agent_scratchpad']
-    )
-    logger.info(prompt.template)
-
-    # Create LLM and call API
-    llm = ChatOpenAI(temperature=temperature, model_name=model)
-    llm_chain = LLMChain(llm=llm, prompt=prompt)
+    llm = ChatOpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()])
+    llm_chain = LLMChain(llm=llm, prompt=PROMPT)
 
     # Create agent with tools
     agent = ZeroShotAgent(llm_chain=llm_chain,
                           tools=TOOLS, tool_names=TOOL_NAMES)
-    agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=TOOLS, max_iterations=10,
-                                                        verbose=True, return_intermediate_steps=True)
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=TOOLS, max_iterations=10,
+                                              verbose=True, return_intermediate_steps=True)
+
+
+# Search agent biaed on zeroshot
+def search_agent(question: str, temperature: float = None, model: str = SEARCH_MODEL) -> str:
+    """
+    Calls OpenAI API and searches the web to find the best answer to a question.
+    """
+    agent_executor = CHAINS.get('search', model, temperature)
 
     response = agent_executor({'input': question})
     pretty_response = prettify_agent_response(response)
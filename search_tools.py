@@ -0,0 +1,173 @@
+"""
+Search tool for the search agent, with cached results and parallel queries.
+
+Results are cached for SEARCH_CACHE_TTL seconds, keyed on the normalized query, and concurrent
+requests for the same query share one API call. One agent step can ask several queries separated
+by " | ", which run concurrently. Optionally, the text of the top result pages is fetched and
+extracted in parallel and added to the results.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List
+
+from cachetools import TTLCache
+
+from config import (SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CONCURRENCY,
+                    SEARCH_MAX_QUERIES, SEARCH_NUM_RESULTS,
+                    SEARCH_PAGE_EXCERPT_TOKENS, SEARCH_PREFETCH_PAGES)
+from extract import fetch_page
+from http_client import get_session
+from logger import logger
+from response_cache import normalize_input
+from tracing import register_cache, span
+
+GOOGLE_SEARCH_URL = 'https://www.googleapis.com/customsearch/v1'
+QUERY_SEPARATOR = ' | '
+NO_RESULTS = 'No good Google Search Result was found'
+
+
+# Search Google on the shared HTTP session
+def google_search(query: str, num_results: int = SEARCH_NUM_RESULTS) -> List[Dict[str, str]]:
+    """
+    Title, link and snippet of the top Google results for query.
+    """
+    params = {'key': os.getenv('GOOGLE_API_KEY'), 'cx': os.getenv('GOOGLE_CSE_ID'), 'q': query, 'num': num_results}
+    with span('search'):
+        response = get_session().get(GOOGLE_SEARCH_URL, params=params)
+        response.raise_for_status()
+    return [{'title': item.get('title', ''), 'link': item.get('link', ''), 'snippet': item.get('snippet', '')}
+            for item in response.json().get('items', [])]
+
+
+# Normalize a query so that trivially different searches share a cache entry
+def normalize_query(query: str) -> str:
+    """
+    Lowercase, collapse whitespace, and strip quotes and trailing punctuation.
+    """
+    return normalize_input(query.strip().strip('"\''))
+
+
+class SearchTool:
+    """
+    Google search with a TTL cache, deduplication of in-flight queries and a thread pool for parallel queries.
+    """
+
+    def __init__(self, num_results: int = SEARCH_NUM_RESULTS, prefetch_pages: int = SEARCH_PREFETCH_PAGES,
+                 cache_size: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL,
+                 concurrency: int = SEARCH_CONCURRENCY):
+        self.num_results = num_results
+        self.prefetch_pages = prefetch_pages
+        self.hits = 0
+        self.misses = 0
+        self._cache: TTLCache = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        # Pages get their own pool, since queries running on the search pool wait for them
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='search')
+        self._page_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='search-page')
+
+    def _cached(self, key: str, func, *args):
+        """
+        Cached func(*args), waiting on an in-flight call for the same key instead of repeating it.
+        """
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._pending[key] = Future()
+
+        if not owner:
+            return future.result()
+        try:
+            value = func(*args)
+            with self._lock:
+                self._cache[key] = value
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def results(self, query: str) -> List[Dict[str, str]]:
+        """
+        Top results for query, cached.
+        """
+        return self._cached(f'search:{self.num_results}:{normalize_query(query)}', google_search, query,
+                            self.num_results)
+
+    def page_excerpt(self, url: str) -> str:
+        """
+        Leading text of a page, cached. Empty if it can't be fetched.
+        """
+        def fetch() -> str:
+            try:
+                return fetch_page(url, max_tokens=SEARCH_PAGE_EXCERPT_TOKENS).text
+            except Exception as e:
+                logger.info(f'Could not fetch {url}: {e}')
+                return ''
+        return self._cached(f'page:{url}', fetch)
+
+    def run(self, query: str) -> str:
+        """
+        Snippets of the top results for query, as LangChain's GoogleSearchAPIWrapper returns them,
+        followed by excerpts of the top pages if prefetching is enabled.
+        """
+        results = self.results(query)
+        if len(results) == 0:
+            return NO_RESULTS
+        text = ' '.join(result['snippet'] for result in results if result['snippet'])
+
+        links = [result['link'] for result in results if result['link']][:self.prefetch_pages]
+        if links:
+            excerpts = self._page_executor.map(self.page_excerpt, links)
+            pages = [f'From {link}: {excerpt}' for link, excerpt in zip(links, excerpts) if excerpt]
+            text = '\n\n'.join([text, *pages])
+        return text
+
+    def run_many(self, queries: List[str]) -> List[str]:
+        """
+        Run queries concurrently.
+        """
+        if len(queries) == 1:
+            return [self.run(queries[0])]
+        return list(self._executor.map(self.run, queries))
+
+    def __call__(self, tool_input: str) -> str:
+        """
+        Tool entry point: one query, or several separated by " | ".
+        """
+        queries: Dict[str, str] = {}
+        for query in tool_input.split(QUERY_SEPARATOR.strip()):
+            if normalize_query(query):
+                queries.setdefault(normalize_query(query), query.strip())
+        queries = list(queries.values())[:SEARCH_MAX_QUERIES] or [tool_input]
+        observations = self.run_many(queries)
+        if len(queries) == 1:
+            return observations[0]
+        return '\n\n'.join(f'Results for "{query}": {observation}' for query, observation in zip(queries, observations))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit and miss counters and the number of cached entries.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+
+# Get the shared search tool
+@lru_cache(maxsize=None)
+def get_search_tool() -> SearchTool:
+    """
+    Process-wide search tool, so agent runs share its cache.
+    """
+    tool = SearchTool()
+    register_cache('search', tool.stats)
+    return tool
@@ -0,0 +1,141 @@
+"""
+Coalescing of identical in-flight requests.
+
+When several users run the same command on the same input at once, e.g. /summarize on a link just
+posted in a busy channel, only the first request calls the backends. The others wait for its
+result. Streamed responses are fanned out token by token: a request that joins late first
+gets the tokens already generated, then the rest as they arrive.
+
+Requests are identical if their command, model, temperature and normalized input match.
+Finished calls are forgotten right away; repeats after that are served by the caches.
+"""
+import asyncio
+from typing import (Any, AsyncIterator, Callable, Dict, Hashable, List,
+                    Optional, Tuple)
+
+from logger import logger
+from response_cache import format_temperature, normalize_input
+from tracing import COALESCED
+
+
+# Build the key that identical requests share
+def flight_key(command: str, model: str, temperature: Optional[float], text: str,
+               normalize: Callable[[str], str] = normalize_input) -> Tuple[str, str, str, str]:
+    """
+    Command, model, formatted temperature and normalized input. Pass a normalize function for inputs like urls.
+    """
+    return command, model, format_temperature(temperature), normalize(text)
+
+
+class Broadcast:
+    """
+    Consumes an async iterator once and replays its items to any number of subscribers.
+    """
+
+    def __init__(self, source: AsyncIterator):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        # The task runs in a copy of the current context, so its spans belong to the first request
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator:
+        """
+        Yield every item from the start, then new ones as they arrive. Re-raises the source's error.
+        """
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.items):
+                yield self.items[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time; concurrent calls with the same key share its result.
+
+    Keys start with the command, which labels the coalesced-requests metric.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.streams: Dict[Hashable, Broadcast] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def _forget(self, registry: Dict, key: Hashable, value: Any):
+        if registry.get(key) is value:
+            del registry[key]
+
+    def in_flight(self, key: Hashable) -> bool:
+        """
+        Whether a call or stream with key is running, so that a request with it would join it.
+        """
+        return key in self.calls or key in self.streams
+
+    async def run(self, key: Tuple, func: Callable, *args, **kwargs) -> Any:
+        """
+        Await func(*args, **kwargs), or the identical call already in flight.
+
+        The call runs as its own task, so it finishes for the others if the request that started it is cancelled.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(self.calls, key, done))
+            # Mark the error as retrieved even if every waiter was cancelled; waiters still get it
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        else:
+            self.followers += 1
+            COALESCED.labels(key[0]).inc()
+            logger.info(f'Joined in-flight {key[0]} request: {key[-1]}')
+        return await asyncio.shield(task)
+
+    def stream(self, key: Tuple, func: Callable[..., AsyncIterator], *args, **kwargs) -> AsyncIterator:
+        """
+        Iterate func(*args, **kwargs), or join the identical stream already in flight.
+        """
+        broadcast = self.streams.get(key)
+        if broadcast is None:
+            self.leaders += 1
+            broadcast = Broadcast(func(*args, **kwargs))
+            self.streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self._forget(self.streams, key, broadcast))
+        else:
+            self.followers += 1
+            COALESCED.labels(key[0]).inc()
+            logger.info(f'Joined in-flight {key[0]} stream: {key[-1]} ({len(broadcast.items)} tokens so far)')
+        return broadcast.subscribe()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Calls started, calls joined and calls in flight.
+        """
+        return {'leaders': self.leaders, 'followers': self.followers,
+                'in_flight': len(self.calls) + len(self.streams)}
@@ -2,27 +2,69 @@
 Agent that can query a database
 Docs: https://langchain.readthedocs.io/en/latest/modules/chains/examples/sqlite.html
 Dataset: https://www.kaggle.com/datasets/jealousleopard/goodreadsbooks
+
+Questions are answered in one step where possible: the model writes a query from the cached
+schema, it runs on the read-only database, and the model answers from the result. The agent
+with database tools is only used when the query still fails after a retry.
 """
+import re
+from functools import lru_cache
+from sqlite3 import Error as SQLiteError
+from typing import Dict, List, Optional, Tuple
+
 from dotenv import load_dotenv
-from langchain import LLMChain, OpenAI, SQLDatabase, SQLDatabaseChain
-from langchain.agents import (AgentExecutor, Tool, ZeroShotAgent,
-                              create_sql_agent)
+from langchain import LLMChain
+from langchain.agents import AgentExecutor, ZeroShotAgent
 from langchain.agents.agent_toolkits import SQLDatabaseToolkit
 from langchain.chat_models import ChatOpenAI
 from langchain.llms.openai import OpenAI
+from langchain.prompts import PromptTemplate
 from langchain.sql_database import SQLDatabase
+from langchain.tools import BaseTool
 
-from config import SQL_MODEL
+from books_db import BooksDB, QueryResult, get_books_db
+from chains import CHAINS
+from config import SQL_DB_PATH, SQL_MODEL
 from logger import logger
-from utils import prettify_agent_response, prettify_chain_response, timer
+from sql_cache import SQLCache, get_sql_cache
+from tracing import get_llm_callback
+from utils import prettify_agent_response, prettify_chain_response
 
 # Load env
 load_dotenv()
-DB = SQLDatabase.from_uri('sqlite:///data/books.db')
-TOOLKIT = SQLDatabaseToolkit(db=DB)
-TOOLS = TOOLKIT.get_tools()
-TOOL_NAMES = [tool.name for tool in TOOLS]
+# Read-only, like the connections of the query engine
+DB_URI = f'sqlite:///file:{SQL_DB_PATH}?mode=ro&uri=true'
+
+
+QUERY_PROMPT = PromptTemplate.from_template("""You are a SQLite expert. Given an input question, write one syntactically correct SQLite query that answers it.
+Unless the user specifies a specific number of examples they wish to obtain, always limit your query to at most {top_k} results.
+You can order the results by a relevant column to return the most interesting examples in the database.
+Never query for all the columns from a specific table, only ask for the few relevant columns given the question.
+Match names and titles with LIKE, since a book can list several authors separated by "/".
+
+DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the database.
 
+If the question does not seem related to the database, just return "I don't know".
+
+Only use the following tables:
+{table_info}
+{error}
+Question: {question}
+SQLQuery:""")
+RETRY_ERROR = """
+The previous query failed.
+SQLQuery: {query}
+Error: {error}
+"""
+ANSWER_PROMPT = PromptTemplate.from_template("""Given an input question, the SQLite query that was run to answer it and the query result, answer the question.
+Only use the query result. If it is empty, say that no matching books were found.
+
+Question: {question}
+SQLQuery: {query}
+SQLResult: {result}
+Answer:""")
+SQL_FENCE_PATTERN = re.compile(r'```(?:sql)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+UNKNOWN = "I don't know"
 
 PREFIX = """You are an agent designed to interact with a SQL database.
 Given an input question, create a syntactically correct {dialect} query to run, then look at the results of the query and return the answer.
@@ -54,49 +96,222 @@ Thought: I should look at the tables in the database to see what I can query.
 {agent_scratchpad}"""
 
 
-# Defines agent to query a database
-@timer
-def sql_agent(query: str, temperature: float = 0, top_k: int = 10, model: str = SQL_MODEL) -> str:
+# Connect to the database on first use
+@lru_cache(maxsize=None)
+def get_toolkit() -> SQLDatabaseToolkit:
+    """
+    Database toolkit for the fallback agent, reusing the cached table info instead of sampling rows per call.
+    """
+    db = SQLDatabase.from_uri(DB_URI, custom_table_info=get_books_db().table_infos)
+    return SQLDatabaseToolkit(db=db)
+
+
+# Get the database tools
+@lru_cache(maxsize=None)
+def get_tools() -> List[BaseTool]:
+    """
+    Tools of the database toolkit, created once.
+    """
+    return get_toolkit().get_tools()
+
+
+# Create the agent prompt for a row limit
+@lru_cache(maxsize=None)
+def create_agent_prompt(top_k: int) -> PromptTemplate:
     """
-    Create Agent that can query a database.
+    Zero-shot agent prompt with the database tools.
     """
-    # Write prompt and create zero-shot agent
     prompt = ZeroShotAgent.create_prompt(
-        tools=TOOLKIT.get_tools(),
-        prefix=PREFIX.format(dialect=TOOLKIT.dialect, top_k=top_k),
+        tools=get_tools(),
+        prefix=PREFIX.format(dialect=get_toolkit().dialect, top_k=top_k),
         suffix=SUFFIX,
         format_instructions=FORMAT_INSTRUCTIONS,
         input_variables=['input', 'agent_scratchpad']
     )
     logger.info(prompt.template)
+    return prompt
+
+
+DEFAULT_TOP_K = 10
+
+
+# Connect to the database ahead of the first request
+def warm_up():
+    """
+    Open the read-only database and cache its schema, and open the query cache.
+    """
+    get_books_db()
+    get_sql_cache().version()
+
+
+# Check whether a query found nothing
+def is_empty(result: QueryResult) -> bool:
+    """
+    True for no rows, or a single row of only zeros, NULLs and empty strings, like an aggregate over no rows.
+    """
+    if not result.rows:
+        return True
+    return len(result.rows) == 1 and all(value in (None, 0, '') for value in result.rows[0])
 
-    # Create LLM and call API
-    llm = ChatOpenAI(temperature=temperature, model_name=model)
+
+class OneStepSQL:
+    """
+    Writes a query from the cached schema, runs it and answers from the result, in two model calls.
+    """
+
+    def __init__(self, llm, db: BooksDB, cache: SQLCache, top_k: int = DEFAULT_TOP_K, max_attempts: int = 2):
+        self.query_chain = LLMChain(llm=llm, prompt=QUERY_PROMPT)
+        self.answer_chain = LLMChain(llm=llm, prompt=ANSWER_PROMPT)
+        self.db = db
+        self.cache = cache
+        self.top_k = top_k
+        self.max_attempts = max_attempts
+
+    def write_query(self, question: str, error: str = '') -> str:
+        """
+        Generate the query, stripping any markdown code fence around it.
+        """
+        text = self.query_chain.predict(question=question, table_info=self.db.table_info, top_k=self.top_k,
+                                        error=error)
+        fenced = SQL_FENCE_PATTERN.search(text)
+        query = fenced.group(1) if fenced else text
+        return query.strip().rstrip(';').strip()
+
+    def run_cached_query(self, question: str) -> Optional[Tuple[str, QueryResult]]:
+        """
+        Run the cached statement for question or a variant of it, unless a variant finds nothing.
+        """
+        prepared = self.cache.get_query(question)
+        if prepared is None:
+            return None
+        query, params = prepared
+        try:
+            result = self.cache.run(self.db, query, params)
+        except SQLiteError as e:
+            logger.info(f'Cached query failed: {e}')
+            return None
+        # A variant may have bound a value the question didn't mean, e.g. with a condition of its own.
+        # Aggregates return a row even then, so a count of 0 or a NULL average counts as nothing found
+        if params and is_empty(result):
+            logger.info(f'Cached query found nothing for {list(params)}, writing a new one')
+            return None
+        return (f'{query}\nParameters: {list(params)}' if params else query), result
+
+    def __call__(self, question: str, use_cache: bool = True) -> Dict:
+        """
+        Answer question, retrying with the error when the query fails. Raises the last error.
+        """
+        cached = self.run_cached_query(question) if use_cache else None
+        if cached is not None:
+            query, result = cached
+            steps = [query, str(result)]
+            answer = self.answer_chain.predict(question=question, query=query, result=str(result))
+            return {'query': question, 'intermediate_steps': steps, 'result': answer.strip()}
+
+        steps: List[str] = []
+        error = ''
+        for attempt in range(self.max_attempts):
+            query = self.write_query(question, error)
+            steps.append(query)
+            if query.strip('"').startswith(UNKNOWN):
+                return {'query': question, 'intermediate_steps': steps, 'result': UNKNOWN}
+            try:
+                result = self.cache.run(self.db, query)
+                self.cache.set_query(question, query)
+                break
+            except SQLiteError as e:
+                logger.info(f'Query failed (attempt {attempt + 1}): {e}')
+                steps.append(f'Error: {e}')
+                if attempt == self.max_attempts - 1:
+                    raise
+                error = RETRY_ERROR.format(query=query, error=e)
+
+        steps.append(str(result))
+        answer = self.answer_chain.predict(question=question, query=query, result=str(result))
+        return {'query': question, 'intermediate_steps': steps, 'result': answer.strip()}
+
+
+# Build the one-step SQL chain for a model, temperature and row limit
+@CHAINS.register('sql-one-step')
+def build_one_step_sql(model: str, temperature: float, top_k: int = DEFAULT_TOP_K) -> OneStepSQL:
+    """
+    Create the one-step chain with a chat model.
+    """
+    return OneStepSQL(ChatOpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()]),
+                      get_books_db(), get_sql_cache(), top_k)
+
+
+# Build the SQL agent for a model, temperature and row limit
+@CHAINS.register('sql-agent')
+def build_sql_agent(model: str, temperature: float, top_k: int = DEFAULT_TOP_K) -> AgentExecutor:
+    """
+    Create zero-shot agent with the database tools.
+    """
+    prompt = create_agent_prompt(top_k)
+    tools = get_tools()
+    llm = ChatOpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()])
     llm_chain = LLMChain(llm=llm, prompt=prompt)
 
     # Create agent with tools
     agent = ZeroShotAgent(llm_chain=llm_chain,
-                          tools=TOOLS, tool_names=TOOL_NAMES)
-    agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=TOOLS, max_iterations=10,
-                                                        verbose=True, return_intermediate_steps=True)
+                          tools=tools, tool_names=[tool.name for tool in tools])
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, max_iterations=10,
+                                              verbose=True, return_intermediate_steps=True)
+
+
+# Build the SQL chain for a model and temperature
+@CHAINS.register('sql')
+def build_sql_chain(model: str, temperature: float) -> OneStepSQL:
+    """
+    Create chain that can query a database.
+    """
+    return OneStepSQL(OpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()]),
+                      get_books_db(), get_sql_cache())
 
-    response = agent_executor({'input': query})
-    pretty_response = prettify_agent_response(response)
 
+# Defines agent to query a database
+def sql_agent(query: str, temperature: float = 0, top_k: int = DEFAULT_TOP_K, model: str = SQL_MODEL,
+              use_cache: bool = True) -> str:
+    """
+    Query a database in one step, falling back to an agent with database tools.
+    """
+    cache = get_sql_cache()
+    if use_cache:
+        answer = cache.get_answer('sql-agent', model, temperature, query)
+        if answer is not None:
+            return answer
+
+    try:
+        response = CHAINS.get('sql-one-step', model, temperature, top_k)(query, use_cache)
+        logger.info(f'Response: {response}')
+        pretty_response = prettify_chain_response(response)
+    except SQLiteError as e:
+        logger.info(f'One-step query failed, falling back to the agent: {e}')
+        agent_executor = CHAINS.get('sql-agent', model, temperature, top_k)
+
+        response = agent_executor({'input': query})
+        pretty_response = prettify_agent_response(response)
+
+    cache.set_answer('sql-agent', model, temperature, query, pretty_response)
     return pretty_response
 
 
 # Create chain to query database
-@timer
-def sql_chain(query: str, temperature: float = 0, model: str = SQL_MODEL) -> str:
+def sql_chain(query: str, temperature: float = 0, model: str = SQL_MODEL, use_cache: bool = True) -> str:
     """
-    Create chain that can query a database.
+    Query a database with a chain.
     """
-    llm = OpenAI(temperature=temperature, model_name=model)
-    db_chain = SQLDatabaseChain(
-        llm=llm, database=DB, verbose=True, return_intermediate_steps=True)
+    cache = get_sql_cache()
+    if use_cache:
+        answer = cache.get_answer('sql', model, temperature, query)
+        if answer is not None:
+            return answer
+
+    db_chain = CHAINS.get('sql', model, temperature)
 
-    response = db_chain(query)
+    # Raises sqlite3.OperationalError if the query still fails after a retry
+    response = db_chain(query, use_cache)
     logger.info(f'Response: {response}')
     pretty_response = prettify_chain_response(response)
+    cache.set_answer('sql', model, temperature, query, pretty_response)
     return pretty_response
@@ -0,0 +1,312 @@
+"""
+Cache of generated SQL, query results and answers for the SQL commands, keyed on the database version.
+
+Once the SQL the model wrote for a question has run successfully, the normalized question is
+mapped to it. Literals in the SQL that also appear in the question (numbers, names, quoted
+values) become parameters of a prepared statement. A question that only differs in those values,
+e.g. "books by neil gaiman rated above 4" after "books by stephen king rated above 3", reuses the
+statement instead of asking the model again. Results and answers to exact repeats are cached as well.
+
+Entries are tied to a hash of the database file and dropped as soon as the file changes.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from books_db import BooksDB, QueryResult
+from config import (SQL_CACHE_MAX_QUERIES, SQL_CACHE_MAX_RESULTS,
+                    SQL_CACHE_PATH, SQL_CACHE_TTL, SQL_DB_PATH)
+from logger import logger
+from response_cache import cache_key
+from tracing import register_cache
+
+# String literals, then numbers that aren't part of an identifier
+LITERAL_PATTERN = re.compile(r"'((?:[^']|'')*)'|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])")
+NUMBER_PATTERN = r'(\d+(?:\.\d+)?)'
+# SQL before a LIMIT or OFFSET literal, including the offset in "LIMIT offset, count"
+ROW_COUNT_PATTERN = re.compile(r'\b(limit|offset)\s+(\d+\s*,\s*)?$', re.IGNORECASE)
+# Words of a text value, at most as many as the cached question's value had, so that a longer
+# question can't bind its trailing clause, e.g. "stephen king are in english", into the value
+TEXT_PATTERN = r'(\S+(?:\ \S+){{0,{extra_words}}})'
+# Bump when parameterization changes, so queries prepared by older versions are dropped
+PARAMETERIZE_VERSION = 3
+
+
+# Normalize a question, keeping its case so that captured values can be used as parameters
+def normalize_question(text: str) -> str:
+    """
+    Collapse whitespace and strip trailing punctuation.
+    """
+    return re.sub(r'\s+', ' ', text.strip()).rstrip('?!. ')
+
+
+@dataclass
+class PreparedQuery:
+    pattern: str  # Regex over the lowercased, normalized question
+    sql: str  # With ? placeholders
+    params: List[List]  # [group, prefix, suffix, is_number] per placeholder
+
+    def bind(self, match: re.Match) -> Tuple:
+        """
+        Parameters for a question matching the pattern.
+        """
+        values = []
+        for group, prefix, suffix, is_number in self.params:
+            value = match.group(group)
+            if is_number:
+                values.append(float(value) if '.' in value else int(value))
+            else:
+                values.append(f'{prefix}{value}{suffix}')
+        return tuple(values)
+
+
+# Turn the SQL generated for a question into a statement with the question's values as parameters
+def parameterize(question: str, sql: str) -> PreparedQuery:
+    """
+    Replace literals in sql that appear as words in question with placeholders, and match them in the pattern.
+
+    Literals that don't appear in the question stay part of the statement, as do LIMIT and OFFSET values,
+    which often coincide with a number in the question ("fewer than 100 ratings ... LIMIT 100").
+    A question value that more than one literal matches stays part of both the statement and the pattern,
+    since it can't be told which of them it was meant for. Text values match at most as many words as
+    the question's value has.
+    """
+    lowered = normalize_question(question).lower()
+    candidates = []  # (literal match, value, question span)
+    for literal in LITERAL_PATTERN.finditer(sql):
+        if ROW_COUNT_PATTERN.search(sql[:literal.start()]):
+            continue
+        quoted, number = literal.group(1), literal.group(2)
+        value = quoted.replace("''", "'") if quoted is not None else number
+        core = value.strip('%')
+        if not core.strip():
+            continue
+        found = re.search(rf'(?<!\w){re.escape(core.lower())}(?!\w)', lowered)
+        if found is not None:
+            candidates.append((literal, value, found.span()))
+    uses = Counter(span for _, _, span in candidates)
+
+    spans: Dict[Tuple[int, int], int] = {}  # Question span -> group
+    number_spans = set()
+    params, parts, last = [], [], 0
+    for literal, value, span in candidates:
+        if uses[span] > 1:
+            continue
+        if any(start < span[1] and span[0] < end for start, end in spans):
+            continue  # Overlaps a value already taken from the question
+        spans[span] = len(spans) + 1
+        core = value.strip('%')
+        if re.fullmatch(NUMBER_PATTERN, core):
+            number_spans.add(span)
+        prefix = value[:len(value) - len(value.lstrip('%'))]
+        suffix = value[len(value.rstrip('%')):]
+        params.append([spans[span], prefix, suffix, literal.group(1) is None])
+        parts.append(sql[last:literal.start()])
+        parts.append('?')
+        last = literal.end()
+    parts.append(sql[last:])
+
+    # Groups are numbered in order of first use in the SQL, but appear in the pattern in question order
+    pattern, position = [], 0
+    order = sorted(spans, key=lambda span: span[0])
+    renumber = {spans[span]: i + 1 for i, span in enumerate(order)}
+    for span in order:
+        pattern.append(re.escape(lowered[position:span[0]]))
+        if span in number_spans:
+            pattern.append(NUMBER_PATTERN)
+        else:
+            pattern.append(TEXT_PATTERN.format(extra_words=len(lowered[span[0]:span[1]].split()) - 1))
+        position = span[1]
+    pattern.append(re.escape(lowered[position:]))
+    for param in params:
+        param[0] = renumber[param[0]]
+    return PreparedQuery(''.join(pattern), ''.join(parts), params)
+
+
+# Identify the contents of the database file
+def file_hash(path: str) -> str:
+    """
+    SHA-256 of the file, truncated.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class SQLCache:
+    """
+    SQLite-backed cache of prepared queries and answers, with an in-memory LRU of query results.
+    """
+
+    def __init__(self, path: str = SQL_CACHE_PATH, db_path: str = SQL_DB_PATH, ttl: float = SQL_CACHE_TTL,
+                 max_queries: int = SQL_CACHE_MAX_QUERIES, max_results: int = SQL_CACHE_MAX_RESULTS):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.max_results = max_results
+        self.counters = {'answer_hits': 0, 'query_hits': 0, 'result_hits': 0, 'misses': 0}
+        self._stat: Optional[Tuple[int, int]] = None
+        self._version = ''
+        self._queries: Dict[str, Tuple[re.Pattern, PreparedQuery]] = {}
+        self._results: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS queries (
+                pattern TEXT PRIMARY KEY,
+                sql TEXT NOT NULL,
+                params TEXT NOT NULL,
+                db_version TEXT NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                db_version TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+        """)
+
+    def version(self) -> str:
+        """
+        Hash of the database file, recomputed when its size or mtime changes. Drops stale entries.
+        """
+        stat = os.stat(self.db_path)
+        with self._lock:
+            if (stat.st_mtime_ns, stat.st_size) == self._stat:
+                return self._version
+            version = f'{file_hash(self.db_path)}-{PARAMETERIZE_VERSION}'
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+            if version != self._version:
+                self._load(version)
+            return version
+
+    def _load(self, version: str):
+        self._version = version
+        self._results.clear()
+        deleted = self._conn.execute('DELETE FROM queries WHERE db_version != ?', (version,)).rowcount
+        deleted += self._conn.execute('DELETE FROM answers WHERE db_version != ?', (version,)).rowcount
+        self._conn.commit()
+        if deleted:
+            logger.info(f'Database {self.db_path} changed, dropped {deleted} cached queries and answers')
+
+        self._queries.clear()
+        for pattern, sql, params in self._conn.execute('SELECT pattern, sql, params FROM queries'):
+            self._queries[pattern] = (re.compile(pattern), PreparedQuery(pattern, sql, json.loads(params)))
+
+    def get_answer(self, command: str, model: str, temperature: float, question: str) -> Optional[Any]:
+        """
+        Cached answer to the same question for the current database.
+        """
+        version = self.version()
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM answers WHERE key = ? AND db_version = ? AND created_at >= ?',
+                                     (cache_key(command, model, temperature, question), version,
+                                      time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        self.counters['answer_hits'] += 1
+        return json.loads(row[0])
+
+    def set_answer(self, command: str, model: str, temperature: float, question: str, value: Any):
+        """
+        Store the answer to a question.
+        """
+        version = self.version()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO answers (key, value, db_version, created_at) VALUES (?, ?, ?, ?)',
+                               (cache_key(command, model, temperature, question), json.dumps(value), version,
+                                time.time()))
+            self._conn.execute('DELETE FROM answers WHERE created_at < ?', (time.time() - self.ttl,))
+            self._conn.commit()
+
+    def get_query(self, question: str) -> Optional[Tuple[str, Tuple]]:
+        """
+        Prepared statement and parameters for a question matching a cached one, preferring the fewest parameters.
+        """
+        self.version()
+        normalized = normalize_question(question)
+        with self._lock:
+            candidates = []
+            for pattern, (regex, prepared) in self._queries.items():
+                match = regex.fullmatch(normalized.lower())
+                if match is not None:
+                    candidates.append((regex.groups, pattern, prepared, match))
+            if not candidates:
+                self.counters['misses'] += 1
+                return None
+            _, pattern, prepared, match = min(candidates, key=lambda candidate: candidate[0])
+            # Captured from the lowercased question; take the values with their original case
+            match = re.compile(pattern, re.IGNORECASE).fullmatch(normalized)
+            self._conn.execute('UPDATE queries SET used_at = ? WHERE pattern = ?', (time.time(), pattern))
+            self._conn.commit()
+        self.counters['query_hits'] += 1
+        return prepared.sql, prepared.bind(match)
+
+    def set_query(self, question: str, sql: str):
+        """
+        Store the SQL that answered a question, as a prepared statement.
+        """
+        prepared = parameterize(question, sql)
+        version = self.version()
+        with self._lock:
+            self._queries[prepared.pattern] = (re.compile(prepared.pattern), prepared)
+            self._conn.execute('INSERT OR REPLACE INTO queries (pattern, sql, params, db_version, used_at) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (prepared.pattern, prepared.sql, json.dumps(prepared.params), version, time.time()))
+            evicted = self._conn.execute('SELECT pattern FROM queries ORDER BY used_at DESC LIMIT -1 OFFSET ?',
+                                         (self.max_queries,)).fetchall()
+            for pattern, in evicted:
+                self._queries.pop(pattern, None)
+                self._conn.execute('DELETE FROM queries WHERE pattern = ?', (pattern,))
+            self._conn.commit()
+        logger.info(f'Cached query for "{prepared.pattern}": {prepared.sql}')
+
+    def run(self, db: BooksDB, sql: str, params: Tuple = ()) -> QueryResult:
+        """
+        Run a query on db, serving repeated queries from memory.
+        """
+        key = (self.version(), sql, params)
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.counters['result_hits'] += 1
+                return result
+
+        result = db.run(sql, params)
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit and miss counters and the number of cached queries and results.
+        """
+        return {**self.counters, 'queries': len(self._queries), 'results': len(self._results)}
+
+
+# Get the shared SQL cache
+@lru_cache(maxsize=None)
+def get_sql_cache() -> SQLCache:
+    """
+    SQL cache, opened on first use.
+    """
+    cache = SQLCache()
+    register_cache('sql', cache.stats)
+    return cache
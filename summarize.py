@@ -1,136 +1,198 @@
 """
 Module for summarizing text.
 """
-import re
-from typing import List
+import asyncio
+import time
+from functools import partial
+from typing import AsyncIterator, List
 
-import requests
-import tiktoken
-from bs4 import BeautifulSoup
+import openai
 from langchain import OpenAI
 from langchain.chains.summarize import load_summarize_chain
 from langchain.docstore.document import Document
 from langchain.prompts import (ChatPromptTemplate, HumanMessagePromptTemplate,
                                SystemMessagePromptTemplate)
-from langchain.text_splitter import TokenTextSplitter
 
-from config import SUMMARY_MAX_TOKENS, SUMMARY_MODEL, SUMMARY_TOKENIZER
+from chains import CHAINS
+from config import (SUMMARY_CHUNK_OVERLAP, SUMMARY_CHUNK_TOKENS,
+                    SUMMARY_MAP_CONCURRENCY, SUMMARY_MAP_MAX_TOKENS,
+                    SUMMARY_MAX_PAGE_TOKENS, SUMMARY_MAX_TOKENS_DICT,
+                    SUMMARY_MODEL)
+from extract import FetchError, afetch_page, fetch_page
+from http_client import use_shared_sessions
 from logger import logger
-from utils import timer
+from tokenization import TokenizedText, get_encoding, num_tokens
+from tracing import (end_span, get_llm_callback, record_tokens,
+                     register_cache, span, start_span)
+from url_cache import UrlCache, conditional_headers
+from utils import remove_empty_lines
+
+URL_CACHE = UrlCache()
+register_cache('url', URL_CACHE.stats)
+
+# Prompts
+SUMMARY_SYSTEM_MSG = """You are a teacher who summarizes documents into easily digestible bullet points."""
+SUMMARY_HUMAN_MSG = """Summarize the following text in bullet points: 
+    
+    {text}
 
-ENC = tiktoken.encoding_for_model(SUMMARY_MODEL)
-TEXT_SPLITTER = TokenTextSplitter(encoding_name=SUMMARY_TOKENIZER)
+    Concise summary in bullet points:"""
+ELI5_SYSTEM_MSG = """You are a teacher who explains documents to a five-year old."""
+ELI5_HUMAN_MSG = """Explain the following text to a five-year old: 
+    
+    {text}
 
+    Concise explanation:"""
+# Used to condense sections of long pages before the final summary or explanation
+MAP_SYSTEM_MSG = """You are a teacher who summarizes sections of long documents, keeping every key point."""
+MAP_HUMAN_MSG = """Summarize the following section of a longer text in bullet points: 
+    
+    {text}
 
-# Count the number of tokens in text
-def num_tokens(text: str) -> int:
+    Concise summary in bullet points:"""
+
+# Chat prompts, built once
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(SUMMARY_SYSTEM_MSG),
+    HumanMessagePromptTemplate.from_template(SUMMARY_HUMAN_MSG)
+])
+ELI5_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(ELI5_SYSTEM_MSG),
+    HumanMessagePromptTemplate.from_template(ELI5_HUMAN_MSG)
+])
+MAP_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(MAP_SYSTEM_MSG),
+    HumanMessagePromptTemplate.from_template(MAP_HUMAN_MSG)
+])
+
+# LangChain's default, so that the streaming path matches the chain-based path
+DEFAULT_TEMPERATURE = 0.7
+
+
+# Load the tokenizer ahead of the first request
+def warm_up():
     """
-    Count the number of tokens in text.
+    Load the summary model's encoding, which is downloaded on first use.
     """
-    enc = tiktoken.encoding_for_model(SUMMARY_MODEL)
-    return len(enc.encode(text))
+    get_encoding(SUMMARY_MODEL)
 
 
 # Get text from url
-def get_text_from_url(url: str) -> str:
+def get_text_from_url(url: str) -> TokenizedText:
     """
-    Get text from url.
+    Get text from url, tokenized and trimmed to the page token limit.
     """
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    text = re.sub(r'\n+', '\n', soup.get_text())  # Remove consecutive newlines
-
-    # Trim text to 1800 tokens
-    trimmed_text = ENC.decode((ENC.encode(text))[:SUMMARY_MAX_TOKENS])
+    page = URL_CACHE.get(url)
+    if page is not None and page.is_fresh(URL_CACHE.ttl):
+        logger.info(f'Url cache hit: {url}')
+    else:
+        fetched = fetch_page(url, conditional_headers(page))
+        if page is not None and fetched.status == 304:
+            URL_CACHE.refresh(url)
+            logger.info(f'Url cache revalidated: {url}')
+        else:
+            page = URL_CACHE.put(url, fetched.html, fetched.text, fetched.etag, fetched.last_modified, fetched.status)
+    if not page.text.strip():
+        raise FetchError(f'No text found at {url}')
+    return trim_text(page.text, url)
+
+
+# Get text from url without blocking the event loop
+async def aget_text_from_url(url: str) -> TokenizedText:
+    """
+    Get text from url asynchronously, tokenized and trimmed to the page token limit.
+    """
+    loop = asyncio.get_running_loop()
+    page = await loop.run_in_executor(None, URL_CACHE.get, url)
+    if page is not None and page.is_fresh(URL_CACHE.ttl):
+        logger.info(f'Url cache hit: {url}')
+    else:
+        fetched = await afetch_page(url, conditional_headers(page))
+        if page is not None and fetched.status == 304:
+            await loop.run_in_executor(None, URL_CACHE.refresh, url)
+            logger.info(f'Url cache revalidated: {url}')
+        else:
+            page = await loop.run_in_executor(None, URL_CACHE.put, url, fetched.html, fetched.text,
+                                              fetched.etag, fetched.last_modified, fetched.status)
+    if not page.text.strip():
+        raise FetchError(f'No text found at {url}')
+    # Tokenizing a long page is CPU-bound
+    return await asyncio.to_thread(trim_text, page.text, url)
+
+
+# Trim text to the page token limit
+def trim_text(text: str, url: str) -> TokenizedText:
+    """
+    Tokenize text once and trim it to the page token limit. Longer pages are summarized with map-reduce.
+    """
+    with span('tokenize', chars=len(text)) as tokenize_span:
+        page = TokenizedText(text)
+        trimmed = page.trim(SUMMARY_MAX_PAGE_TOKENS)
+        tokenize_span.set(tokens=len(page))
 
     logger.info(
-        f'{num_tokens(trimmed_text)}/{num_tokens(text)} tokens from {url}')
-    return trimmed_text
+        f'{len(trimmed)}/{len(page)} tokens from {url}')
+    return trimmed
 
 
 # Get docs from text
-def get_docs_from_text(text: str) -> list:
+def get_docs_from_text(text: TokenizedText, model: str = SUMMARY_MODEL) -> list:
     """
-    Get docs from text.
+    Get docs from text. Text that fits into a single call for the model is kept as one doc.
     """
-    texts = TEXT_SPLITTER.split_text(text)
-    docs = [Document(page_content=t) for t in texts]
+    if len(text) <= SUMMARY_MAX_TOKENS_DICT[model]:
+        return [Document(page_content=text.text)]
+    texts = text.split(SUMMARY_CHUNK_TOKENS, SUMMARY_CHUNK_OVERLAP)
+    docs = [Document(page_content=t.text) for t in texts]
     logger.info(f'Created {len(docs):,} out of {len(texts):,} total docs')
     return docs
 
 
-# Remove empty lines from text
-def remove_empty_lines(text: str) -> str:
-    """
-    Remove empty lines from text.
-    """
-    return '\n'.join([line for line in text.splitlines() if line.strip()])
-
-
-# Calls OpenAI API and returns summary of text
-def summarize(docs: List[str], temperature: float, model: str) -> str:
+# Build a summarize chain for a prompt, model, temperature and chain type
+def build_summarize_chain(prompt: ChatPromptTemplate, model: str, temperature: float, chain_type: str):
     """
-    Calls OpenAI API and returns summary of text.
+    Stuff chain that summarizes docs in one call, or map-reduce chain that summarizes each doc and combines with prompt.
     """
-    # Write prompt
-    system_msg = """You are a teacher who summarizes documents into easily digestible bullet points."""
-    human_msg = """Summarize the following text in bullet points: 
-    
-    {text}
+    llm = OpenAI(temperature=temperature, model_name=model, callbacks=[get_llm_callback()])
+    if chain_type == 'stuff':
+        return load_summarize_chain(llm, chain_type='stuff', prompt=prompt)
+    return load_summarize_chain(llm, chain_type='map_reduce', map_prompt=MAP_PROMPT, combine_prompt=prompt)
 
-    Concise summary in bullet points:"""
 
-    messages = [
-        SystemMessagePromptTemplate.from_template(system_msg),
-        HumanMessagePromptTemplate.from_template(human_msg)
-    ]
+CHAINS.register('summarize')(partial(build_summarize_chain, SUMMARY_PROMPT))
+CHAINS.register('eli5')(partial(build_summarize_chain, ELI5_PROMPT))
 
-    prompt = ChatPromptTemplate.from_messages(messages)
-    logger.info(f'Prompt: {prompt}, temperature: {temperature}')
 
-    # Create LLM and call API
-    llm = OpenAI(temperature=temperature, model_name=model)
-    chain = load_summarize_chain(llm, chain_type="stuff", prompt=prompt)
+# Run the stuff chain on a single doc, or map-reduce over several
+def run_summarize_chain(command: str, docs: List[Document], temperature: float, model: str) -> str:
+    """
+    Summarize docs in one call if there is one doc, else summarize each doc and combine.
+    """
+    chain_type = 'stuff' if len(docs) == 1 else 'map_reduce'
+    chain = CHAINS.get(command, model, temperature, chain_type)
     response = chain.run(docs)
     logger.info(
         f'Results received: {response} ({num_tokens(response)} tokens), temperature: {temperature}')
-
     return response
 
 
-# Calls OpenAI API and explains the text like the user is a five-year old
-def eli5(docs: List[str], temperature: float, model: str) -> str:
+# Calls OpenAI API and returns summary of text
+def summarize(docs: List[Document], temperature: float, model: str) -> str:
     """
-    Calls OpenAI API and returns explaination for a five year old
+    Calls OpenAI API and returns summary of text.
     """
-    # Write prompt
-    system_msg = """You are a teacher who explains documents to a five-year old."""
-    human_msg = """Explain the following text to a five-year old: 
-    
-    {text}
+    return run_summarize_chain('summarize', docs, temperature, model)
 
-    Concise explanation:"""
 
-    messages = [
-        SystemMessagePromptTemplate.from_template(system_msg),
-        HumanMessagePromptTemplate.from_template(human_msg)
-    ]
-
-    prompt = ChatPromptTemplate.from_messages(messages)
-    logger.info(f'Prompt: {prompt}, temperature: {temperature}')
-
-    # Create LLM and call API
-    llm = OpenAI(temperature=temperature, model_name=model)
-    chain = load_summarize_chain(llm, chain_type="stuff", prompt=prompt)
-    response = chain.run(docs)
-    logger.info(
-        f'Results received: {response} ({num_tokens(response)} tokens), temperature: {temperature}')
-
-    return response
+# Calls OpenAI API and explains the text like the user is a five-year old
+def eli5(docs: List[Document], temperature: float, model: str) -> str:
+    """
+    Calls OpenAI API and returns explaination for a five year old
+    """
+    return run_summarize_chain('eli5', docs, temperature, model)
 
 
 # Summarize text from url
-@timer
 def summarize_url(url: str, temperature: float = None, model: str = SUMMARY_MODEL) -> str:
     """
     Calls OpenAI API and returns summary of text.
@@ -139,7 +201,7 @@ def summarize_url(url: str, temperature: float = None, model: str = SUMMARY_MODE
         f'summarize: {url} (temperature: {temperature}, model: {model})')
     # Get text from url
     text = get_text_from_url(url)
-    docs = get_docs_from_text(text)
+    docs = get_docs_from_text(text, model)
     response = summarize(docs, temperature, model)
     pretty_response = remove_empty_lines(response)
 
@@ -147,7 +209,6 @@ def summarize_url(url: str, temperature: float = None, model: str = SUMMARY_MODE
 
 
 # Explain like I'm five from url
-@timer
 def eli5_url(url: str, temperature: float = None, model: str = SUMMARY_MODEL) -> str:
     """
     Calls OpenAI API and explains the text like the user is a five-year old.
@@ -155,8 +216,148 @@ def eli5_url(url: str, temperature: float = None, model: str = SUMMARY_MODEL) ->
     logger.info(f'eli5: {url} (temperature: {temperature}, model: {model})')
     # Get text from url
     text = get_text_from_url(url)
-    docs = get_docs_from_text(text)
+    docs = get_docs_from_text(text, model)
     response = eli5(docs, temperature, model)
     pretty_response = remove_empty_lines(response)
 
     return pretty_response
+
+
+# Get a chat completion
+async def acomplete(system_msg: str, human_msg: str, text: str, temperature: float, model: str,
+                    max_tokens: int = None) -> str:
+    """
+    Calls OpenAI API asynchronously and returns the full response.
+    """
+    if temperature is None:
+        temperature = DEFAULT_TEMPERATURE
+    messages = [{'role': 'system', 'content': system_msg},
+                {'role': 'user', 'content': human_msg.format(text=text)}]
+    use_shared_sessions()
+
+    with span('llm', model=model) as llm_span:
+        response = await openai.ChatCompletion.acreate(model=model, messages=messages,
+                                                       temperature=temperature, max_tokens=max_tokens)
+        usage = response.get('usage', {})
+        record_tokens(model, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), llm_span)
+    return response['choices'][0]['message']['content']
+
+
+# Stream a chat completion token by token
+async def astream_completion(system_msg: str, human_msg: str, text: str, temperature: float, model: str) -> AsyncIterator[str]:
+    """
+    Calls OpenAI API asynchronously and yields the response as it is generated.
+    """
+    if temperature is None:
+        temperature = DEFAULT_TEMPERATURE
+    messages = [{'role': 'system', 'content': system_msg},
+                {'role': 'user', 'content': human_msg.format(text=text)}]
+    use_shared_sessions()
+
+    # Not made current, since the consumer sends messages between tokens.
+    # Streamed responses carry no usage, so tokens are counted here: one per content delta
+    llm_span = start_span('llm', model=model, stream=True)
+    completion_tokens, error = 0, None
+    try:
+        response = await openai.ChatCompletion.acreate(model=model, messages=messages,
+                                                       temperature=temperature, stream=True)
+        async for chunk in response:
+            token = chunk['choices'][0]['delta'].get('content')
+            if token:
+                if not completion_tokens:
+                    llm_span.set(first_token=time.time() - llm_span.start)
+                completion_tokens += 1
+                yield token
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        prompt_tokens = sum(num_tokens(message['content'], model) for message in messages)
+        record_tokens(model, prompt_tokens, completion_tokens, llm_span)
+        end_span(llm_span, error)
+
+
+# Group texts into as few groups as possible that each fit into max_tokens
+def group_by_tokens(texts: List[str], max_tokens: int, model: str = SUMMARY_MODEL) -> List[List[str]]:
+    """
+    Greedily group consecutive texts so that each group, joined by newlines, fits into max_tokens.
+    """
+    groups, group, group_tokens = [], [], 0
+    for text in texts:
+        tokens = num_tokens(text, model) + 1  # And the newline joining it to the next
+        if group and group_tokens + tokens > max_tokens:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(text)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+# Compute the tokens of summaries that one reduce call can take
+def reduce_budget(model: str) -> int:
+    """
+    Model's prompt budget less the map prompt and the section summary it generates.
+    """
+    overhead = num_tokens(MAP_SYSTEM_MSG, model) + num_tokens(MAP_HUMAN_MSG.format(text=''), model)
+    return SUMMARY_MAX_TOKENS_DICT[model] - overhead - SUMMARY_MAP_MAX_TOKENS
+
+
+# Condense long text with parallel map-reduce so that it fits into a single call
+async def acondense(text: TokenizedText, temperature: float, model: str) -> str:
+    """
+    Return text unchanged if it fits into one call, else summaries of its chunks, reduced hierarchically.
+    """
+    max_tokens = SUMMARY_MAX_TOKENS_DICT[model]
+    if len(text) <= max_tokens:
+        return text.text
+
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+    async def summarize_section(section: str) -> str:
+        async with semaphore:
+            return await acomplete(MAP_SYSTEM_MSG, MAP_HUMAN_MSG, section, temperature, model, SUMMARY_MAP_MAX_TOKENS)
+
+    # Map: summarize every chunk concurrently
+    sections = text.split(SUMMARY_CHUNK_TOKENS, SUMMARY_CHUNK_OVERLAP)
+    summaries = await asyncio.gather(*(summarize_section(section.text) for section in sections))
+    logger.info(f'Summarized {len(sections)} sections ({len(text)} tokens)')
+
+    # Reduce: summarize groups of summaries until they fit into a single call.
+    # Each group must leave room in the reduce call for the map prompt and the summary it generates
+    budget = reduce_budget(model)
+    while sum(num_tokens(summary, model) + 1 for summary in summaries) > max_tokens:
+        groups = group_by_tokens(summaries, budget, model)
+        if len(groups) == len(summaries):
+            # Summaries are too long to combine; keep what fits
+            break
+        summaries = await asyncio.gather(*(summarize_section('\n'.join(group)) for group in groups))
+        logger.info(f'Reduced {len(groups)} groups of summaries')
+    return TokenizedText('\n'.join(summaries), model).trim(max_tokens).text
+
+
+# Stream summary of text from url
+async def astream_summarize_url(url: str, temperature: float = None, model: str = SUMMARY_MODEL) -> AsyncIterator[str]:
+    """
+    Fetches url and streams the summary of its text.
+    """
+    logger.info(
+        f'summarize (stream): {url} (temperature: {temperature}, model: {model})')
+    text = await aget_text_from_url(url)
+    text = await acondense(text, temperature, model)
+    async for token in astream_completion(SUMMARY_SYSTEM_MSG, SUMMARY_HUMAN_MSG, text, temperature, model):
+        yield token
+
+
+# Stream explanation of text from url for a five-year old
+async def astream_eli5_url(url: str, temperature: float = None, model: str = SUMMARY_MODEL) -> AsyncIterator[str]:
+    """
+    Fetches url and streams an explanation of its text for a five-year old.
+    """
+    logger.info(
+        f'eli5 (stream): {url} (temperature: {temperature}, model: {model})')
+    text = await aget_text_from_url(url)
+    text = await acondense(text, temperature, model)
+    async for token in astream_completion(ELI5_SYSTEM_MSG, ELI5_HUMAN_MSG, text, temperature, model):
+        yield token
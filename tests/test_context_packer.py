@@ -0,0 +1,62 @@
+import pytest
+from langchain.docstore.document import Document
+
+import context_packer
+from context_packer import context_budget, pack_documents, strip_overlap
+from tokenization import get_encoding, num_tokens
+
+MODEL = 'gpt-3.5-turbo'
+OVERLAP = 'shared text between two adjacent chunks of the page'
+
+# tiktoken downloads the encoding on first use, which fails offline
+try:
+    get_encoding(MODEL)
+except Exception as e:
+    pytest.skip(f'Cannot load the {MODEL} tokenizer: {e}', allow_module_level=True)
+
+
+def doc(text, source='https://eugeneyan.com/a'):
+    return Document(page_content=text, metadata={'source': source})
+
+
+def test_strip_overlap_removes_a_repeated_prefix_or_suffix():
+    assert strip_overlap(f'The first chunk ends with {OVERLAP}', f'{OVERLAP} and the second goes on.') == \
+        'and the second goes on.'
+    assert strip_overlap(f'{OVERLAP} and the later chunk goes on.', f'The earlier chunk ends with {OVERLAP}') == \
+        'The earlier chunk ends with'
+    # Too short to be anything but a coincidence
+    assert strip_overlap('ends with the page', 'the page starts here') == 'the page starts here'
+
+
+def test_pack_strips_overlap_and_skips_covered_chunks():
+    first = doc(f'The first chunk ends with {OVERLAP}')
+    packed, _ = pack_documents([first, doc(f'{OVERLAP} and the second goes on.'), doc('first chunk'),
+                                doc(f'{OVERLAP} on another page.', 'https://eugeneyan.com/b')], 1000, MODEL)
+    assert [d.page_content for d in packed] == [first.page_content, 'and the second goes on.',
+                                                f'{OVERLAP} on another page.']
+
+
+def test_pack_trims_the_last_chunk_to_the_budget(monkeypatch):
+    monkeypatch.setattr(context_packer, 'QA_MIN_CHUNK_TOKENS', 10)
+    chunks = [doc(' one' * 100, 'a'), doc(' two' * 100, 'b'), doc(' three' * 100, 'c')]
+    packed, used = pack_documents(chunks, 150, MODEL)
+
+    assert [d.metadata['source'] for d in packed] == ['a', 'b']
+    assert packed[0].page_content == chunks[0].page_content
+    assert chunks[1].page_content.startswith(packed[1].page_content)
+    assert 10 <= num_tokens(packed[1].page_content, MODEL) < 50
+    assert used == 150
+
+
+def test_pack_drops_the_last_chunk_when_too_little_would_be_left(monkeypatch):
+    monkeypatch.setattr(context_packer, 'QA_MIN_CHUNK_TOKENS', 60)
+    packed, used = pack_documents([doc(' one' * 100, 'a'), doc(' two' * 100, 'b')], 150, MODEL)
+    assert [d.metadata['source'] for d in packed] == ['a']
+    assert used < 150
+
+
+@pytest.mark.parametrize('model', ['gpt-3.5-turbo', 'gpt-4'])
+def test_budget_leaves_room_for_the_prompt_and_answer(model):
+    budget = context_budget('What is a feature store?', model)
+    assert 0 < budget <= context_packer.QA_CONTEXT_MAX_TOKENS_DICT[model]
+    assert budget + context_packer.QA_ANSWER_TOKENS < context_packer.SUMMARY_MAX_TOKENS_DICT[model]
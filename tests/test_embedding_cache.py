@@ -0,0 +1,83 @@
+import multiprocessing
+import sqlite3
+
+import numpy as np
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+MODEL = 'test-model'
+DIM = 4
+
+
+def vector(i: int):
+    return [float(i)] * DIM
+
+
+def write(path: str, capacity: int, writer: int, n_texts: int):
+    cache = EmbeddingCache(path, DIM, capacity, 'float32')
+    for i in range(writer * n_texts, (writer + 1) * n_texts):
+        cache.put_many(MODEL, [f'text {i}'], [vector(i)])
+
+
+def run_writers(path: str, capacity: int, n_writers: int, n_texts: int):
+    # Create the files once, like the bot does before workers start
+    EmbeddingCache(path, DIM, capacity, 'float32')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=write, args=(path, capacity, writer, n_texts)) for writer in range(n_writers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [vector(len(text)) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def test_cached_embeddings_only_embed_misses(tmp_path):
+    embeddings = CountingEmbeddings()
+    cached = CachedEmbeddings(embeddings, EmbeddingCache(str(tmp_path), DIM, 8, 'float32'), MODEL)
+
+    assert cached.embed_documents(['a', 'bb']) == [vector(1), vector(2)]
+    assert cached.embed_documents(['  bb ', 'ccc']) == [vector(2), vector(3)]
+    assert cached.embed_query('a') == vector(1)
+    assert embeddings.calls == [['a', 'bb'], ['ccc']]
+    assert cached.cache.stats() == {'hits': 2, 'misses': 3}
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), DIM, 2, 'float32')
+    cache.put_many(MODEL, ['a', 'b'], [vector(1), vector(2)])
+    cache.get_many(MODEL, ['a'])
+    cache.put_many(MODEL, ['c'], [vector(3)])
+    assert cache.get_many(MODEL, ['a', 'b', 'c']) == [vector(1), None, vector(3)]
+
+
+@pytest.mark.parametrize('capacity', [64, 16])
+def test_concurrent_writers_never_share_a_slot(tmp_path, capacity):
+    n_writers, n_texts = 4, 16
+    run_writers(str(tmp_path), capacity, n_writers, n_texts)
+
+    conn = sqlite3.connect(str(tmp_path / 'index.db'))
+    slots = [slot for slot, in conn.execute('SELECT slot FROM entries')]
+    conn.close()
+    assert len(slots) == min(capacity, n_writers * n_texts)
+    assert sorted(slots) == list(range(len(slots)))
+
+    # Every entry left in the cache holds the vector written for its own text
+    cache = EmbeddingCache(str(tmp_path), DIM, capacity, 'float32')
+    texts = [f'text {i}' for i in range(n_writers * n_texts)]
+    found = {i: result for i, result in enumerate(cache.get_many(MODEL, texts)) if result is not None}
+    assert len(found) == len(slots)
+    assert all(np.array_equal(result, vector(i)) for i, result in found.items())
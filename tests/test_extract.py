@@ -0,0 +1,95 @@
+import pytest
+
+import extract
+from extract import FetchError, StreamingExtractor, extract_text, fetch_page
+
+PARAGRAPH = '<p>' + 'A sentence that is long enough to be kept as content. ' * 4 + '</p>'
+
+
+class Response:
+    def __init__(self, body: bytes, status_code: int = 200, headers: dict = None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {'Content-Type': 'text/html; charset=utf-8'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class Session:
+    def __init__(self, response: Response):
+        self.response = response
+
+    def get(self, url, **kwargs):
+        return self.response
+
+
+@pytest.fixture(params=['lxml', 'stdlib'])
+def parser(request, monkeypatch):
+    if request.param == 'stdlib':
+        monkeypatch.setattr(extract, 'etree', None)
+    elif extract.etree is None:
+        pytest.skip('lxml is not installed')
+    return request.param
+
+
+def serve(monkeypatch, response: Response):
+    monkeypatch.setattr(extract, 'get_session', lambda: Session(response))
+
+
+def test_boilerplate_is_dropped_and_main_text_preferred(parser):
+    html = (f'<html><body><nav>{PARAGRAPH}</nav><div class="sidebar">{PARAGRAPH}</div>'
+            f'<article><h1>Title</h1>{PARAGRAPH}<p>Too short</p></article>'
+            f'<div class="content">Outside the article, and long enough to be kept.</div></body></html>')
+    lines = extract_text(html).split('\n')
+    assert lines[0] == 'Title'
+    assert len(lines) == 2 and lines[1].startswith('A sentence')
+
+
+def test_all_text_is_kept_when_extraction_drops_everything(parser):
+    html = f'<html><body><div class="has-sidebar">{PARAGRAPH}<p>Short</p></div><script>x = 1</script></body></html>'
+    text = extract_text(html)
+    assert text.startswith('A sentence') and text.endswith('Short')
+    assert 'x = 1' not in text
+
+
+def test_extraction_stops_at_the_token_budget(parser):
+    html = '<html><body>' + PARAGRAPH * 1000 + '</body></html>'
+    extractor = StreamingExtractor(max_tokens=100)
+    fed = 0
+    for start in range(0, len(html), 1024):
+        fed += 1
+        if extractor.feed(html[start:start + 1024]):
+            break
+    assert fed < len(html) // 1024
+    assert 100 * extract.EXTRACT_CHARS_PER_TOKEN <= len(extractor.close()) < len(html) // 10
+
+
+def test_fetch_stops_at_max_bytes(parser, monkeypatch):
+    body = ('<html><body>' + PARAGRAPH * 1000 + '</body></html>').encode('utf-8')
+    serve(monkeypatch, Response(body))
+    page = fetch_page('https://example.com', max_bytes=64 * 1024)
+    assert page.truncated
+    assert len(page.html.encode('utf-8')) == 64 * 1024
+    assert page.text.startswith('A sentence')
+
+
+def test_fetch_keeps_small_pages_whole(parser, monkeypatch):
+    serve(monkeypatch, Response(f'<html><body>{PARAGRAPH}</body></html>'.encode('utf-8'),
+                                headers={'Content-Type': 'text/html', 'ETag': '"v1"'}))
+    page = fetch_page('https://example.com')
+    assert (page.status, page.truncated, page.etag) == (200, False, '"v1"')
+    assert page.text.startswith('A sentence')
+
+
+def test_fetch_raises_on_error_responses(monkeypatch):
+    serve(monkeypatch, Response(b'<html><body><p>Not found, but long enough to be kept.</p></body></html>', 404))
+    with pytest.raises(FetchError, match='returned HTTP 404'):
+        fetch_page('https://example.com/missing')
@@ -0,0 +1,15 @@
+import openai
+from openai import api_requestor
+
+from http_client import get_session, use_shared_sessions
+
+
+def test_openai_gets_its_own_session_with_the_shared_settings(monkeypatch):
+    monkeypatch.setattr(openai, 'requestssession', None)
+    use_shared_sessions()
+    session = api_requestor._make_session()
+
+    # openai closes its session every few minutes, which must not close the shared pool
+    assert session is not get_session()
+    assert session.get_adapter('https://') is not get_session().get_adapter('https://')
+    assert session.get_adapter('https://').max_retries.total == get_session().get_adapter('https://').max_retries.total
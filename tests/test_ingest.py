@@ -0,0 +1,19 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ingest import read_rows
+
+
+def write(path, rows):
+    pq.write_table(pa.table({'url': [url for url, _ in rows], 'text': [text for _, text in rows]}), str(path))
+    return str(path)
+
+
+def test_url_in_several_paths_is_read_once(tmp_path):
+    (tmp_path / 'site').mkdir()
+    write(tmp_path / 'site' / '1.parquet', [('a', 'old a'), ('b', 'old b')])
+    write(tmp_path / 'site' / '2.parquet', [('a', 'new a')])
+    other = write(tmp_path / 'other.parquet', [('b', 'other b'), ('c', 'c'), ('c', 'c again')])
+
+    rows = list(read_rows([str(tmp_path / 'site'), other]))
+    assert rows == [('a', 'new a'), ('b', 'old b'), ('c', 'c')]
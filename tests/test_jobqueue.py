@@ -0,0 +1,228 @@
+import asyncio
+
+import pytest
+
+import jobqueue
+from jobqueue import JobError, JobQueue, QueueDispatcher
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobqueue.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return JobQueue(str(tmp_path / 'jobs.db'), lease=60, max_attempts=3, retry_delay=5)
+
+
+def sql_chain(question):
+    pass
+
+
+sql_chain.module = 'sql'  # Like a LazyCommand, which names the module the worker imports
+
+
+def test_claim_ack_and_get(queue):
+    assert queue.claim('w1') is None
+    job_id = queue.submit('sql', {'args': ['books']})
+
+    job = queue.claim('w1')
+    assert (job.id, job.command, job.payload, job.attempts) == (job_id, 'sql', {'args': ['books']}, 1)
+    assert queue.claim('w2') is None
+    assert queue.ack(job, 'w1', {'rows': 3})
+    done = queue.get([job_id])[job_id]
+    assert (done.status, done.result) == ('done', {'rows': 3})
+
+
+def test_claim_only_takes_listed_commands(queue):
+    queue.submit('sql', {})
+    assert queue.claim('w1', ['search']) is None
+    assert queue.claim('w1', ['search', 'sql']).command == 'sql'
+
+
+def test_expired_lease_is_claimed_again(queue, clock):
+    job_id = queue.submit('sql', {})
+    first = queue.claim('w1')
+    clock.now += 30
+    assert queue.heartbeat(first, 'w1')
+    clock.now += 50
+    assert queue.claim('w2') is None  # The heartbeat extended the lease
+
+    clock.now += 30
+    second = queue.claim('w2')
+    assert (second.id, second.attempts) == (job_id, 2)
+    # The first worker lost the job and can no longer finish it
+    assert not queue.ack(first, 'w1', 'late')
+    assert queue.ack(second, 'w2', 'ok')
+
+
+def test_expired_lease_after_progress_or_last_attempt_fails_the_job(queue, clock):
+    streamed = queue.submit('summarize', {})
+    job = queue.claim('w1')
+    queue.progress(job, 'w1', 'Some text the user saw')
+    clock.now += 61
+    assert queue.claim('w2') is None
+    assert queue.get([streamed])[streamed].error_type == 'WorkerLost'
+
+    exhausted = queue.submit('sql', {})
+    for _ in range(3):
+        assert queue.claim('w1').id == exhausted
+        clock.now += 61
+    assert queue.claim('w2') is None
+    assert queue.get([exhausted])[exhausted].status == 'failed'
+
+
+def test_fail_retries_with_a_delay(queue, clock):
+    job_id = queue.submit('search', {})
+    job = queue.claim('w1')
+    assert queue.fail(job, 'w1', RuntimeError('rate limited'))
+    assert queue.get([job_id])[job_id].status == 'queued'
+    clock.now += 4
+    assert queue.claim('w1') is None
+    clock.now += 2
+    assert queue.claim('w1').attempts == 2
+
+
+def test_fail_without_retry(queue):
+    for error, retry in ((ValueError('bad url'), True), (RuntimeError('stream broke'), False)):
+        job_id = queue.submit('summarize', {})
+        queue.fail(queue.claim('w1'), 'w1', error, retry)
+        failed = queue.get([job_id])[job_id]
+        assert (failed.status, failed.error_type) == ('failed', type(error).__name__)
+
+
+def test_failed_jobs_raise_their_error_type(queue):
+    for error, expected in ((ValueError('bad url'), ValueError), (KeyError('boom'), JobError)):
+        job_id = queue.submit('sql', {})
+        queue.fail(queue.claim('w1'), 'w1', error, retry=False)
+        with pytest.raises(expected):
+            queue.get([job_id])[job_id].raise_error()
+
+
+def test_cancel_only_drops_queued_jobs(queue):
+    running = queue.submit('sql', {})
+    queue.claim('w1')
+    queued = queue.submit('sql', {})
+    queue.cancel(running)
+    queue.cancel(queued)
+    assert list(queue.get([running, queued])) == [running]
+
+
+# Run the first job the dispatcher submits with handle(job) on a background "worker"
+async def serve(queue: JobQueue, handle):
+    while True:
+        job = await asyncio.to_thread(queue.claim, 'w1')
+        if job is not None:
+            return await handle(job)
+        await asyncio.sleep(0.001)
+
+
+def test_dispatcher_run_returns_the_result(queue):
+    async def handle(job):
+        assert job.payload == {'module': 'sql', 'function': 'sql_chain', 'args': ['books'], 'kwargs': {'model': 'm'}}
+        queue.ack(job, 'w1', 'three books')
+
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001)
+        result, _ = await asyncio.gather(dispatcher.run('sql', sql_chain, 'books', model='m'), serve(queue, handle))
+        return result
+
+    assert asyncio.run(main()) == 'three books'
+
+
+def test_dispatcher_run_raises_the_job_error(queue):
+    async def handle(job):
+        queue.fail(job, 'w1', sqlite_error(), retry=False)
+
+    def sqlite_error():
+        return jobqueue.sqlite3.OperationalError('no such column: rating')
+
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001)
+        await asyncio.gather(dispatcher.run('sql', sql_chain, 'books'), serve(queue, handle))
+
+    with pytest.raises(jobqueue.sqlite3.OperationalError, match='no such column'):
+        asyncio.run(main())
+
+
+def test_dispatcher_run_times_out(queue):
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001, timeout=0.01)
+        await dispatcher.run('sql', sql_chain, 'books')
+
+    with pytest.raises(JobError, match='No result after 0.01s'):
+        asyncio.run(main())
+    assert queue.stats() == {}  # The job nobody waits for is dropped
+
+
+async def collect(stream, received):
+    async for text in stream:
+        received.append(text)
+
+
+async def wait_for(predicate):
+    while not predicate():
+        await asyncio.sleep(0.001)
+
+
+def test_dispatcher_stream_yields_published_text(queue):
+    received = []
+
+    async def handle(job):
+        for text in ('Hel', 'Hello'):
+            queue.progress(job, 'w1', text)
+            await wait_for(lambda: ''.join(received) == text)
+        queue.ack(job, 'w1', 'Hello world')
+
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001)
+        await asyncio.gather(collect(dispatcher.stream('summarize', sql_chain, 'url'), received), serve(queue, handle))
+
+    asyncio.run(main())
+    assert received == ['Hel', 'lo', ' world']
+
+
+def test_dispatcher_stream_raises_when_the_text_changes(queue):
+    received = []
+
+    async def handle(job):
+        queue.progress(job, 'w1', 'First attempt')
+        await wait_for(lambda: received)
+        queue.progress(job, 'w1', 'Second attempt')
+
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001)
+        await asyncio.gather(collect(dispatcher.stream('summarize', sql_chain, 'url'), received), serve(queue, handle))
+
+    with pytest.raises(JobError, match='changed while it was streamed'):
+        asyncio.run(main())
+    assert received == ['First attempt']
+
+
+def test_dispatcher_stream_continues_after_a_retry_that_streamed_nothing(queue, clock):
+    received = []
+
+    async def handle(job):
+        queue.fail(job, 'w1', RuntimeError('connection reset'))
+        clock.now += 10
+        retried = await asyncio.to_thread(queue.claim, 'w1')
+        assert retried.attempts == 2
+        queue.ack(retried, 'w1', 'Summary')
+
+    async def main():
+        dispatcher = QueueDispatcher(queue, poll_interval=0.001)
+        await asyncio.gather(collect(dispatcher.stream('summarize', sql_chain, 'url'), received), serve(queue, handle))
+
+    asyncio.run(main())
+    assert received == ['Summary']
@@ -0,0 +1,48 @@
+from output import (FENCE, MAX_INITIAL_MESSAGE_LENGTH, MAX_MESSAGE_LENGTH,
+                    open_fence, split_message)
+
+
+def test_short_text_is_one_message():
+    assert split_message('Hello there.') == ['Hello there.']
+
+
+def test_chunks_fit_discord_limits_and_end_on_breaks():
+    paragraph = 'A sentence of about fifty characters, more or less. ' * 10
+    text = '\n\n'.join([paragraph.strip()] * 10)
+    chunks = split_message(text)
+
+    assert len(chunks[0]) <= MAX_INITIAL_MESSAGE_LENGTH
+    assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert all(chunk.endswith('less.') for chunk in chunks)
+    assert ' '.join(' '.join(chunks).split()) == ' '.join(text.split())
+
+
+def test_code_block_cut_at_the_limit_is_closed_and_reopened():
+    code = '\n'.join(f'SELECT title FROM books WHERE id = {i};' for i in range(150))
+    text = f'The query:\n\n```sql\n{code}\n```\n\nDone.'
+    chunks = split_message(text)
+
+    assert len(chunks) > 2
+    assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert all(chunk.endswith(FENCE) for chunk in chunks[:-1])
+    assert all(chunk.startswith('```sql\n') for chunk in chunks[1:])
+    assert not any(open_fence(chunk) for chunk in chunks)
+    lines = [line for chunk in chunks for line in chunk.splitlines() if line.startswith('SELECT')]
+    assert lines == code.splitlines()
+
+
+def test_one_line_fenced_snippet_does_not_open_a_block():
+    assert open_fence('Run ```x = 1``` first.\n```x = 1```') == ''
+    assert open_fence('```python\nx = 1') == '```python'
+    assert open_fence('```python\nx = 1\n```') == ''
+
+    text = ('Run ```pip install discord``` first. ' * 60).strip()
+    chunks = split_message(text)
+    assert len(chunks) > 1
+    assert not any(chunk.startswith(FENCE) or chunk.endswith(f'\n{FENCE}') for chunk in chunks)
+
+
+def test_chunks_of_streamed_text_do_not_change_as_it_grows():
+    text = 'word ' * 1000
+    shorter, longer = split_message(text[:3000]), split_message(text)
+    assert shorter[0] == longer[0]
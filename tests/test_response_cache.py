@@ -0,0 +1,31 @@
+from response_cache import ResponseCache
+
+TTL_DICT = {'ask-ey': 60}
+
+
+def recording_embed(calls):
+    def embed(text):
+        calls.append(text)
+        return [1.0, 0.0]
+    return embed
+
+
+def test_semantic_lookup_is_off_by_default(tmp_path):
+    calls = []
+    cache = ResponseCache(str(tmp_path / 'cache.db'), TTL_DICT, embed_fn=recording_embed(calls))
+    cache.set('ask-ey', 'model', 0.0, 'What is a feature store?', ['answer'])
+
+    assert cache.get('ask-ey', 'model', 0.0, 'what is a feature store') == ['answer']
+    assert cache.get('ask-ey', 'model', 0.0, 'What are feature stores?') is None
+    assert calls == []
+
+
+def test_semantic_lookup_embeds_the_question_as_retrieval_does(tmp_path):
+    calls = []
+    cache = ResponseCache(str(tmp_path / 'cache.db'), TTL_DICT, ['ask-ey'], embed_fn=recording_embed(calls))
+    cache.set('ask-ey', 'model', 0.0, 'What is a feature store?', ['answer'])
+
+    # Embedded as typed, so the retriever's embedding of the same question is an embedding cache hit
+    assert cache.get('ask-ey', 'model', 0.0, 'What are  Feature Stores?') == ['answer']
+    assert calls == ['What is a feature store?', 'What are  Feature Stores?']
+    assert cache.stats() == {'hits': 0, 'semantic_hits': 1, 'misses': 0}
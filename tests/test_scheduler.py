@@ -0,0 +1,199 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import (Rejected, Scheduler, TokenBuckets, estimate_cost,
+                       format_wait, worker_slots)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler, 'monotonic', lambda: now[0])
+    return now
+
+
+def make_scheduler(**kwargs) -> Scheduler:
+    options = dict(slots=2, heavy_slots=1, heavy_cost=8000, user_concurrency=2, user_quota=100_000,
+                   guild_quota=1_000_000, quota_period=100)
+    return Scheduler(**{**options, **kwargs})
+
+
+def test_estimate_cost():
+    assert estimate_cost('summarize', 'gpt-3.5-turbo', 'x' * 400) == 4100
+    assert estimate_cost('sql-agent', 'gpt-4', '') == 6 * 1500 * 20
+    assert estimate_cost('help', 'gpt-4', 'anything') == 0
+
+
+def test_token_buckets_refill_over_the_period(clock):
+    buckets = TokenBuckets(capacity=100, period=10)
+    buckets.take('u', 80)
+    assert buckets.level('u') == 20
+    assert buckets.wait_time('u', 50) == 3
+    clock[0] += 3
+    assert buckets.level('u') == 50
+    buckets.give('u', 80)
+    assert buckets.level('u') == 100
+    # Costs above capacity need a full bucket, and take all of it
+    assert buckets.wait_time('u', 500) == 0
+
+
+def test_admit_charges_user_and_guild_until_out_of_quota(clock):
+    s = make_scheduler(guild_quota=10_000)
+    ticket = s.admit('summarize', 'gpt-3.5-turbo', '', 'u1', 'g1')
+    assert (ticket.cost, ticket.heavy) == (4000, False)
+    assert s.users.level('u1') == 96_000 and s.guilds.level('g1') == 6000
+
+    s.admit('summarize', 'gpt-3.5-turbo', '', 'u2', 'g1')
+    with pytest.raises(Rejected, match='This server has used up the quota'):
+        s.admit('summarize', 'gpt-3.5-turbo', '', 'u3', 'g1')
+    assert s.users.level('u3') == 100_000  # Nothing is charged for a rejected request
+
+    s.admit('summarize', 'gpt-3.5-turbo', '', 'u3', None)  # Direct messages have no guild quota
+    with pytest.raises(Rejected, match='You have used up the quota'):
+        s.admit('sql-agent', 'gpt-4', '', 'u1', None)
+
+
+def test_rejection_rounds_the_wait_up(clock):
+    s = make_scheduler(user_quota=10_000, quota_period=3600)
+    s.admit('summarize', 'gpt-3.5-turbo', '', 'u1', None)
+    s.admit('summarize', 'gpt-3.5-turbo', '', 'u1', None)
+    clock[0] += 3600 * 1990 / 10_000  # 10 tokens short of the next request
+    with pytest.raises(Rejected, match='try again in 4 seconds,'):
+        s.admit('summarize', 'gpt-3.5-turbo', '', 'u1', None)
+
+
+def test_format_wait():
+    assert [format_wait(seconds) for seconds in (0.2, 1, 59.5, 60, 61, 3600)] == \
+        ['1 second', '1 second', '1 minute', '1 minute', '2 minutes', '60 minutes']
+
+
+def test_gateway_slots_scale_with_workers():
+    assert worker_slots(1, 8) == (8, 4)
+    assert worker_slots(4, 8) == (32, 16)
+    assert worker_slots(1, 1) == (1, 1)
+
+
+def test_refund_is_given_once(clock):
+    s = make_scheduler()
+    ticket = s.admit('sql', 'gpt-3.5-turbo', '', 'u1', 'g1')
+    s.refund(ticket)
+    s.refund(ticket)
+    assert s.users.level('u1') == 100_000 and s.guilds.level('g1') == 1_000_000
+
+
+async def hold(s: Scheduler, ticket, started: list, release: asyncio.Event):
+    async with s.slot(ticket):
+        started.append(ticket.seq)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_cheap_requests_go_first_and_heavy_ones_are_capped(clock):
+    async def main():
+        s = make_scheduler(slots=3, user_quota=10_000_000)
+        release, started = asyncio.Event(), []
+        heavy = [s.admit('sql-agent', 'gpt-3.5-turbo', '', f'u{i}', None) for i in range(2)]
+        cheap = s.admit('sql', 'gpt-3.5-turbo', '', 'u9', None)
+        tasks = [asyncio.ensure_future(hold(s, ticket, started, release)) for ticket in heavy + [cheap]]
+        await settle()
+        # Only one heavy slot, so the second heavy request waits although a slot is free
+        assert started == [heavy[0].seq, cheap.seq]
+        assert s.stats() == {'waiting': 1, 'running': 2, 'running_heavy': 1}
+        release.set()
+        await asyncio.gather(*tasks)
+        return s, started
+
+    s, started = asyncio.run(main())
+    assert len(started) == 3 and s.stats() == {'waiting': 0, 'running': 0, 'running_heavy': 0}
+
+
+def test_freed_slots_go_to_users_with_fewer_running_requests(clock):
+    async def main():
+        s = make_scheduler(slots=2, user_quota=10_000_000)
+        started = []
+        first, second = asyncio.Event(), asyncio.Event()
+        spammer = [s.admit('sql', 'gpt-3.5-turbo', '', 'spammer', None) for _ in range(3)]
+        other = s.admit('sql', 'gpt-3.5-turbo', '', 'other', None)
+        tasks = [asyncio.ensure_future(hold(s, spammer[0], started, first)),
+                 asyncio.ensure_future(hold(s, spammer[1], started, second)),
+                 asyncio.ensure_future(hold(s, spammer[2], started, second))]
+        await settle()
+        tasks.append(asyncio.ensure_future(hold(s, other, started, second)))
+        await settle()
+        assert started == [spammer[0].seq, spammer[1].seq]
+        first.set()
+        await settle()
+        # The spammer's third request arrived first, but they still run one request
+        assert started[-1] == other.seq
+        second.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert len(asyncio.run(main())) == 4
+
+
+def test_user_concurrency_is_limited(clock):
+    async def main():
+        s = make_scheduler(slots=4, user_concurrency=1, user_quota=10_000_000)
+        release, started = asyncio.Event(), []
+        tickets = [s.admit('sql', 'gpt-3.5-turbo', '', 'u1', None) for _ in range(2)]
+        tasks = [asyncio.ensure_future(hold(s, ticket, started, release)) for ticket in tickets]
+        await settle()
+        assert started == [tickets[0].seq] and s.stats()['waiting'] == 1
+        release.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert len(asyncio.run(main())) == 2
+
+
+def test_cancelled_while_waiting_is_refunded(clock):
+    async def main():
+        s = make_scheduler(slots=1)
+        release, started = asyncio.Event(), []
+        running = s.admit('sql', 'gpt-3.5-turbo', '', 'u1', 'g1')
+        waiting = s.admit('sql', 'gpt-3.5-turbo', '', 'u2', 'g1')
+        holder = asyncio.ensure_future(hold(s, running, started, release))
+        waiter = asyncio.ensure_future(hold(s, waiting, started, release))
+        await settle()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert waiting.refunded and not running.refunded
+        assert s.users.level('u2') == 100_000 and s.stats()['waiting'] == 0
+        release.set()
+        await holder
+        return s
+
+    s = asyncio.run(main())
+    assert s.stats() == {'waiting': 0, 'running': 0, 'running_heavy': 0}
+
+
+def test_failed_requests_are_refunded_and_release_their_slot(clock):
+    async def fail(s, ticket):
+        async with s.slot(ticket):
+            raise RuntimeError('LLM call failed')
+
+    async def succeed(s, ticket):
+        async with s.slot(ticket):
+            pass
+
+    async def main():
+        s = make_scheduler(slots=1)
+        failed = s.admit('sql', 'gpt-3.5-turbo', '', 'u1', None)
+        done = s.admit('sql', 'gpt-3.5-turbo', '', 'u2', None)
+        with pytest.raises(RuntimeError):
+            await fail(s, failed)
+        await succeed(s, done)
+        return s, failed, done
+
+    s, failed, done = asyncio.run(main())
+    assert failed.refunded and s.users.level('u1') == 100_000
+    assert not done.refunded and s.users.level('u2') == 97_000
+    assert s.stats() == {'waiting': 0, 'running': 0, 'running_heavy': 0}
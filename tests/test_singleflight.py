@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from response_cache import normalize_url
+from singleflight import SingleFlight, flight_key
+
+
+def test_flight_key_normalizes_input():
+    assert flight_key('summarize', 'gpt-4', 0.0, '  Some  URL ') == flight_key('summarize', 'gpt-4', 0, 'some url')
+    assert flight_key('summarize', 'gpt-4', 0.0, 'a') != flight_key('eli5', 'gpt-4', 0.0, 'a')
+
+
+def test_flight_key_normalizes_urls():
+    assert flight_key('summarize', 'gpt-4', 0.0, 'HTTPS://Example.com:443/a?utm_source=x&b=2&a=1#top', normalize_url) == \
+        flight_key('summarize', 'gpt-4', 0.0, 'https://example.com/a?a=1&b=2', normalize_url)
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def main():
+        flights = SingleFlight()
+        key = ('sql', 'books')
+        first = asyncio.ensure_future(flights.run(key, compute, 21))
+        await asyncio.sleep(0)
+        assert flights.in_flight(key)
+        results = await asyncio.gather(first, flights.run(key, compute, 21))
+        assert not flights.in_flight(key)
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert results == [42, 42] and calls == [21]
+    assert flights.stats() == {'leaders': 1, 'followers': 1, 'in_flight': 0}
+
+
+def test_call_finishes_for_followers_when_the_leader_is_cancelled():
+    async def compute():
+        await asyncio.sleep(0.01)
+        return 'done'
+
+    async def main():
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.run(('search', 'q'), compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run(('search', 'q'), compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == 'done'
+
+
+def test_errors_reach_every_caller():
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError('bad query')
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.run(('sql', 'q'), compute), flights.run(('sql', 'q'), compute),
+                                       return_exceptions=True)
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert not flights.in_flight(('sql', 'q'))
+
+
+def test_late_subscriber_gets_the_tokens_so_far():
+    started = []
+
+    async def generate():
+        started.append(True)
+        for token in ['a', 'b', 'c']:
+            yield token
+            await asyncio.sleep(0.01)
+
+    async def collect(stream, received):
+        async for token in stream:
+            received.append(token)
+
+    async def main():
+        flights = SingleFlight()
+        key = ('summarize', 'url')
+        first, second = [], []
+        leader = asyncio.ensure_future(collect(flights.stream(key, generate), first))
+        await asyncio.sleep(0.015)
+        assert flights.in_flight(key)
+        await asyncio.gather(leader, collect(flights.stream(key, generate), second))
+        assert not flights.in_flight(key)
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == second == ['a', 'b', 'c'] and started == [True]
+
+
+def test_stream_error_is_raised_to_subscribers_after_its_tokens():
+    async def generate():
+        yield 'partial'
+        await asyncio.sleep(0.01)
+        raise RuntimeError('stream broke')
+
+    async def collect(stream):
+        received = []
+        with pytest.raises(RuntimeError, match='stream broke'):
+            async for token in stream:
+                received.append(token)
+        return received
+
+    async def main():
+        flights = SingleFlight()
+        key = ('eli5', 'url')
+        return await asyncio.gather(collect(flights.stream(key, generate)), collect(flights.stream(key, generate)))
+
+    assert asyncio.run(main()) == [['partial'], ['partial']]
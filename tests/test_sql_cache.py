@@ -0,0 +1,131 @@
+import sqlite3
+
+import pytest
+from langchain.llms.fake import FakeListLLM
+
+from books_db import BooksDB
+from sql import OneStepSQL
+from sql_cache import SQLCache, parameterize
+
+
+@pytest.fixture
+def books(tmp_path):
+    path = str(tmp_path / 'books.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE books (title TEXT, author TEXT, rating REAL, ratings INTEGER)')
+    conn.executemany('INSERT INTO books VALUES (?, ?, ?, ?)', [
+        ('Coraline', 'Neil Gaiman', 4.1, 500),
+        ('Stardust', 'Neil Gaiman', 3.9, 80),
+        ('It', 'Stephen King', 4.2, 900),
+        ("Ender's Game", 'Orson Scott Card', 4.3, 1200),
+        ("Speaker's Game", 'Someone Else', 3.5, 10),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path, books):
+    return SQLCache(str(tmp_path / 'sql_cache.db'), books)
+
+
+def query(books, sql, params):
+    conn = sqlite3.connect(books)
+    try:
+        return [row[0] for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def test_literals_in_the_question_become_parameters():
+    prepared = parameterize('Books by Stephen King rated above 3?',
+                            "SELECT title FROM books WHERE author = 'Stephen King' AND rating > 3")
+    assert prepared.sql == 'SELECT title FROM books WHERE author = ? AND rating > ?'
+    assert prepared.pattern == r'books\ by\ (\S+(?:\ \S+){0,1})\ rated\ above\ (\d+(?:\.\d+)?)'
+
+
+def test_literal_not_in_the_question_stays_in_the_statement():
+    prepared = parameterize('books by stephen king', "SELECT title FROM books WHERE author = 'Stephen King' "
+                                                     "AND rating > 4")
+    assert prepared.sql == 'SELECT title FROM books WHERE author = ? AND rating > 4'
+
+
+def test_repeated_literal_is_not_parameterized():
+    sql = "SELECT title FROM books WHERE author = 'Neil Gaiman' OR title LIKE 'Neil Gaiman'"
+    prepared = parameterize('books by neil gaiman', sql)
+    assert (prepared.sql, prepared.params) == (sql, [])
+    assert prepared.pattern == r'books\ by\ neil\ gaiman'
+
+
+def test_quoted_string_containing_quotes():
+    prepared = parameterize("books titled Ender's Game", "SELECT author FROM books WHERE title = 'Ender''s Game'")
+    assert prepared.sql == 'SELECT author FROM books WHERE title = ?'
+    assert prepared.params == [[1, '', '', False]]
+
+
+def test_like_wildcards_are_kept_around_the_parameter():
+    prepared = parameterize('books with game in the title', "SELECT title FROM books WHERE title LIKE '%Game%'")
+    assert prepared.sql == 'SELECT title FROM books WHERE title LIKE ?'
+    assert prepared.params == [[1, '%', '%', False]]
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT title FROM books WHERE ratings < 100 ORDER BY rating DESC LIMIT 100',
+    'SELECT title FROM books WHERE ratings < 100 ORDER BY rating DESC LIMIT 10 OFFSET 100',
+    'SELECT title FROM books WHERE ratings < 100 ORDER BY rating DESC LIMIT 100, 10',
+])
+def test_limit_and_offset_are_never_parameterized(sql):
+    prepared = parameterize('books with fewer than 100 ratings', sql)
+    assert prepared.sql == sql.replace('ratings < 100', 'ratings < ?', 1)
+    assert prepared.params == [[1, '', '', True]]
+
+
+def test_cache_hit_binds_the_new_question_values(cache, books):
+    cache.set_query('Books by Stephen King rated above 3',
+                    "SELECT title FROM books WHERE author = 'Stephen King' AND rating > 3 ORDER BY title LIMIT 3")
+
+    sql, params = cache.get_query('books by Neil Gaiman rated above 4?')
+    assert params == ('Neil Gaiman', 4)
+    assert query(books, sql, params) == ['Coraline']
+    assert cache.get_query('books by Neil Gaiman') is None
+    assert cache.stats()['query_hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_longer_question_does_not_match_a_shorter_template(cache):
+    cache.set_query('how many books by Stephen King', "SELECT COUNT(*) FROM books WHERE author LIKE '%Stephen King%'")
+
+    assert cache.get_query('how many books by Stephen King are in english') is None
+    assert cache.get_query('how many books by Neil Gaiman')[1] == ('%Neil Gaiman%',)
+
+
+def test_variant_of_an_aggregate_that_finds_nothing_is_a_miss(cache, books):
+    cache.set_query('how many books by Stephen King', "SELECT COUNT(*) FROM books WHERE author LIKE '%Stephen King%'")
+    cache.set_query('average rating of books by Stephen King',
+                    "SELECT AVG(rating) FROM books WHERE author LIKE '%Stephen King%'")
+    one_step = OneStepSQL(FakeListLLM(responses=['unused']), BooksDB(books), cache)
+
+    assert one_step.run_cached_query('how many books by Neil Gaiman')[1].rows == [(2,)]
+    # Matches the template, but COUNT and AVG return a row of 0 or NULL for an unknown author
+    assert one_step.run_cached_query('how many books by Tolkien') is None
+    assert one_step.run_cached_query('average rating of books by Tolkien') is None
+    # The cached question itself is served as is
+    assert one_step.run_cached_query('how many books by Stephen King')[1].rows == [(1,)]
+
+
+def test_cache_hit_binds_values_containing_quotes(cache, books):
+    cache.set_query("who wrote Ender's Game", "SELECT author FROM books WHERE title = 'Ender''s Game'")
+
+    sql, params = cache.get_query("Who wrote Speaker's Game")
+    assert params == ("Speaker's Game",)
+    assert query(books, sql, params) == ['Someone Else']
+
+
+def test_queries_are_dropped_when_the_database_changes(cache, books):
+    cache.set_query('books by stephen king', "SELECT title FROM books WHERE author = 'Stephen King'")
+    conn = sqlite3.connect(books)
+    conn.execute("INSERT INTO books VALUES ('Misery', 'Stephen King', 4.2, 700)")
+    conn.commit()
+    conn.close()
+
+    assert cache.get_query('books by neil gaiman') is None
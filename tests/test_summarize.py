@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import summarize
+from summarize import (MAP_HUMAN_MSG, MAP_SYSTEM_MSG, acondense,
+                       group_by_tokens, reduce_budget)
+from tokenization import TokenizedText, get_encoding, num_tokens
+
+MODEL = 'gpt-3.5-turbo'
+MAX_TOKENS = 1000
+
+# tiktoken downloads the encoding on first use, which fails offline
+try:
+    get_encoding(MODEL)
+except Exception as e:
+    pytest.skip(f'Cannot load the {MODEL} tokenizer: {e}', allow_module_level=True)
+
+
+@pytest.fixture(autouse=True)
+def small_model(monkeypatch):
+    monkeypatch.setitem(summarize.SUMMARY_MAX_TOKENS_DICT, MODEL, MAX_TOKENS)
+    monkeypatch.setattr(summarize, 'SUMMARY_CHUNK_TOKENS', 500)
+    monkeypatch.setattr(summarize, 'SUMMARY_CHUNK_OVERLAP', 0)
+
+
+def test_group_by_tokens_counts_the_joining_newlines():
+    texts = [' x' * 10] * 4
+    assert [len(group) for group in group_by_tokens(texts, 22, MODEL)] == [2, 2]
+    assert [len(group) for group in group_by_tokens(texts, 21, MODEL)] == [1, 1, 1, 1]
+
+
+def test_reduce_rounds_fit_the_model_context(monkeypatch):
+    calls = []
+
+    async def complete(system_msg, human_msg, text, temperature, model, max_tokens):
+        prompt_tokens = num_tokens(system_msg, model) + num_tokens(human_msg.format(text=text), model)
+        calls.append(prompt_tokens + max_tokens)
+        return ' x' * max_tokens  # Summaries as long as allowed
+
+    monkeypatch.setattr(summarize, 'acomplete', complete)
+    text = TokenizedText(' word' * 20 * 500, MODEL)
+    condensed = asyncio.run(acondense(text, 0.0, MODEL))
+
+    # 20 sections, then groups of 2 summaries: more than 10 reduce calls take a second round
+    assert len(calls) > 20 + 10
+    assert max(calls) <= MAX_TOKENS
+    assert num_tokens(condensed, MODEL) <= MAX_TOKENS
+
+
+def test_reduce_budget_leaves_room_for_the_prompt_and_summary():
+    overhead = num_tokens(MAP_SYSTEM_MSG, MODEL) + num_tokens(MAP_HUMAN_MSG.format(text=''), MODEL)
+    assert reduce_budget(MODEL) == MAX_TOKENS - overhead - summarize.SUMMARY_MAP_MAX_TOKENS
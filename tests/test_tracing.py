@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import pytest
+from prometheus_client.core import REGISTRY
+
+import tracing
+from tracing import (current_span, end_span, register_cache, register_pools, span,
+                     start_span, trace)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_spans_nest_under_the_request():
+    with trace('test-nest', 'model-a') as root:
+        with span('fetch') as fetch:
+            with span('parse') as parse:
+                assert current_span() is parse
+        assert current_span() is root
+    assert current_span() is None
+
+    assert fetch.parent_id == root.span_id and parse.parent_id == fetch.span_id
+    assert {fetch.trace_id, parse.trace_id} == {root.trace_id}
+    assert {fetch.command, parse.command} == {'test-nest'}
+
+
+def test_span_is_carried_into_threads():
+    async def handler():
+        with trace('test-thread') as root:
+            child = await asyncio.to_thread(lambda: start_span('query'))
+        return root, child
+
+    root, child = asyncio.run(handler())
+    assert child.parent_id == root.span_id and child.command == 'test-thread'
+
+
+def test_latencies_and_errors_are_observed():
+    before = sample('gpt_request_seconds_count', command='test-metrics', model='model-b')
+    stage_before = sample('gpt_stage_seconds_count', stage='llm', command='test-metrics')
+    errors_before = sample('gpt_errors_total', stage='llm', command='test-metrics')
+
+    with pytest.raises(RuntimeError):
+        with trace('test-metrics', 'model-b'):
+            with span('llm') as llm:
+                raise RuntimeError('boom')
+
+    assert llm.error == repr(RuntimeError('boom'))
+    assert sample('gpt_request_seconds_count', command='test-metrics', model='model-b') == before + 1
+    assert sample('gpt_stage_seconds_count', stage='llm', command='test-metrics') == stage_before + 1
+    assert sample('gpt_errors_total', stage='llm', command='test-metrics') == errors_before + 1
+
+
+def test_spans_are_exported_as_json_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_export_file', None)
+    path = tmp_path / 'spans.jsonl'
+    finished = start_span('search', query='books')
+    try:
+        end_span(finished, duration=0.5)
+        tracing.export(finished, str(path))
+    finally:
+        if tracing._export_file is not None:
+            tracing._export_file.close()
+
+    exported = json.loads(path.read_text().splitlines()[0])
+    assert exported['name'] == 'search' and exported['duration'] == 0.5
+    assert exported['attributes'] == {'query': 'books'}
+
+
+def test_cache_hit_ratio_counts_every_kind_of_hit(monkeypatch):
+    monkeypatch.setattr(tracing.CACHES, 'caches', {})
+    register_cache('test-cache', lambda: {'exact_hits': 3, 'semantic_hits': 1, 'misses': 4})
+    register_cache('test-broken', lambda: 1 / 0)
+
+    assert sample('gpt_cache_lookups', cache='test-cache', result='hit') == 4
+    assert sample('gpt_cache_hit_ratio', cache='test-cache') == 0.5
+    assert REGISTRY.get_sample_value('gpt_cache_hit_ratio', {'cache': 'test-broken'}) is None
+
+
+def test_pool_utilization_is_reported(monkeypatch):
+    monkeypatch.setattr(tracing.POOLS, 'stats', None)
+    register_pools(lambda: {'requests': 7, 'retries_429': 1,
+                            'pools': {'https://api.openai.com': {'opened': 2, 'requests': 5, 'idle': 2}},
+                            'aiohttp': {'in_use': 3, 'idle': 1, 'limit': 100}})
+
+    assert sample('gpt_http_connections', client='requests', host='https://api.openai.com', state='idle') == 2
+    assert sample('gpt_http_connections', client='aiohttp', host='', state='in_use') == 3
+    assert sample('gpt_http_connection_limit') == 100
+    assert sample('gpt_http_requests_total', kind='retries_429') == 1
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from vectorstore import LocalVectorStore
+
+
+class NoEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        raise NotImplementedError
+
+    def embed_query(self, text):
+        raise NotImplementedError
+
+
+VECTORS = np.eye(4, dtype=np.float32)
+
+
+@pytest.mark.parametrize('quantized', [False, True])
+def test_save_and_load_round_trip(tmp_path, quantized):
+    store = LocalVectorStore(NoEmbeddings(), 4, search='flat', quantized=quantized)
+    store.add_embeddings(['a', 'b', 'c'], VECTORS[:3], [{'source': 'x'}] * 3, ids=['1', '2', '3'])
+    # Embedded again, e.g. after an interrupted ingest: replaces the row instead of duplicating it
+    store.add_embeddings(['b again'], VECTORS[3:], [{'source': 'y'}], ids=['2'])
+    store.save(str(tmp_path))
+
+    loaded = LocalVectorStore.load(str(tmp_path), NoEmbeddings(), search='flat')
+    assert (loaded.ids, loaded.texts) == (['1', '3', '2'], ['a', 'c', 'b again'])
+    assert loaded.metadatas[2] == {'source': 'y'}
+    assert loaded.quantized == quantized
+    assert [doc.page_content for doc in loaded.similarity_search_by_vector(VECTORS[3].tolist(), k=1)] == ['b again']
+    assert sorted(os.listdir(tmp_path)) == sorted(['docs.jsonl', 'meta.json', 'vectors.npy']
+                                                  + (['scales.npy'] if quantized else []))
+
+
+def test_save_leaves_memory_mapped_readers_intact(tmp_path):
+    store = LocalVectorStore(NoEmbeddings(), 4, search='flat')
+    store.add_embeddings(['a', 'b'], VECTORS[:2], ids=['1', '2'])
+    store.save(str(tmp_path))
+    reader = LocalVectorStore.load(str(tmp_path), NoEmbeddings(), search='flat')
+
+    store.add_embeddings(['c', 'd'], VECTORS[2:], ids=['3', '4'])
+    store.save(str(tmp_path))
+    assert np.array_equal(reader.vectors, VECTORS[:2])
+    assert len(LocalVectorStore.load(str(tmp_path), NoEmbeddings(), search='flat')) == 4
+
+
+def test_save_drops_an_ivf_index_the_store_no_longer_has(tmp_path):
+    store = LocalVectorStore(NoEmbeddings(), 4, search='ivf')
+    store.add_embeddings(['a', 'b', 'c', 'd'], VECTORS, ids=['1', '2', '3', '4'])
+    store.build_ivf(n_clusters=2)
+    store.save(str(tmp_path))
+    assert LocalVectorStore.load(str(tmp_path), NoEmbeddings()).centroids is not None
+
+    rebuilt = LocalVectorStore(NoEmbeddings(), 4, search='ivf')
+    rebuilt.add_embeddings(['a'], VECTORS[:1], ids=['1'])
+    rebuilt.save(str(tmp_path))
+    assert LocalVectorStore.load(str(tmp_path), NoEmbeddings()).centroids is None
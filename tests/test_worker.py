@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import worker
+from http_client import close_sessions
+from jobqueue import JobQueue
+from worker import Worker, resolve
+
+
+def count_books(author):
+    return f'3 books by {author}'
+
+
+async def generate(fail_after=None):
+    for i, token in enumerate(['Once', ' upon', ' a time']):
+        if i == fail_after:
+            raise RuntimeError('stream broke')
+        yield token
+        await asyncio.sleep(0)
+
+
+FUNCTIONS = {'count_books': count_books, 'generate': generate}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.db'), lease=60, max_attempts=3, retry_delay=0)
+
+
+@pytest.fixture(autouse=True)
+def functions(monkeypatch):
+    monkeypatch.setattr(worker, 'resolve', lambda job: FUNCTIONS[job.payload['function']])
+    monkeypatch.setattr(worker, 'JOB_PROGRESS_INTERVAL', 0)  # Publish every token
+
+
+def submit(queue, command, function, *args, **kwargs):
+    return queue.submit(command, {'module': 'test', 'function': function, 'args': list(args), 'kwargs': kwargs})
+
+
+def execute(queue, job_id):
+    runner = Worker(queue, concurrency=1)
+    job = queue.claim(runner.name)
+    assert job.id == job_id
+
+    async def main():
+        try:
+            await runner.execute(job)
+        finally:
+            runner.dispatcher.shutdown()
+            await close_sessions()
+
+    asyncio.run(main())
+    return queue.get([job_id])[job_id]
+
+
+def test_resolve_only_allows_job_functions(queue):
+    submit(queue, 'sql', 'system')
+    job = queue.claim('w1')
+    job.payload['module'] = 'os'
+    with pytest.raises(ValueError, match='Jobs cannot run os.system'):
+        resolve(job)
+
+
+def test_blocking_job_is_acked_with_its_result(queue):
+    job = execute(queue, submit(queue, 'sql', 'count_books', 'neil gaiman'))
+    assert (job.status, job.result) == ('done', '3 books by neil gaiman')
+
+
+def test_streamed_job_publishes_progress(queue):
+    job = execute(queue, submit(queue, 'summarize', 'generate'))
+    assert (job.status, job.result, job.progress) == ('done', 'Once upon a time', 'Once upon a time')
+
+
+def test_streamed_job_is_not_retried_after_publishing(queue):
+    job = execute(queue, submit(queue, 'summarize', 'generate', fail_after=2))
+    assert (job.status, job.error, job.progress) == ('failed', 'stream broke', 'Once upon')
+
+
+def test_streamed_job_is_retried_if_it_published_nothing(queue):
+    job = execute(queue, submit(queue, 'summarize', 'generate', fail_after=0))
+    assert (job.status, job.attempts, job.progress) == ('queued', 1, '')
+
+
+def test_run_takes_jobs_until_stopped(queue, monkeypatch):
+    monkeypatch.setattr(worker, 'JOB_POLL_INTERVAL', 0.001)
+    job_ids = [submit(queue, 'sql', 'count_books', author) for author in ('a', 'b', 'c')]
+
+    async def main():
+        runner = Worker(queue, concurrency=2)
+        running = asyncio.create_task(runner.run())
+        while queue.stats() != {'done': 3}:
+            await asyncio.sleep(0.001)
+        runner.stop()
+        await running
+
+    asyncio.run(main())
+    jobs = queue.get(job_ids)
+    assert [jobs[job_id].result for job_id in job_ids] == ['3 books by a', '3 books by b', '3 books by c']
@@ -0,0 +1,71 @@
+"""
+Tokenization shared by the summarization and Q&A paths.
+
+Encodings are loaded once per process. A page is encoded once into a TokenizedText, whose token
+ids are then reused for counting, trimming and splitting instead of re-encoding.
+"""
+from functools import lru_cache
+from typing import List
+
+import tiktoken
+
+from config import SUMMARY_MODEL, TOKENIZER_DICT
+
+
+# Get the tokenizer for a model
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Load the model's encoding once per process.
+    """
+    return tiktoken.get_encoding(TOKENIZER_DICT[model])
+
+
+# Count the number of tokens in text
+def num_tokens(text: str, model: str = SUMMARY_MODEL) -> int:
+    """
+    Count the number of tokens in text.
+    """
+    return len(get_encoding(model).encode(text))
+
+
+class TokenizedText:
+    """
+    Text together with its token ids, encoded once.
+    """
+
+    def __init__(self, text: str, model: str = SUMMARY_MODEL, tokens: List[int] = None):
+        self.text = text
+        self.model = model
+        self.tokens = tokens if tokens is not None else get_encoding(model).encode(text)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def slice(self, start: int, end: int) -> str:
+        """
+        Text of tokens[start:end], decoded from the ids rather than re-encoded from text.
+        """
+        # Tokens can end inside a multi-byte character; drop the partial character
+        return get_encoding(self.model).decode_bytes(self.tokens[start:end]).decode('utf-8', errors='ignore')
+
+    def trim(self, max_tokens: int) -> 'TokenizedText':
+        """
+        The first max_tokens tokens, without re-encoding.
+        """
+        if len(self.tokens) <= max_tokens:
+            return self
+        return TokenizedText(self.slice(0, max_tokens), self.model, self.tokens[:max_tokens])
+
+    def split(self, chunk_size: int, chunk_overlap: int = 0) -> List['TokenizedText']:
+        """
+        Windows of chunk_size tokens overlapping by chunk_overlap, like LangChain's TokenTextSplitter.
+        """
+        chunks, start = [], 0
+        while start < len(self.tokens):
+            end = min(start + chunk_size, len(self.tokens))
+            chunks.append(TokenizedText(self.slice(start, end), self.model, self.tokens[start:end]))
+            if end == len(self.tokens):
+                break
+            start += chunk_size - chunk_overlap
+        return chunks
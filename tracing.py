@@ -0,0 +1,341 @@
+"""
+Per-request tracing and Prometheus metrics.
+
+A span times one stage of a request: fetch, parse, tokenize, retrieve, embed, llm, query, search,
+or discord.send. The current span is held in a context variable, so stages nest under the
+request that started them. It is also carried across awaits, and into threads started with
+asyncio.to_thread or the Dispatcher. Finished spans feed the latency histograms. If
+TRACE_EXPORT_PATH is set, they are also appended to it as JSON lines.
+
+start_metrics_server serves /metrics with request and stage latencies by command and model, token
+counts per model, errors, queue depth and wait, rejected and coalesced requests, cache
+hit rates, and connection pool utilization of the shared HTTP clients.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache, wraps
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import (REGISTRY, CounterMetricFamily,
+                                     GaugeMetricFamily)
+
+from config import (DEFAULT_MODEL, METRICS_ADDR, METRICS_PORT,
+                    TRACE_EXPORT_PATH)
+from logger import logger
+
+# Seconds; LLM calls and page fetches take up to a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram('gpt_request_seconds', 'Latency of a command, from receiving it to the last message',
+                            ['command', 'model'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('gpt_stage_seconds', 'Latency of a stage within a command', ['stage', 'command'],
+                          buckets=LATENCY_BUCKETS)
+ERRORS = Counter('gpt_errors_total', 'Stages and commands that raised', ['stage', 'command'])
+LLM_TOKENS = Counter('gpt_llm_tokens_total', 'Tokens sent to and generated by the model', ['model', 'kind'])
+QUEUE_DEPTH = Gauge('gpt_queue_depth', 'Requests waiting for a concurrency slot', ['command'])
+RUNNING = Gauge('gpt_running', 'Requests running on the worker pool', ['command'])
+QUEUE_WAIT = Histogram('gpt_queue_wait_seconds', 'Time a request waited for a scheduler slot', ['command'],
+                       buckets=LATENCY_BUCKETS)
+REJECTED = Counter('gpt_rejected_total', 'Requests turned down for being over quota', ['command', 'quota'])
+COALESCED = Counter('gpt_coalesced_total', 'Requests that joined an identical request in flight', ['command'])
+
+
+@dataclass
+class Span:
+    name: str
+    command: str
+    trace_id: str
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    duration: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        """
+        Add attributes, e.g. sizes or token counts known only once the stage ran.
+        """
+        self.attributes.update(attributes)
+
+
+_current: ContextVar[Optional[Span]] = ContextVar('span', default=None)
+_export_lock = threading.Lock()
+_export_file = None
+
+
+# Get the span of the running stage
+def current_span() -> Optional[Span]:
+    """
+    The innermost open span in this context, if any.
+    """
+    return _current.get()
+
+
+# Open a span without making it current, for stages that don't nest others
+def start_span(name: str, **attributes) -> Span:
+    """
+    Child of the current span, or a new trace outside of a request.
+    """
+    parent = _current.get()
+    if parent is None:
+        return Span(name, command='none', trace_id=uuid.uuid4().hex, attributes=attributes)
+    return Span(name, command=parent.command, trace_id=parent.trace_id, parent_id=parent.span_id,
+                attributes=attributes)
+
+
+# Close a span opened with start_span
+def end_span(span: Span, error: BaseException = None, duration: float = None):
+    """
+    Record the span's duration, observe it and export it.
+    """
+    span.duration = time.time() - span.start if duration is None else duration
+    if error is not None:
+        span.error = repr(error)
+        ERRORS.labels(span.name, span.command).inc()
+    if span.parent_id is None and span.name == 'request':
+        REQUEST_LATENCY.labels(span.command, span.attributes.get('model', '')).observe(span.duration)
+    else:
+        STAGE_LATENCY.labels(span.name, span.command).observe(span.duration)
+    export(span)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """
+    Time the enclosed block as a child of the current span. Spans opened inside it become its children.
+    """
+    current = start_span(name, **attributes)
+    token = _current.set(current)
+    start = perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(token)
+        end_span(current, error, perf_counter() - start)
+
+
+@contextmanager
+def trace(command: str, model: str = DEFAULT_MODEL, **attributes) -> Iterator[Span]:
+    """
+    Root span of a request for command.
+    """
+    root = Span('request', command=command, trace_id=uuid.uuid4().hex, attributes={'model': model, **attributes})
+    token = _current.set(root)
+    start = perf_counter()
+    error = None
+    try:
+        yield root
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(token)
+        end_span(root, error, perf_counter() - start)
+
+
+# Record a stage whose time was accumulated piecemeal, like parsing interleaved with a download
+def record(name: str, duration: float, **attributes):
+    """
+    Record a finished child span of the current span.
+    """
+    end_span(start_span(name, **attributes), duration=duration)
+
+
+# Decorator tracing a blocking function as a stage
+def traced(name: str) -> Callable:
+    """
+    Run the decorated function in a span.
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Decorator tracing a Discord command handler as a request
+def traced_command(command: str) -> Callable:
+    """
+    Run the decorated handler in a request span, labeled with its model option.
+    """
+    def decorator(coro: Callable) -> Callable:
+        @wraps(coro)
+        async def wrapper(*args, **kwargs):
+            with trace(command, kwargs.get('model', DEFAULT_MODEL)):
+                return await coro(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Count the tokens of an LLM call
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int, current: Span = None):
+    """
+    Add token counts to the metrics and to the LLM call's span.
+    """
+    LLM_TOKENS.labels(model, 'prompt').inc(prompt_tokens)
+    LLM_TOKENS.labels(model, 'completion').inc(completion_tokens)
+    if current is not None:
+        current.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+# Append a finished span to the export file
+def export(finished: Span, path: Optional[str] = TRACE_EXPORT_PATH):
+    """
+    Write the span as a JSON line, if export is enabled.
+    """
+    global _export_file
+    if not path:
+        return
+    with _export_lock:
+        if _export_file is None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            _export_file = open(path, 'a', encoding='utf-8')
+        _export_file.write(json.dumps(asdict(finished), default=str) + '\n')
+        _export_file.flush()
+
+
+class CacheCollector:
+    """
+    Reports the hit rate of every registered cache when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self.caches: Dict[str, Callable[[], Dict[str, int]]] = {}
+
+    def collect(self):
+        lookups = GaugeMetricFamily('gpt_cache_lookups', 'Cache lookups since startup', labels=['cache', 'result'])
+        ratio = GaugeMetricFamily('gpt_cache_hit_ratio', 'Share of cache lookups that hit', labels=['cache'])
+        for name, stats in list(self.caches.items()):
+            try:
+                counters = stats()
+            except Exception as e:
+                logger.info(f'Skipping stats of {name}: {e}')
+                continue
+            # Caches count several kinds of hits, e.g. exact and semantic
+            hits = sum(value for key, value in counters.items() if key.endswith('hits'))
+            misses = counters.get('misses', 0)
+            lookups.add_metric([name, 'hit'], hits)
+            lookups.add_metric([name, 'miss'], misses)
+            ratio.add_metric([name], hits / (hits + misses) if hits + misses else 0.0)
+        yield lookups
+        yield ratio
+
+
+CACHES = CacheCollector()
+REGISTRY.register(CACHES)
+
+
+# Report a cache's hit rate on /metrics
+def register_cache(name: str, stats: Callable[[], Dict[str, int]]):
+    """
+    Register a cache by its stats function, which returns counters ending in 'hits' and 'misses'.
+    """
+    CACHES.caches[name] = stats
+
+
+class PoolCollector:
+    """
+    Reports connections and requests of the shared HTTP clients when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self.stats: Optional[Callable[[], Dict]] = None
+
+    def collect(self):
+        if self.stats is None:
+            return
+        try:
+            stats = self.stats()
+        except Exception as e:
+            logger.info(f'Skipping HTTP pool stats: {e}')
+            return
+        connections = GaugeMetricFamily('gpt_http_connections', 'Open connections of the shared HTTP clients',
+                                        labels=['client', 'host', 'state'])
+        limit = GaugeMetricFamily('gpt_http_connection_limit', 'Connections the aiohttp client opens at most')
+        requests = CounterMetricFamily('gpt_http_requests', 'HTTP requests and retries since startup',
+                                       labels=['kind'])
+        for host, pool in stats['pools'].items():
+            connections.add_metric(['requests', host, 'idle'], pool['idle'])
+        if stats['aiohttp']:
+            connections.add_metric(['aiohttp', '', 'in_use'], stats['aiohttp']['in_use'])
+            connections.add_metric(['aiohttp', '', 'idle'], stats['aiohttp']['idle'])
+            limit.add_metric([], stats['aiohttp']['limit'])
+        for kind, value in stats.items():
+            if kind not in ('pools', 'aiohttp'):
+                requests.add_metric([kind], value)
+        yield connections
+        yield limit
+        yield requests
+
+
+POOLS = PoolCollector()
+REGISTRY.register(POOLS)
+
+
+# Report the shared HTTP clients' pool utilization on /metrics
+def register_pools(stats: Callable[[], Dict]):
+    """
+    Register the stats function of the shared HTTP clients, see http_client.stats.
+    """
+    POOLS.stats = stats
+
+
+# Serve /metrics
+@lru_cache(maxsize=None)
+def start_metrics_server(port: Optional[int] = METRICS_PORT, addr: str = METRICS_ADDR):
+    """
+    Serve the metrics over HTTP on a background thread, once. A port of None disables it.
+    """
+    if port is None:
+        return
+    start_http_server(port, addr)
+    logger.info(f'Serving metrics on http://{addr}:{port}/metrics')
+
+
+# Report token usage of LangChain LLM calls
+@lru_cache(maxsize=None)
+def get_llm_callback():
+    """
+    LangChain callback handler that records each LLM call as a span with its token counts.
+    """
+    # Imported here since LangChain is slow to import, and tracing is imported at startup
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class LLMTracer(BaseCallbackHandler):
+        def __init__(self):
+            self.spans: Dict[Any, Span] = {}
+
+        def on_llm_start(self, serialized: Dict[str, Any], prompts, *, run_id, **kwargs):
+            model = (serialized.get('kwargs') or {}).get('model_name', '')
+            self.spans[run_id] = start_span('llm', model=model, prompts=len(prompts))
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            current = self.spans.pop(run_id, None)
+            if current is None:
+                return
+            usage = (response.llm_output or {}).get('token_usage') or {}
+            model = (response.llm_output or {}).get('model_name') or current.attributes['model']
+            record_tokens(model, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), current)
+            end_span(current)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            current = self.spans.pop(run_id, None)
+            if current is not None:
+                end_span(current, error)
+
+    return LLMTracer()
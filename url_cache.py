@@ -0,0 +1,171 @@
+"""
+Persistent cache of fetched pages and their extracted text, keyed by normalized url.
+
+Page bodies are stored once per content hash, so urls that resolve to the same content share an entry.
+The cache is cleared when the extractor version changes, since its stored text would be stale.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from config import URL_CACHE_MAX_BYTES, URL_CACHE_PATH, URL_CACHE_TTL
+from extract import EXTRACTOR_VERSION
+from logger import logger
+from response_cache import normalize_url
+
+
+@dataclass
+class CachedPage:
+    url: str
+    html: str
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+
+class UrlCache:
+    """
+    SQLite-backed page cache with TTL freshness, conditional GET validators and LRU eviction by size.
+    """
+
+    def __init__(self, path: str = URL_CACHE_PATH, ttl: float = URL_CACHE_TTL, max_bytes: int = URL_CACHE_MAX_BYTES,
+                 version: int = EXTRACTOR_VERSION):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                html BLOB NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                key TEXT PRIMARY KEY,
+                hash TEXT NOT NULL REFERENCES blobs(hash),
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS urls_accessed_at ON urls(accessed_at);
+        """)
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != version:
+            logger.info(f'Url cache extractor version changed, clearing {path}')
+            self._conn.execute('DELETE FROM urls')
+            self._conn.execute('DELETE FROM blobs')
+            self._conn.execute(f'PRAGMA user_version = {int(version)}')
+            self._conn.commit()
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        """
+        Get the cached page for url, fresh or stale. Only fresh pages count as hits.
+        """
+        key = normalize_url(url)
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT blobs.html, blobs.text, urls.etag, urls.last_modified, urls.fetched_at
+                FROM urls JOIN blobs ON urls.hash = blobs.hash WHERE urls.key = ?
+            """, (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE urls SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+
+        html, text, etag, last_modified, fetched_at = row
+        page = CachedPage(url=key, html=zlib.decompress(html).decode('utf-8'), text=text,
+                          etag=etag, last_modified=last_modified, fetched_at=fetched_at)
+        if page.is_fresh(self.ttl):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return page
+
+    def put(self, url: str, html: str, text: str, etag: str = None, last_modified: str = None,
+            status: int = 200) -> CachedPage:
+        """
+        Store a freshly fetched page and evict least recently used pages beyond the size limit.
+
+        Error responses and pages without text are returned but not stored, so the next request fetches them again.
+        """
+        key = normalize_url(url)
+        if not 200 <= status < 300 or not text.strip():
+            logger.info(f'Not caching {key}: status {status}, {len(text)} chars of text')
+            return CachedPage(url=key, html=html, text=text, etag=etag, last_modified=last_modified,
+                              fetched_at=time.time())
+        digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+        compressed = zlib.compress(html.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO blobs (hash, html, text, size) VALUES (?, ?, ?, ?)',
+                               (digest, compressed, text, len(compressed) + len(text.encode('utf-8'))))
+            self._conn.execute("""
+                INSERT OR REPLACE INTO urls (key, hash, etag, last_modified, fetched_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (key, digest, etag, last_modified, now, now))
+            self._evict()
+            self._conn.commit()
+        return CachedPage(url=key, html=html, text=text, etag=etag, last_modified=last_modified, fetched_at=now)
+
+    def refresh(self, url: str):
+        """
+        Mark a stale page as fresh after the server answered 304 Not Modified.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE urls SET fetched_at = ?, accessed_at = ? WHERE key = ?',
+                               (now, now, normalize_url(url)))
+            self._conn.commit()
+        self.revalidations += 1
+
+    def _evict(self):
+        # Drop least recently used urls until the blobs they reference fit in max_bytes
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while total > self.max_bytes:
+            row = self._conn.execute('SELECT key, hash FROM urls ORDER BY accessed_at LIMIT 1').fetchone()
+            if row is None:
+                break
+            key, digest = row
+            self._conn.execute('DELETE FROM urls WHERE key = ?', (key,))
+            if self._conn.execute('SELECT 1 FROM urls WHERE hash = ? LIMIT 1', (digest,)).fetchone() is None:
+                size = self._conn.execute('SELECT size FROM blobs WHERE hash = ?', (digest,)).fetchone()[0]
+                self._conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+                total -= size
+            logger.info(f'Evicted {key} from url cache')
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hit, miss and revalidation counters.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations}
+
+
+# Build the headers for a conditional GET of a stale page
+def conditional_headers(page: Optional[CachedPage]) -> Dict[str, str]:
+    """
+    Return If-None-Match/If-Modified-Since headers for the cached page, if any.
+    """
+    headers = {}
+    if page is not None:
+        if page.etag:
+            headers['If-None-Match'] = page.etag
+        if page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+    return headers
@@ -2,26 +2,6 @@
 Utility functions for the project.
 """
 import re
-from functools import wraps
-from time import perf_counter
-from typing import Callable
-
-
-# Timer decorator
-def timer(func: Callable) -> Callable:
-    """
-    Timer decorator.
-    """
-    @wraps(func)
-    def wrapper_timer(*args, **kwargs):
-        start_time = perf_counter()
-        value = func(*args, **kwargs)
-        end_time = perf_counter()
-        run_time = end_time - start_time
-        print(f'Finished {func.__name__!r} in {run_time:.2f} secs')
-        return value, run_time
-
-    return wrapper_timer
 
 
 # Prettify langchain agent response
@@ -88,3 +68,11 @@ def prettify_qa_response(response: dict, question_key: str = 'question', answer_
         result_list.append(pretty_source)
 
     return result_list
+
+
+# Remove empty lines from text
+def remove_empty_lines(text: str) -> str:
+    """
+    Remove empty lines from text.
+    """
+    return '\n'.join([line for line in text.splitlines() if line.strip()])
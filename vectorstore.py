@@ -0,0 +1,332 @@
+"""
+Local vector store backed by memory-mapped NumPy arrays.
+
+Vectors are L2-normalized so that inner product equals cosine similarity, matching the Pinecone indices.
+Search is either flat (exact) or IVF (approximate; only the nprobe clusters closest to the query are scanned).
+Vectors can optionally be stored as int8 with a per-row scale to cut memory by 4x.
+"""
+import json
+import os
+import uuid
+from contextlib import contextmanager
+from typing import IO, Any, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from config import LOCAL_INDEX_NPROBE, LOCAL_INDEX_QUANTIZE, LOCAL_INDEX_SEARCH
+from logger import logger
+
+SEARCH_MODES = ('flat', 'ivf')
+BLOCK_SIZE = 65536  # Rows scored at a time, to bound memory when dequantizing int8 vectors
+
+
+# Normalize rows to unit length
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize vectors along the last axis.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Quantize vectors to int8 with one scale per row
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization. Returns (int8 vectors, float32 scales).
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales
+
+
+# Cluster vectors with spherical k-means
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means on unit vectors. Returns (centroids, assignments).
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = vectors[assignments == c]
+            # Re-seed empty clusters with a random point
+            centroids[c] = members.sum(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+        centroids = normalize(centroids)
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+    return centroids, assignments
+
+
+# Write a file under a temporary name and move it into place
+@contextmanager
+def atomic_write(path: str, mode: str = 'w') -> Iterator[IO]:
+    """
+    Open a temporary file next to path, replacing path with it once the block exits without error.
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Get indices of the top k scores, sorted descending
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first.
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Vector store that keeps embeddings in a (memory-mapped) matrix on local disk.
+    """
+
+    def __init__(self, embedding: Embeddings, dim: int, search: str = LOCAL_INDEX_SEARCH,
+                 quantized: bool = LOCAL_INDEX_QUANTIZE, nprobe: int = LOCAL_INDEX_NPROBE):
+        if search not in SEARCH_MODES:
+            raise ValueError(f'Unknown search mode: {search}. Expected one of {SEARCH_MODES}')
+        self._embedding = embedding
+        self.dim = dim
+        self.search = search
+        self.quantized = quantized
+        self.nprobe = nprobe
+
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.vectors = np.empty((0, dim), dtype=np.int8 if quantized else np.float32)
+        self.scales = np.empty(0, dtype=np.float32)
+
+        # IVF index: centroids, plus row ids sorted by cluster with offsets into them
+        self.centroids: Optional[np.ndarray] = None
+        self.list_ids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add_embeddings(self, texts: List[str], vectors: np.ndarray, metadatas: List[dict] = None,
+                       ids: List[str] = None) -> List[str]:
+        """
+        Add precomputed embeddings. Rows whose id is already in the store replace the existing ones.
+        """
+        vectors = normalize(vectors)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        # E.g. chunks embedded again after ingestion was interrupted between saving the store and its manifest
+        self.delete(ids)
+
+        if self.quantized:
+            quantized, scales = quantize(vectors)
+            self.vectors = np.concatenate([self.vectors, quantized])
+            self.scales = np.concatenate([self.scales, scales])
+        else:
+            self.vectors = np.concatenate([self.vectors, vectors])
+
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+
+        # Keep the IVF index valid by assigning new rows to their nearest centroid
+        if self.centroids is not None:
+            assignments = np.concatenate([self._assignments(), np.argmax(vectors @ self.centroids.T, axis=1)])
+            self._set_lists(assignments)
+            logger.info(f'Assigned {len(ids)} new vectors ({start} to {len(self.ids)}) to IVF lists')
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        return self.add_embeddings(texts, vectors, metadatas, kwargs.get('ids'))
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """
+        Delete vectors by id.
+        """
+        if not ids:
+            return False
+        remove = set(ids)
+        keep = np.array([id_ not in remove for id_ in self.ids], dtype=bool)
+        if keep.all():
+            return False
+
+        assignments = self._assignments() if self.centroids is not None else None
+        self.vectors = np.asarray(self.vectors)[keep]
+        if self.quantized:
+            self.scales = np.asarray(self.scales)[keep]
+        self.ids = [id_ for id_, k in zip(self.ids, keep) if k]
+        self.texts = [text for text, k in zip(self.texts, keep) if k]
+        self.metadatas = [metadata for metadata, k in zip(self.metadatas, keep) if k]
+        if assignments is not None:
+            self._set_lists(assignments[keep])
+        logger.info(f'Deleted {len(keep) - int(keep.sum())} vectors')
+        return True
+
+    def build_ivf(self, n_clusters: int = None, n_iter: int = 20):
+        """
+        Cluster the vectors into inverted lists for approximate search.
+        """
+        if n_clusters is None:
+            n_clusters = max(1, int(4 * np.sqrt(len(self))))
+        n_clusters = min(n_clusters, len(self))
+        self.centroids, assignments = kmeans(self._dense(), n_clusters, n_iter)
+        self._set_lists(assignments)
+        logger.info(f'Built IVF index with {n_clusters} lists over {len(self)} vectors')
+
+    def _set_lists(self, assignments: np.ndarray):
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.list_ids = order.astype(np.int64)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def _assignments(self) -> np.ndarray:
+        assignments = np.empty(len(self.list_ids), dtype=np.int64)
+        for c in range(len(self.centroids)):
+            assignments[self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]]] = c
+        return assignments
+
+    def _dense(self, rows: np.ndarray = None) -> np.ndarray:
+        # Float32 view of (a subset of) the vectors
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        if not self.quantized:
+            return np.asarray(vectors, dtype=np.float32)
+        scales = self.scales if rows is None else self.scales[rows]
+        return vectors.astype(np.float32) * scales[:, None]
+
+    def _score(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        # Inner product of query against all vectors, or a subset of rows
+        n = len(self) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, BLOCK_SIZE):
+            block = slice(start, start + BLOCK_SIZE) if rows is None else rows[start:start + BLOCK_SIZE]
+            vectors = self.vectors[block]
+            if self.quantized:
+                scores[start:start + BLOCK_SIZE] = (vectors.astype(np.float32) @ query) * self.scales[block]
+            else:
+                scores[start:start + BLOCK_SIZE] = vectors @ query
+        return scores
+
+    def search_vector(self, vector: List[float], k: int = 4, search: str = None,
+                      nprobe: int = None) -> List[Tuple[int, float]]:
+        """
+        Return (row, score) pairs for the k nearest vectors.
+        """
+        search = search or self.search
+        query = normalize(vector)
+        if search == 'ivf' and self.centroids is not None:
+            probes = top_k(self.centroids @ query, nprobe or self.nprobe)
+            rows = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+            scores = self._score(query, rows)
+            best = top_k(scores, k)
+            return [(int(rows[i]), float(scores[i])) for i in best]
+
+        scores = self._score(query)
+        return [(int(i), float(scores[i])) for i in top_k(scores, k)]
+
+    def _to_document(self, row: int) -> Document:
+        return Document(page_content=self.texts[row], metadata=dict(self.metadatas[row]))
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        return [(self._to_document(row), score) for row, score in self.search_vector(embedding, k)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4,
+                                                 **kwargs: Any) -> List[Tuple[Document, float]]:
+        # Map cosine similarity from [-1, 1] to [0, 1]
+        return [(doc, (score + 1) / 2) for doc, score in self.similarity_search_with_score(query, k)]
+
+    def save(self, path: str):
+        """
+        Save vectors, documents and the IVF index to a directory.
+
+        Each file is written to a temporary file and moved into place, so that processes that memory-mapped
+        the previous files keep reading them intact. meta.json is written last.
+        """
+        os.makedirs(path, exist_ok=True)
+        with atomic_write(os.path.join(path, 'vectors.npy'), 'wb') as f:
+            np.save(f, np.asarray(self.vectors))
+        if self.quantized:
+            with atomic_write(os.path.join(path, 'scales.npy'), 'wb') as f:
+                np.save(f, np.asarray(self.scales))
+        ivf_path = os.path.join(path, 'ivf.npz')
+        if self.centroids is not None:
+            with atomic_write(ivf_path, 'wb') as f:
+                np.savez(f, centroids=self.centroids, list_ids=self.list_ids, list_offsets=self.list_offsets)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)  # Left by an earlier save; its lists no longer match the rows
+        with atomic_write(os.path.join(path, 'docs.jsonl'), 'w') as f:
+            for id_, text, metadata in zip(self.ids, self.texts, self.metadatas):
+                f.write(json.dumps({'id': id_, 'text': text, 'metadata': metadata}) + '\n')
+        with atomic_write(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'quantized': self.quantized, 'count': len(self)}, f)
+        logger.info(f'Saved {len(self)} vectors to {path}')
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings, search: str = LOCAL_INDEX_SEARCH,
+             nprobe: int = LOCAL_INDEX_NPROBE, mmap: bool = True) -> 'LocalVectorStore':
+        """
+        Load a store saved with save(), memory-mapping the vectors.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        store = cls(embedding, meta['dim'], search=search, quantized=meta['quantized'], nprobe=nprobe)
+
+        mmap_mode = 'r' if mmap else None
+        store.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+        if store.quantized:
+            store.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode=mmap_mode)
+        ivf_path = os.path.join(path, 'ivf.npz')
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            store.centroids, store.list_ids, store.list_offsets = ivf['centroids'], ivf['list_ids'], ivf['list_offsets']
+        elif search == 'ivf':
+            logger.info(f'No IVF index in {path}, falling back to flat search')
+
+        with open(os.path.join(path, 'docs.jsonl')) as f:
+            for line in f:
+                doc = json.loads(line)
+                store.ids.append(doc['id'])
+                store.texts.append(doc['text'])
+                store.metadatas.append(doc['metadata'])
+        logger.info(f'Loaded {len(store)} vectors from {path} (search: {search}, quantized: {store.quantized})')
+        return store
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> 'LocalVectorStore':
+        texts = list(texts)
+        vectors = np.asarray(embedding.embed_documents(texts), dtype=np.float32)
+        store = cls(embedding, vectors.shape[1], **kwargs)
+        store.add_embeddings(texts, vectors, metadatas)
+        if store.search == 'ivf':
+            store.build_ivf()
+        return store
@@ -0,0 +1,164 @@
+"""
+Worker process that runs command jobs from the job queue.
+
+Run the bot as a gateway that only talks to Discord, and any number of workers next to it:
+
+    python main.py --mode gateway --workers 2
+    python worker.py --concurrency 8  # In each of the two worker processes
+
+Blocking commands run on the worker's Dispatcher, with the same per-command limits as in the bot.
+Streamed commands run on its event loop and publish their text every JOB_PROGRESS_INTERVAL seconds.
+The lease on each running job is extended until it finishes. If the worker crashes, another one
+picks the job up once the lease expires. On SIGINT or SIGTERM, the worker stops claiming jobs and
+finishes the running ones.
+"""
+import argparse
+import asyncio
+import importlib
+import inspect
+import os
+import signal
+import socket
+from time import monotonic
+from typing import Callable, List, Set
+
+from config import (JOB_POLL_INTERVAL, JOB_PROGRESS_INTERVAL,
+                    JOB_QUEUE_PATH, WARM_UP_MODULES, WORKER_CONCURRENCY)
+from dispatch import Dispatcher
+from http_client import close_sessions, use_shared_sessions
+from jobqueue import Job, JobQueue
+from logger import logger
+from tracing import start_metrics_server, trace
+
+# Functions jobs may name, by module
+JOB_FUNCTIONS = {'qa': {'qa_ey', 'qa_board'},
+                 'search': {'search_agent'},
+                 'sql': {'sql_agent', 'sql_chain'},
+                 'summarize': {'astream_summarize_url', 'astream_eli5_url'}}
+PURGE_INTERVAL = 10 * 60  # Seconds between deletions of old finished jobs
+
+
+# Look up the function a job runs
+def resolve(job: Job) -> Callable:
+    """
+    Import the job's function, if it is one jobs may run.
+    """
+    module, function = job.payload['module'], job.payload['function']
+    if function not in JOB_FUNCTIONS.get(module, ()):
+        raise ValueError(f'Jobs cannot run {module}.{function}')
+    return getattr(importlib.import_module(module), function)
+
+
+class Worker:
+    """
+    Claims jobs while it has free slots and runs them concurrently.
+    """
+
+    def __init__(self, queue: JobQueue, commands: List[str] = None, concurrency: int = WORKER_CONCURRENCY):
+        self.queue = queue
+        self.commands = commands
+        self.concurrency = concurrency
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        self.dispatcher = Dispatcher()
+        self.stopping = False
+        self._running: Set[asyncio.Task] = set()
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.queue.lease / 3)
+            if not await asyncio.to_thread(self.queue.heartbeat, job, self.name):
+                logger.error(f'Lost the lease on job {job.id} ({job.command})')
+                return
+
+    async def execute(self, job: Job):
+        """
+        Run a job, then acknowledge it with its result or fail it.
+        """
+        args, kwargs = job.payload['args'], job.payload['kwargs']
+        logger.info(f'Running job {job.id} ({job.command}, attempt {job.attempts}): {args[0] if args else ""}')
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        published = False
+        try:
+            with trace(job.command, kwargs.get('model', '')):
+                use_shared_sessions()
+                func = await asyncio.to_thread(resolve, job)
+                if inspect.isasyncgenfunction(func):
+                    result, last_progress = '', monotonic()
+                    async for token in func(*args, **kwargs):
+                        result += token
+                        if monotonic() - last_progress >= JOB_PROGRESS_INTERVAL:
+                            await asyncio.to_thread(self.queue.progress, job, self.name, result)
+                            published = True
+                            last_progress = monotonic()
+                else:
+                    result = await self.dispatcher.run(job.command, func, *args, **kwargs)
+            await asyncio.to_thread(self.queue.ack, job, self.name, result)
+        except Exception as e:
+            logger.error(f'Job {job.id} ({job.command}) failed: {e!r}')
+            # The gateway sent the published text on, so another attempt couldn't continue it
+            await asyncio.to_thread(self.queue.fail, job, self.name, e, not published)
+        finally:
+            heartbeat.cancel()
+
+    async def run(self):
+        """
+        Claim and run jobs until stopped, then wait for the running ones.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+        last_purge = 0.0
+        logger.info(f'Worker {self.name} started: {self.concurrency} slots, '
+                    f'commands: {", ".join(self.commands) if self.commands else "all"}')
+        while not self.stopping:
+            await slots.acquire()
+            job = await asyncio.to_thread(self.queue.claim, self.name, self.commands)
+            if job is None:
+                slots.release()
+                if monotonic() - last_purge > PURGE_INTERVAL:
+                    purged = await asyncio.to_thread(self.queue.purge)
+                    if purged:
+                        logger.info(f'Purged {purged} finished jobs')
+                    last_purge = monotonic()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(self.execute(job))
+            self._running.add(task)
+            task.add_done_callback(lambda done: (self._running.discard(done), slots.release()))
+
+        logger.info(f'Worker {self.name} stopping, waiting for {len(self._running)} jobs')
+        await asyncio.gather(*self._running, return_exceptions=True)
+        self.dispatcher.shutdown()
+        await close_sessions()
+
+    def stop(self):
+        self.stopping = True
+
+
+# Import the command modules and initialize their backends before taking jobs
+def warm_up():
+    for name in WARM_UP_MODULES:
+        module = importlib.import_module(name)
+        if hasattr(module, 'warm_up'):
+            module.warm_up()
+
+
+async def main(args):
+    worker = Worker(JobQueue(args.queue), args.commands, args.concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    if args.warm_up:
+        await asyncio.to_thread(warm_up)
+    await worker.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue', type=str, default=JOB_QUEUE_PATH)
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    parser.add_argument('--commands', type=str, nargs='*', default=None, help='Only run jobs of these commands')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve /metrics on this port')
+    args = parser.parse_args()
+
+    start_metrics_server(args.metrics_port)
+    asyncio.run(main(args))